@@ -1,13 +1,22 @@
 'use client'
 
-import { useEffect, useState } from 'react'
+import { useCallback, useEffect, useRef, useState } from 'react'
 import ScrollStory from '@/components/projects/nyc-bike-rhythms/ScrollStory'
 import WeekExplorer from '@/components/projects/nyc-bike-rhythms/WeekExplorer'
 import HeroAnimation from '@/components/projects/nyc-bike-rhythms/HeroAnimation'
-import type { StoryMoment, NeighborhoodsGeoJSON, FlowData } from '@/lib/types/citibike'
+import { FlowRequestContext } from '@/components/projects/nyc-bike-rhythms/FlowRequestContext'
+import { NeighborhoodRequestContext } from '@/components/projects/nyc-bike-rhythms/NeighborhoodRequestContext'
+import { FlowBundleLoader, NeighborhoodLoader, loadStoryFlows } from '@/lib/citibike'
+import type { StoryMoment, NeighborhoodsGeoJSON, NeighborhoodDetail, FlowData, FlowFilter, TopFlow } from '@/lib/types/citibike'
+
+export type BikeRhythmsDataUrls = {
+  neighborhoods: Record<NeighborhoodDetail, string>
+  flowManifest: string
+}
 
 type BikeRhythmsClientProps = {
   storyMoments: StoryMoment[]
+  dataUrls: BikeRhythmsDataUrls
 }
 
 // Empty placeholder for immediate render
@@ -17,65 +26,102 @@ const EMPTY_NEIGHBORHOODS: NeighborhoodsGeoJSON = {
 }
 
 export default function BikeRhythmsClient({
-  storyMoments
+  storyMoments,
+  dataUrls
 }: BikeRhythmsClientProps) {
   const [neighborhoods, setNeighborhoods] = useState<NeighborhoodsGeoJSON>(EMPTY_NEIGHBORHOODS)
   const [flows, setFlows] = useState<FlowData | undefined>(undefined)
+  const [storyFlows, setStoryFlows] = useState<Record<string, TopFlow[]>>({})
+  const flowLoader = useRef<FlowBundleLoader | null>(null)
+  const neighborhoodLoader = useRef<NeighborhoodLoader | null>(null)
+
+  const getFlowLoader = () => {
+    if (!flowLoader.current) flowLoader.current = new FlowBundleLoader(dataUrls.flowManifest)
+    return flowLoader.current
+  }
 
   // Scroll to top when page loads (prevents browser scroll restoration)
   useEffect(() => {
     window.scrollTo(0, 0)
   }, [])
 
-  // Load data immediately on mount - preload links in page.tsx start fetch early
+  // Load flows immediately on mount - preload links in page.tsx start fetch early
   useEffect(() => {
-    Promise.all([
-      fetch('/data/citibike/neighborhoods.json').then(res => res.json()),
-      fetch('/data/citibike/flows.json').then(res => res.json())
-    ])
-      .then(([neighborhoodsData, flowsData]) => {
-        setNeighborhoods(neighborhoodsData)
-        setFlows(flowsData)
-      })
+    getFlowLoader().initialize()
+      .then(() => setFlows(getFlowLoader().flowData()))
       .catch(err => console.error('Failed to load data:', err))
+  }, [dataUrls])
+
+  // Story moments with precomputed flows draw them as-is; they are small, so
+  // fetch them all up front and scroll transitions never wait on filtering
+  useEffect(() => {
+    storyMoments.forEach(moment => {
+      if (!moment.flowSet) return
+      loadStoryFlows(moment.flowSet)
+        .then(momentFlows => setStoryFlows(current => ({ ...current, [moment.id]: momentFlows })))
+        .catch(err => console.error(`Failed to load flows for ${moment.id}:`, err))
+    })
+  }, [storyMoments])
+
+  // Maps request the flow bundles their filter needs; always publish the
+  // loader's full set so a late response never replaces newer data
+  const requestFlows = useCallback((filter: FlowFilter) => {
+    const loader = getFlowLoader()
+    loader.ensure(filter)
+      .then(() => setFlows(loader.flowData()))
+      .catch(err => console.error('Failed to load flows:', err))
   }, [])
 
+  // Maps request the neighborhood detail their zoom needs; only the level for
+  // the opening view is fetched up front, finer ones as the story zooms in
+  const requestNeighborhoods = useCallback((zoom: number) => {
+    if (!neighborhoodLoader.current) {
+      neighborhoodLoader.current = new NeighborhoodLoader(dataUrls.neighborhoods, setNeighborhoods)
+    }
+    neighborhoodLoader.current.request(zoom)
+  }, [dataUrls])
+
   return (
-    <div className="bike-rhythms">
-      {/* Hero with animated SVG trip visualization - loads instantly */}
-      <section className="bike-rhythms-hero">
-        <div className="hero-cover-visual">
-          <div className="cover-gradient" />
-          <HeroAnimation />
-          <div className="cover-glow" />
-        </div>
-        <div className="hero-content-overlay">
-          <p className="bike-rhythms-eyebrow">A Visual Story</p>
-          <h1 className="bike-rhythms-title">City in Motion</h1>
-          <p className="bike-rhythms-subtitle">
-            46 million bike trips. One year. What they reveal about New York.
-          </p>
-          <div className="bike-rhythms-scroll-hint">
-            <span>Scroll to explore</span>
-            <div className="scroll-arrow">↓</div>
-          </div>
-        </div>
-      </section>
+    <FlowRequestContext.Provider value={requestFlows}>
+      <NeighborhoodRequestContext.Provider value={requestNeighborhoods}>
+        <div className="bike-rhythms">
+          {/* Hero with animated SVG trip visualization - loads instantly */}
+          <section className="bike-rhythms-hero">
+            <div className="hero-cover-visual">
+              <div className="cover-gradient" />
+              <HeroAnimation />
+              <div className="cover-glow" />
+            </div>
+            <div className="hero-content-overlay">
+              <p className="bike-rhythms-eyebrow">A Visual Story</p>
+              <h1 className="bike-rhythms-title">City in Motion</h1>
+              <p className="bike-rhythms-subtitle">
+                46 million bike trips. One year. What they reveal about New York.
+              </p>
+              <div className="bike-rhythms-scroll-hint">
+                <span>Scroll to explore</span>
+                <div className="scroll-arrow">↓</div>
+              </div>
+            </div>
+          </section>
 
-      {/* Always render components - map shows dark background while loading */}
-      <ScrollStory
-        moments={storyMoments}
-        neighborhoods={neighborhoods}
-        flows={flows}
-      />
+          {/* Always render components - map shows dark background while loading */}
+          <ScrollStory
+            moments={storyMoments}
+            neighborhoods={neighborhoods}
+            flows={flows}
+            storyFlows={storyFlows}
+          />
 
-      {/* Week Explorer section */}
-      <section className="week-explorer-section" id="week-explorer">
-        <WeekExplorer
-          neighborhoods={neighborhoods}
-          flows={flows}
-        />
-      </section>
-    </div>
+          {/* Week Explorer section */}
+          <section className="week-explorer-section" id="week-explorer">
+            <WeekExplorer
+              neighborhoods={neighborhoods}
+              flows={flows}
+            />
+          </section>
+        </div>
+      </NeighborhoodRequestContext.Provider>
+    </FlowRequestContext.Provider>
   )
 }
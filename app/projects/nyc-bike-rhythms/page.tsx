@@ -1,7 +1,24 @@
 import { Metadata } from 'next'
 import BikeRhythmsClient from './BikeRhythmsClient'
 import storyMoments from '@/data/citibike/story-moments.json'
-import type { StoryMoment } from '@/lib/types/citibike'
+import outputManifest from '@/data/citibike/manifest.json'
+import { neighborhoodDetailForZoom, outputUrl } from '@/lib/citibike'
+import type { OutputManifest, StoryMoment } from '@/lib/types/citibike'
+
+// Content-addressed data URLs, resolved at build time so the first fetches
+// don't wait on the manifest
+const manifest = outputManifest as OutputManifest
+const dataUrls = {
+  neighborhoods: {
+    low: outputUrl(manifest, 'neighborhoods/low.json'),
+    medium: outputUrl(manifest, 'neighborhoods/medium.json'),
+    high: outputUrl(manifest, 'neighborhoods/high.json')
+  },
+  flowManifest: outputUrl(manifest, 'flows/manifest.json')
+}
+const moments = storyMoments as StoryMoment[]
+// The only neighborhood detail fetched for first paint: the opening view's
+const openingNeighborhoods = dataUrls.neighborhoods[neighborhoodDetailForZoom(moments[0].mapState.zoom)]
 
 export const metadata: Metadata = {
   title: 'City in Motion | Aklavya',
@@ -17,10 +34,11 @@ export default function NYCBikeRhythms() {
   return (
     <>
       {/* Preload data files to start fetching in parallel with JS */}
-      <link rel="preload" href="/data/citibike/neighborhoods.json" as="fetch" crossOrigin="anonymous" />
-      <link rel="preload" href="/data/citibike/flows.json" as="fetch" crossOrigin="anonymous" />
+      <link rel="preload" href={openingNeighborhoods} as="fetch" crossOrigin="anonymous" />
+      <link rel="preload" href={dataUrls.flowManifest} as="fetch" crossOrigin="anonymous" />
       <BikeRhythmsClient
-        storyMoments={storyMoments as StoryMoment[]}
+        storyMoments={moments}
+        dataUrls={dataUrls}
       />
     </>
   )
@@ -1,9 +1,11 @@
 'use client'
 
-import { useRef, useEffect, useState, useMemo } from 'react'
+import { useRef, useEffect, useState, useMemo, useContext } from 'react'
 import mapboxgl from 'mapbox-gl'
 import 'mapbox-gl/dist/mapbox-gl.css'
-import type { MapState, NeighborhoodsGeoJSON, FlowData, FlowFilter, Flow } from '@/lib/types/citibike'
+import { FlowRequestContext } from '@/components/projects/nyc-bike-rhythms/FlowRequestContext'
+import { NeighborhoodRequestContext } from '@/components/projects/nyc-bike-rhythms/NeighborhoodRequestContext'
+import type { MapState, NeighborhoodsGeoJSON, FlowData, FlowFilter, Flow, TopFlow } from '@/lib/types/citibike'
 
 type BikeMapProps = {
   mapState: MapState
@@ -11,6 +13,7 @@ type BikeMapProps = {
   highlightNeighborhoods?: string[]
   flows?: FlowData
   flowFilter?: FlowFilter | null
+  exactFlows?: TopFlow[]  // precomputed flows, drawn as-is; flows and flowFilter are ignored
   flowColor?: string
   onNeighborhoodClick?: (id: string, name: string) => void
 }
@@ -96,7 +99,7 @@ function filterFlows(flows: Flow[], filter: FlowFilter): Flow[] {
 }
 
 // Create GeoJSON for flow lines
-function createFlowGeoJSON(flows: Flow[], maxCount: number) {
+function createFlowGeoJSON(flows: TopFlow[], maxCount: number) {
   const features = flows.map(flow => ({
     type: 'Feature' as const,
     properties: {
@@ -123,6 +126,7 @@ export default function BikeMap({
   highlightNeighborhoods = [],
   flows,
   flowFilter,
+  exactFlows,
   flowColor = '#FF9500',
   onNeighborhoodClick
 }: BikeMapProps) {
@@ -131,9 +135,22 @@ export default function BikeMap({
   const [loaded, setLoaded] = useState(false)
   const animationRef = useRef<number | null>(null)
   const progressRef = useRef(0)
+  const requestFlows = useContext(FlowRequestContext)
+  const requestNeighborhoods = useContext(NeighborhoodRequestContext)
+
+  // Fetch the neighborhood detail this zoom needs
+  useEffect(() => {
+    requestNeighborhoods(mapState.zoom)
+  }, [mapState.zoom, requestNeighborhoods])
+
+  // Fetch the flow bundles this filter draws from
+  useEffect(() => {
+    if (flowFilter && !exactFlows) requestFlows(flowFilter)
+  }, [flowFilter, exactFlows, requestFlows])
 
   // Filter and prepare flow data
-  const filteredFlows = useMemo(() => {
+  const filteredFlows = useMemo((): TopFlow[] => {
+    if (exactFlows) return exactFlows
     if (!flows || !flowFilter) return []
 
     const filtered = filterFlows(flows.flows, flowFilter)
@@ -156,7 +173,7 @@ export default function BikeMap({
     return Array.from(aggregated.values())
       .sort((a, b) => b.c - a.c)
       .slice(0, maxFlows)
-  }, [flows, flowFilter])
+  }, [flows, flowFilter, exactFlows])
 
   const flowGeoJSON = useMemo(() => {
     if (filteredFlows.length === 0) return null
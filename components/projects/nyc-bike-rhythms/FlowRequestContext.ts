@@ -0,0 +1,5 @@
+import { createContext } from 'react'
+import type { FlowFilter } from '@/lib/types/citibike'
+
+// Lets a map ask BikeRhythmsClient to fetch the flow bundles its filter needs
+export const FlowRequestContext = createContext<(filter: FlowFilter) => void>(() => {})
@@ -0,0 +1,4 @@
+import { createContext } from 'react'
+
+// Lets a map ask BikeRhythmsClient for the neighborhood detail its zoom needs
+export const NeighborhoodRequestContext = createContext<(zoom: number) => void>(() => {})
@@ -3,20 +3,23 @@
 import { useRef, useState, useEffect, useCallback } from 'react'
 import dynamic from 'next/dynamic'
 import StoryMoment from './StoryMoment'
-import type { StoryMoment as StoryMomentType, NeighborhoodsGeoJSON, FlowData } from '@/lib/types/citibike'
+import type { StoryMoment as StoryMomentType, NeighborhoodsGeoJSON, FlowData, TopFlow } from '@/lib/types/citibike'
 
 // Dynamic import BikeMap - Mapbox GL JS needs window object
 const BikeMap = dynamic(() => import('./BikeMap'), {
   ssr: false
 })
 
+const NO_FLOWS: TopFlow[] = []
+
 type ScrollStoryProps = {
   moments: StoryMomentType[]
   neighborhoods: NeighborhoodsGeoJSON
   flows?: FlowData
+  storyFlows?: Record<string, TopFlow[]>
 }
 
-export default function ScrollStory({ moments, neighborhoods, flows }: ScrollStoryProps) {
+export default function ScrollStory({ moments, neighborhoods, flows, storyFlows = {} }: ScrollStoryProps) {
   const [activeIndex, setActiveIndex] = useState(0)
   const [isHidden, setIsHidden] = useState(false)
   const momentRefs = useRef<(HTMLDivElement | null)[]>([])
@@ -76,6 +79,10 @@ export default function ScrollStory({ moments, neighborhoods, flows }: ScrollSto
 
   const activeMoment = moments[activeIndex]
   const hasSplitView = !!activeMoment.splitView
+  // A moment with a precomputed flow set never filters flows on the client:
+  // it draws nothing until its set has loaded
+  const flowFilter = activeMoment.flowSet ? null : activeMoment.flowFilter
+  const exactFlows = activeMoment.flowSet ? storyFlows[activeMoment.id] ?? NO_FLOWS : undefined
 
   return (
     <div className={`scroll-story ${hasSplitView ? 'has-split-view' : ''}`}>
@@ -111,7 +118,8 @@ export default function ScrollStory({ moments, neighborhoods, flows }: ScrollSto
             neighborhoods={neighborhoods}
             highlightNeighborhoods={activeMoment.highlightNeighborhoods}
             flows={flows}
-            flowFilter={activeMoment.flowFilter}
+            flowFilter={flowFilter}
+            exactFlows={exactFlows}
             flowColor={activeMoment.flowColor || '#FF9500'}
           />
         )}
@@ -0,0 +1,238 @@
+import type {
+  CentroidsBundle,
+  Flow,
+  FlowBundle,
+  FlowBundleEntry,
+  FlowBundleManifest,
+  FlowData,
+  FlowFilter,
+  NeighborhoodDetail,
+  NeighborhoodsGeoJSON,
+  NeighborhoodTopology,
+  OutputManifest,
+  StoryFlowSet,
+  StoryFlowSetRef,
+  TimePeriod,
+  TopFlow
+} from '@/lib/types/citibike'
+
+// Must match FLOW_BUNDLES_VERSION and OUTPUT_MANIFEST_VERSION in
+// scripts/citibike/process_data.py
+export const FLOW_BUNDLES_VERSION = 1
+export const OUTPUT_MANIFEST_VERSION = 1
+
+// URL of an output by its logical name, e.g. "flows/manifest.json"
+export function outputUrl(manifest: OutputManifest, name: string, baseUrl: string = '/data/citibike'): string {
+  if (manifest.version !== OUTPUT_MANIFEST_VERSION) {
+    throw new Error(`Unsupported output manifest version: ${manifest.version}`)
+  }
+  const entry = manifest.files[name]
+  if (!entry) throw new Error(`Unknown output: ${name}`)
+  return `${baseUrl}/${entry.file}`
+}
+
+// Keys of the "<dayType>/<period>" bundles a filter draws from
+export function flowBundleKeys(filter: FlowFilter): string[] {
+  const dayTypes = filter.dayType === 'all' ? ['weekday', 'weekend'] : [filter.dayType]
+  const keys: string[] = []
+  dayTypes.forEach(dayType => {
+    filter.timePeriods.forEach(period => keys.push(`${dayType}/${period}`))
+  })
+  return keys
+}
+
+// Fetches the flow bundles listed in the flows manifest on demand. Loaded
+// bundles are kept, so flowData() grows as more of the story is viewed.
+export class FlowBundleLoader {
+  private baseUrl: string
+  private manifestUrl: string
+  private ready: Promise<void>
+  private entries: Record<string, FlowBundleEntry> = {}
+  private requests: Record<string, Promise<void>> = {}
+  private loaded: Record<string, Flow[]> = {}
+  private ntas: string[] = []
+  private centroids: [number, number][] = []
+  private topFlows: TopFlow[] = []
+
+  // manifestUrl is the content-addressed flows manifest (see outputUrl)
+  constructor(manifestUrl: string, baseUrl: string = '/data/citibike') {
+    this.baseUrl = baseUrl
+    this.manifestUrl = manifestUrl
+    this.ready = this.init()
+  }
+
+  // Manifest, centroid table and top flows: everything needed for first paint
+  private async init(): Promise<void> {
+    const manifest: FlowBundleManifest = await fetch(this.manifestUrl).then(res => res.json())
+    if (manifest.version !== FLOW_BUNDLES_VERSION) {
+      throw new Error(`Unsupported flow bundles version: ${manifest.version}`)
+    }
+    manifest.bundles.forEach(entry => {
+      this.entries[entry.key] = entry
+    })
+
+    const [centroids, top] = await Promise.all([
+      this.fetchBundle<CentroidsBundle>('centroids'),
+      this.fetchBundle<FlowBundle>('top')
+    ])
+    this.ntas = centroids.ntas
+    this.centroids = centroids.centroids
+    this.topFlows = top.c.map((count, i) => ({
+      f: this.ntas[top.f[i]],
+      t: this.ntas[top.t[i]],
+      fc: this.centroids[top.f[i]],
+      tc: this.centroids[top.t[i]],
+      c: count
+    }))
+  }
+
+  private fetchBundle<T>(key: string): Promise<T> {
+    const entry = this.entries[key]
+    if (!entry) return Promise.reject(new Error(`Unknown flow bundle: ${key}`))
+    // Bundle files are content-addressed, so a changed bundle always has a new URL
+    return fetch(`${this.baseUrl}/${entry.file}`).then(res => res.json())
+  }
+
+  private load(key: string): Promise<void> {
+    if (!this.requests[key]) {
+      const [dayType, period] = key.split('/')
+      this.requests[key] = this.fetchBundle<FlowBundle>(key).then(bundle => {
+        this.loaded[key] = bundle.c.map((count, i) => ({
+          f: this.ntas[bundle.f[i]],
+          t: this.ntas[bundle.t[i]],
+          fc: this.centroids[bundle.f[i]],
+          tc: this.centroids[bundle.t[i]],
+          d: dayType === 'weekend' ? 1 : 0,
+          p: period as TimePeriod,
+          c: count
+        }))
+      })
+    }
+    return this.requests[key]
+  }
+
+  async initialize(): Promise<void> {
+    await this.ready
+  }
+
+  // Load every bundle the filter needs; already loaded bundles are reused
+  async ensure(filter: FlowFilter): Promise<void> {
+    await this.ready
+    await Promise.all(flowBundleKeys(filter).map(key => this.load(key)))
+  }
+
+  flowData(): FlowData {
+    const flows: Flow[] = []
+    Object.keys(this.loaded).forEach(key => {
+      this.loaded[key].forEach(flow => flows.push(flow))
+    })
+
+    const centroids: Record<string, [number, number]> = {}
+    this.ntas.forEach((nta, i) => {
+      centroids[nta] = this.centroids[i]
+    })
+
+    return { flows, topFlows: this.topFlows, centroids }
+  }
+}
+
+// Fetch a story moment's precomputed flows as ready-to-draw records
+export async function loadStoryFlows(ref: StoryFlowSetRef, baseUrl: string = '/data/citibike'): Promise<TopFlow[]> {
+  const set: StoryFlowSet = await fetch(`${baseUrl}/${ref.file}`).then(res => res.json())
+  return set.c.map((count, i) => ({
+    f: set.ntas[set.f[i]],
+    t: set.ntas[set.t[i]],
+    fc: set.centroids[set.f[i]],
+    tc: set.centroids[set.t[i]],
+    c: count
+  }))
+}
+
+// Expand a neighborhood topology back into GeoJSON: undo the delta encoding
+// and quantization of each arc, then stitch arcs into rings
+export function decodeNeighborhoodTopology(topology: NeighborhoodTopology): NeighborhoodsGeoJSON {
+  const [scaleX, scaleY] = topology.transform.scale
+  const [translateX, translateY] = topology.transform.translate
+  const arcs = topology.arcs.map(arc => {
+    let x = 0
+    let y = 0
+    return arc.map(([dx, dy]) => {
+      x += dx
+      y += dy
+      return [x * scaleX + translateX, y * scaleY + translateY]
+    })
+  })
+
+  // Consecutive arcs share an endpoint; a negative index is a reversed arc
+  const ring = (indices: number[]) => {
+    const points: number[][] = []
+    indices.forEach(index => {
+      const arc = index < 0 ? arcs[~index].slice().reverse() : arcs[index]
+      arc.forEach((point, i) => {
+        if (i > 0 || points.length === 0) points.push(point)
+      })
+    })
+    return points
+  }
+  const polygon = (rings: number[][]) => rings.map(ring)
+
+  return {
+    type: 'FeatureCollection',
+    features: topology.objects.neighborhoods.geometries.map(geometry => ({
+      type: 'Feature' as const,
+      properties: geometry.properties,
+      geometry: geometry.type === 'Polygon'
+        ? { type: 'Polygon' as const, coordinates: polygon(geometry.arcs as number[][]) }
+        : { type: 'MultiPolygon' as const, coordinates: (geometry.arcs as number[][][]).map(polygon) }
+    }))
+  }
+}
+
+// Levels of detail from coarsest to finest, and the map zoom from which each
+// one replaces the coarser level
+const NEIGHBORHOOD_DETAILS: NeighborhoodDetail[] = ['low', 'medium', 'high']
+export const NEIGHBORHOOD_DETAIL_ZOOM: Record<NeighborhoodDetail, number> = { low: 0, medium: 12.5, high: 13.5 }
+
+export function neighborhoodDetailForZoom(zoom: number): NeighborhoodDetail {
+  return NEIGHBORHOOD_DETAILS.filter(detail => zoom >= NEIGHBORHOOD_DETAIL_ZOOM[detail]).pop() ?? 'low'
+}
+
+// Fetches the neighborhood level of detail the maps' zoom needs. Requests
+// made together (every map asks as the page mounts) fetch only the finest
+// level among them, and a finer level is never replaced by a coarser one.
+export class NeighborhoodLoader {
+  private urls: Record<NeighborhoodDetail, string>
+  private onLoad: (neighborhoods: NeighborhoodsGeoJSON) => void
+  private requested = -1
+  private pending = -1
+  private shown = -1
+
+  // urls are the content-addressed neighborhoods/<detail>.json files (see outputUrl)
+  constructor(urls: Record<NeighborhoodDetail, string>, onLoad: (neighborhoods: NeighborhoodsGeoJSON) => void) {
+    this.urls = urls
+    this.onLoad = onLoad
+  }
+
+  request(zoom: number): void {
+    const level = NEIGHBORHOOD_DETAILS.indexOf(neighborhoodDetailForZoom(zoom))
+    if (level <= Math.max(this.requested, this.pending)) return
+    if (this.pending < 0) queueMicrotask(() => this.flush())
+    this.pending = level
+  }
+
+  private flush(): void {
+    const level = this.pending
+    const detail = NEIGHBORHOOD_DETAILS[level]
+    this.pending = -1
+    this.requested = level
+    fetch(this.urls[detail])
+      .then(res => res.json())
+      .then(decodeNeighborhoodTopology)
+      .then(neighborhoods => {
+        if (level < this.shown) return
+        this.shown = level
+        this.onLoad(neighborhoods)
+      })
+      .catch(err => console.error(`Failed to load ${detail} neighborhoods:`, err))
+  }
+}
@@ -28,19 +28,36 @@ export type SplitView = {
   }
 }
 
-export type StoryMoment = {
+// The filter generate_story_moments writes next to a moment's flowSet, in
+// hours and days (0=Monday) rather than periods. Its flows were evaluated at
+// build time, so the client never filters with it.
+export type StoryFlowFilter = {
+  hours: number[]
+  days: number[]
+  direction: FlowFilter['direction']
+  fromPrefixes?: string[]
+  toPrefixes?: string[]
+}
+
+type StoryMomentContent = {
   id: string
   title: string
   description: string
   mapState: MapState
   highlightNeighborhoods: string[]
-  flowFilter?: FlowFilter | null
   flowColor?: string
   statistic?: { label: string; value: string }
   timeContext?: string
   splitView?: SplitView
 }
 
+// Hand-written moments filter the flow bundles by period on the client;
+// generated moments draw their precomputed flowSet and nothing else
+export type StoryMoment = StoryMomentContent & (
+  | { flowFilter?: FlowFilter | null; flowSet?: undefined }
+  | { flowFilter: StoryFlowFilter; flowSet: StoryFlowSetRef }
+)
+
 export type HourlyData = {
   hour: number
   departures: number
@@ -110,5 +127,95 @@ export type Metadata = {
     start: string
     end: string
   }
-  generatedAt: string
+}
+
+// On-demand flow bundles (see generate_flow_bundles in
+// scripts/citibike/process_data.py). flows/manifest.json lists every bundle;
+// "centroids" holds the NTA table, "top" the top flows, and one bundle per
+// "<dayType>/<period>" key holds that slice of the flows.
+export type FlowBundleEntry = {
+  key: string
+  file: string
+  bytes: number
+  sha256: string
+}
+
+export type FlowBundleManifest = {
+  version: 1
+  bundles: FlowBundleEntry[]
+}
+
+export type CentroidsBundle = {
+  ntas: string[]
+  centroids: [number, number][]
+}
+
+export type FlowBundle = {
+  f: number[]
+  t: number[]
+  c: number[]
+}
+
+// Quantized, TopoJSON-style neighborhood geometry (see
+// generate_neighborhood_topologies in scripts/citibike/process_data.py).
+// neighborhoods/<detail>.json holds one topology per level of detail; arcs
+// are delta-encoded integer coordinates shared between neighbors.
+export type NeighborhoodDetail = 'low' | 'medium' | 'high'
+
+export type NeighborhoodTopologyGeometry = {
+  type: 'Polygon' | 'MultiPolygon'
+  arcs: number[][] | number[][][]
+  properties: NeighborhoodFeature['properties']
+}
+
+export type NeighborhoodTopology = {
+  type: 'Topology'
+  transform: {
+    scale: [number, number]
+    translate: [number, number]
+  }
+  arcs: [number, number][][]
+  objects: {
+    neighborhoods: {
+      type: 'GeometryCollection'
+      geometries: NeighborhoodTopologyGeometry[]
+    }
+  }
+}
+
+// data/citibike/manifest.json (see save_output in
+// scripts/citibike/process_data.py) maps each output's logical name, e.g.
+// "neighborhoods/low.json", to the file that holds it. Files fetched at
+// runtime are content-addressed ("neighborhoods/low.<hash>.json"), so a
+// changed file always gets a new URL and can be cached forever. Those files
+// and the manifest itself are copied to public/data/citibike (see
+// publish_outputs).
+export type OutputFile = {
+  file: string
+  bytes: number
+  sha256: string
+}
+
+export type OutputManifest = {
+  version: 1
+  files: Record<string, OutputFile>
+}
+
+// Exact flows for one story moment, evaluated from its flowFilter at build
+// time (see generate_story_flows in scripts/citibike/process_data.py). The
+// moment references story-flows/<id>.<hash>.json; f/t index into the set's
+// own ntas and centroids, strongest flow first.
+export type StoryFlowSetRef = {
+  file: string
+  sha256: string
+  trips: number
+}
+
+export type StoryFlowSet = {
+  trips: number
+  ntas: string[]
+  centroids: [number, number][]
+  f: number[]
+  t: number[]
+  c: number[]
 }
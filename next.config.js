@@ -1,6 +1,14 @@
 /** @type {import('next').NextConfig} */
 const nextConfig = {
   reactStrictMode: true,
+  // Citi Bike data fetched at runtime is content-addressed (see save_output in
+  // scripts/citibike/process_data.py): a file never changes under its URL
+  async headers() {
+    return ['neighborhoods', 'flows', 'story-flows'].map(dir => ({
+      source: `/data/citibike/${dir}/:file*`,
+      headers: [{ key: 'Cache-Control', value: 'public, max-age=31536000, immutable' }],
+    }))
+  },
 }
 
 module.exports = nextConfig
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the NYC Bike Rhythms data pipeline.
+
+Generates synthetic Citi Bike zips and a stand-in NTA boundary file (cached
+under cache/benchmark/), then times and memory-profiles each pipeline stage
+separately and writes the results as JSON.
+
+Usage:
+    python benchmark.py [--trips 1000000 10000000 50000000] [--output results.json]
+    python benchmark.py --compare before.json   # exit 1 if a stage regressed
+    python benchmark.py --engines pandas duckdb  # exit 1 unless engine outputs match
+    python benchmark.py --timestamps 5000000     # parse_datetime micro-benchmark
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import process_data
+
+BENCHMARK_DIR = process_data.CACHE_DIR / "benchmark"
+RESULTS_VERSION = 1
+# Bump when synthetic_dataset would write different files for the same parameters
+DATASET_VERSION = 2
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+# Rough outline of the Citi Bike service area
+SERVICE_AREA = (-74.05, 40.64, -73.88, 40.84)
+NTA_GRID = (8, 12)
+
+# Relative departures per hour on weekdays (commute peaks) and weekends
+WEEKDAY_HOURS = np.array([2, 1, 1, 1, 1, 3, 8, 18, 26, 18, 11, 11,
+                          13, 13, 14, 17, 23, 28, 22, 15, 11, 8, 6, 4], dtype=float)
+WEEKEND_HOURS = np.array([5, 4, 3, 2, 1, 1, 2, 4, 7, 11, 15, 18,
+                          19, 19, 19, 18, 17, 15, 13, 11, 9, 8, 7, 6], dtype=float)
+
+def _edge_points(p0, p1, segments=8, amplitude=0.002):
+    """Wavy edge from p0 to p1. Shared edges come out identical for both
+    neighbours, so the grid has no gaps and simplification has work to do."""
+    reverse = p1 < p0
+    if reverse:
+        p0, p1 = p1, p0
+    t = np.linspace(0, 1, segments + 1)
+    offset = amplitude * np.sin(np.pi * t) * np.sin(3 * np.pi * t + p0[0] * 50 + p0[1] * 70)
+    x = p0[0] + (p1[0] - p0[0]) * t
+    y = p0[1] + (p1[1] - p0[1]) * t
+    if p0[0] == p1[0]:
+        x = x + offset
+    else:
+        y = y + offset
+    points = list(zip(x.round(6), y.round(6)))
+    return points[::-1] if reverse else points
+
+def synthetic_neighborhoods(path):
+    """Write a grid of wavy polygons over the service area as NTA boundaries."""
+    west, south, east, north = SERVICE_AREA
+    cols, rows = NTA_GRID
+    dx, dy = (east - west) / cols, (north - south) / rows
+    # NTA codes start with the borough's code, as the story moments' prefixes expect
+    boroughs = [('Manhattan', 'MN'), ('Brooklyn', 'BK'), ('Queens', 'QN'), ('Bronx', 'BX')]
+
+    features = []
+    for i in range(cols):
+        for j in range(rows):
+            corners = [(west + i * dx, south + j * dy), (west + (i + 1) * dx, south + j * dy),
+                       (west + (i + 1) * dx, south + (j + 1) * dy), (west + i * dx, south + (j + 1) * dy)]
+            ring = []
+            for k in range(4):
+                ring.extend(_edge_points(corners[k], corners[(k + 1) % 4])[:-1])
+            ring.append(ring[0])
+
+            borough, prefix = boroughs[(i + j) % len(boroughs)]
+            code = f"{prefix}{i:02d}{j:02d}"
+            features.append({
+                'type': 'Feature',
+                'properties': {'nta2020': code, 'ntaname': f"Neighborhood {code}", 'boroname': borough},
+                'geometry': {'type': 'Polygon', 'coordinates': [[list(p) for p in ring]]}
+            })
+
+    path.write_text(json.dumps({'type': 'FeatureCollection', 'features': features}))
+
+def _format_timestamps(values):
+    """datetime64[ms] -> "YYYY-MM-DD HH:MM:SS.fff" strings, as in the Citi Bike CSVs."""
+    chars = np.datetime_as_string(values, unit='ms').astype('S23')
+    chars.view(np.uint8).reshape(-1, 23)[:, 10] = ord(' ')
+    return chars.astype('U23')
+
+def synthetic_trips(rng, month_start, n, stations):
+    """One chunk of trips starting in the month beginning at month_start."""
+    ids, lat, lng, popularity, nearby = stations
+    days_in_month = month_start.days_in_month
+
+    day = rng.integers(0, days_in_month, n)
+    weekend = ((month_start.dayofweek + day) % 7) >= 5
+    hour = np.where(weekend,
+                    rng.choice(24, n, p=WEEKEND_HOURS / WEEKEND_HOURS.sum()),
+                    rng.choice(24, n, p=WEEKDAY_HOURS / WEEKDAY_HOURS.sum()))
+    offset_ms = ((day * 24 + hour) * 3600 + rng.integers(0, 3600, n)) * 1000 + rng.integers(0, 1000, n)
+    started_at = np.datetime64(month_start.date(), 'ms') + offset_ms.astype('timedelta64[ms]')
+    ended_at = started_at + (rng.gamma(2.0, 420.0, n) * 1000 + 60_000).astype('timedelta64[ms]')
+
+    # Most trips are short hops to a nearby station
+    start = rng.choice(len(ids), n, p=popularity)
+    end = np.where(rng.random(n) < 0.7,
+                   nearby[start, rng.integers(0, nearby.shape[1], n)],
+                   rng.choice(len(ids), n, p=popularity))
+    # GPS jitter on a share of e-bike trips, as in the real data
+    jitter = rng.normal(0, 2e-5, n) * (rng.random(n) < 0.3)
+
+    trips = pd.DataFrame({
+        'ride_id': [f"{value:016X}" for value in rng.integers(0, 2 ** 63, n)],
+        'rideable_type': np.where(rng.random(n) < 0.6, 'electric_bike', 'classic_bike'),
+        'started_at': _format_timestamps(started_at),
+        'ended_at': _format_timestamps(ended_at),
+        'start_station_name': np.char.add('Station ', ids[start]),
+        'start_station_id': ids[start],
+        'end_station_name': np.char.add('Station ', ids[end]),
+        'end_station_id': ids[end],
+        'start_lat': (lat[start] + jitter).round(6),
+        'start_lng': lng[start].round(6),
+        'end_lat': lat[end].round(6),
+        'end_lng': lng[end].round(6),
+        'member_casual': np.where(rng.random(n) < 0.78, 'member', 'casual'),
+    })
+    # Undocked or lost bikes have no end station
+    missing = rng.random(n) < 0.005
+    trips.loc[missing, ['end_station_name', 'end_station_id', 'end_lat', 'end_lng']] = np.nan
+    return trips
+
+def synthetic_dataset(directory, trips, months=12, stations=2000, seed=0, chunk_size=1_000_000):
+    """Write RAW_DIR-style monthly zips and an NTA boundary file to directory.
+
+    Datasets are reused if one with the same parameters was already written.
+    Months with more than chunk_size trips are split into several CSVs, like
+    the real monthly archives.
+    """
+    spec = {'version': DATASET_VERSION, 'trips': trips, 'months': months, 'stations': stations, 'seed': seed}
+    marker = directory / "dataset.json"
+    if marker.exists() and json.loads(marker.read_text()) == spec:
+        return directory
+    if directory.exists():
+        shutil.rmtree(directory)
+    (directory / "raw").mkdir(parents=True)
+
+    print(f"Generating {trips:,} synthetic trips in {directory}...")
+    synthetic_neighborhoods(directory / "nta_boundaries.geojson")
+
+    rng = np.random.default_rng(seed)
+    west, south, east, north = SERVICE_AREA
+    ids = np.array([f"{code // 100}.{code % 100:02d}" for code in
+                    rng.choice(np.arange(200_000, 900_000), stations, replace=False)])
+    lat = rng.uniform(south, north, stations)
+    lng = rng.uniform(west, east, stations)
+    popularity = rng.zipf(1.3, stations).clip(max=200).astype(float)
+    popularity /= popularity.sum()
+    distance = np.hypot(lat[:, None] - lat[None, :], lng[:, None] - lng[None, :])
+    nearby = np.argsort(distance, axis=1)[:, :20]
+
+    per_month = np.diff(np.linspace(0, trips, months + 1).astype(int))
+    for month, count in enumerate(per_month):
+        month_start = pd.Timestamp(2025 + month // 12, month % 12 + 1, 1)
+        name = f"{month_start:%Y%m}-citibike-tripdata"
+        with zipfile.ZipFile(directory / "raw" / f"{name}.zip", 'w', zipfile.ZIP_DEFLATED) as archive:
+            sizes = [chunk_size] * (count // chunk_size) + ([count % chunk_size] if count % chunk_size else [])
+            for part, size in enumerate(sizes, start=1):
+                chunk = synthetic_trips(rng, month_start, size, (ids, lat, lng, popularity, nearby))
+                with archive.open(f"{name}_{part}.csv", 'w') as member:
+                    member.write(chunk.to_csv(index=False).encode())
+
+    marker.write_text(json.dumps(spec))
+    return directory
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def measure_stage(stages, name, fn, *args):
+    """Run fn(*args), appending its wall time and memory use to stages.
+
+    peakRssMb is the process high-water mark during the stage where the kernel
+    lets us reset it (Linux), otherwise the high-water mark of the whole run.
+    """
+    per_stage = process_data.reset_peak_rss()
+    rss_before = process_data.current_rss_mb()
+    result, seconds = timed(fn, *args)
+    rss_after = process_data.current_rss_mb()
+
+    stage = {'stage': name, 'seconds': round(seconds, 4), 'peakRssMb': round(process_data.peak_rss_mb(), 1),
+             'peakRssPerStage': per_stage}
+    if rss_before is not None:
+        stage['rssDeltaMb'] = round(rss_after - rss_before, 1)
+    stages.append(stage)
+    return result
+
+# ---------------------------------------------------------------------------
+# Stages
+# ---------------------------------------------------------------------------
+
+def _aggregate_trips(trips):
+    aggregates = process_data.TripAggregates()
+    aggregates.add_trips(trips)
+    return aggregates
+
+def _use_dataset(data_dir):
+    process_data.RAW_DIR = data_dir / "raw"
+    process_data.NTA_FILE = data_dir / "nta_boundaries.geojson"
+
+@contextmanager
+def dataset_cache(data_dir):
+    """Point process_data's cache at data_dir/cache while engines run.
+
+    The store engine replaces sibling stores and DuckDB rebuilds its work
+    directory, so a benchmark must never run them against the real
+    pipeline cache.
+    """
+    cache_dir = process_data.CACHE_DIR
+    process_data.CACHE_DIR = data_dir / "cache"
+    try:
+        yield process_data.CACHE_DIR
+    finally:
+        process_data.CACHE_DIR = cache_dir
+
+def benchmark_pipeline(data_dir):
+    """Run the default (in-memory) pipeline on data_dir stage by stage."""
+    _use_dataset(data_dir)
+    station_cache = data_dir / "station-nta.json"
+    station_cache.unlink(missing_ok=True)  # always measure a cold mapping
+
+    stages = []
+    trips = measure_stage(stages, 'load_and_process_trips',
+                          process_data.load_and_process_trips, process_data.AGGREGATE_COLUMNS)
+    trip_count = len(trips)
+    trips = measure_stage(stages, 'parse_datetime', process_data.parse_datetime, trips)
+    aggregates = measure_stage(stages, 'aggregate_trips', _aggregate_trips, trips)
+    del trips
+
+    nta = measure_stage(stages, 'load_neighborhoods', process_data.load_neighborhoods)
+    station_mapping = measure_stage(stages, 'create_station_to_nta_mapping',
+                                    process_data.create_station_to_nta_mapping,
+                                    aggregates.stations(), nta, station_cache)
+    centroids = process_data.calculate_centroids(nta)
+    patterns, flow_cube = measure_stage(stages, 'aggregate_by_neighborhood',
+                                        process_data.aggregate_by_neighborhood, aggregates, station_mapping)
+
+    measure_stage(stages, 'generate_weekly_patterns', process_data.generate_weekly_patterns, patterns)
+    measure_stage(stages, 'generate_flows', process_data.generate_flows, flow_cube, centroids)
+    measure_stage(stages, 'generate_neighborhoods_geojson',
+                  process_data.generate_neighborhoods_geojson, nta, patterns)
+    measure_stage(stages, 'generate_story_moments', process_data.generate_story_moments, flow_cube, aggregates)
+    station_patterns = measure_stage(stages, 'aggregate_by_station', process_data.aggregate_by_station, aggregates)
+    measure_stage(stages, 'generate_station_imbalance', process_data.generate_station_imbalance,
+                  station_patterns, aggregates.stations(), station_mapping)
+
+    return {
+        'trips': trip_count,
+        'stations': len(station_mapping),
+        'totalSeconds': round(sum(stage['seconds'] for stage in stages), 4),
+        'stages': stages,
+    }
+
+def pipeline_outputs(aggregates, nta, station_cache):
+    """Every JSON output the pipeline writes, serialized, from one set of aggregates."""
+    station_mapping = process_data.create_station_to_nta_mapping(aggregates.stations(), nta, station_cache)
+    patterns, flow_cube = process_data.aggregate_by_neighborhood(aggregates, station_mapping)
+    outputs = {
+        'weekly-patterns': process_data.generate_weekly_patterns(patterns),
+        'neighborhoods': process_data.generate_neighborhoods_geojson(nta, patterns),
+        'flows': process_data.generate_flows(flow_cube, process_data.calculate_centroids(nta)),
+        'story-moments': process_data.generate_story_moments(flow_cube, aggregates),
+        'station-imbalance': process_data.generate_station_imbalance(
+            process_data.aggregate_by_station(aggregates), aggregates.stations(), station_mapping),
+        'trip-distributions': process_data.generate_trip_distributions(aggregates, station_mapping),
+        'metadata': process_data.generate_metadata(aggregates),
+    }
+    return {name: json.dumps(output) for name, output in outputs.items()}
+
+def benchmark_engines(data_dir, engines):
+    """Aggregate data_dir with each engine and check that all outputs match the first."""
+    _use_dataset(data_dir)
+    args = argparse.Namespace(stream=False, workers=1, incremental=False,
+                              chunk_size=process_data.DEFAULT_CHUNK_SIZE)
+    nta = process_data.load_neighborhoods()
+
+    stages = []
+    outputs = {}
+    with dataset_cache(data_dir):
+        for engine in engines:
+            aggregates = measure_stage(stages, f"{engine}_trip_aggregates",
+                                       process_data.ENGINES[engine](args).trip_aggregates,
+                                       process_data.RunReport())
+            outputs[engine] = pipeline_outputs(aggregates, nta, data_dir / "station-nta.json")
+
+    reference = outputs[engines[0]]
+    mismatches = [f"{engine}/{name}" for engine in engines[1:]
+                  for name, output in outputs[engine].items() if output != reference[name]]
+    return {'stages': stages, 'parity': not mismatches, 'mismatches': mismatches}
+
+def print_stages(result):
+    print(f"\nPipeline ({result['trips']:,} trips, {result['stations']:,} stations)")
+    for stage in result['stages']:
+        print(f"  {stage['stage']:32s} {stage['seconds']:8.2f}s  {stage['peakRssMb']:8.0f} MB peak")
+    print(f"  {'total':32s} {result['totalSeconds']:8.2f}s")
+
+# ---------------------------------------------------------------------------
+# Regression check
+# ---------------------------------------------------------------------------
+
+def compare_results(baseline, current, threshold, min_seconds=0.05):
+    """Print per-stage time and memory ratios against a baseline results file.
+
+    Returns the stages that got slower or bigger than threshold (a ratio).
+    Stages faster than min_seconds in both runs are too noisy to judge on time.
+    """
+    regressions = []
+    baseline_runs = {run['dataset']['trips']: run for run in baseline['runs']}
+    for run in current['runs']:
+        before_run = baseline_runs.get(run['dataset']['trips'])
+        if before_run is None:
+            print(f"\nNo baseline for {run['dataset']['trips']:,} trips")
+            continue
+
+        print(f"\nCompared with baseline ({run['dataset']['trips']:,} trips)")
+        before_stages = {stage['stage']: stage for stage in before_run['pipeline']['stages']}
+        for stage in run['pipeline']['stages']:
+            before = before_stages.get(stage['stage'])
+            if before is None:
+                continue
+            time_ratio = stage['seconds'] / max(before['seconds'], 1e-9)
+            memory_ratio = stage['peakRssMb'] / max(before['peakRssMb'], 1e-9)
+            slower = time_ratio > threshold and max(stage['seconds'], before['seconds']) >= min_seconds
+            bigger = memory_ratio > threshold and stage['peakRssPerStage'] and before['peakRssPerStage']
+            flag = "  REGRESSION" if slower or bigger else ""
+            print(f"  {stage['stage']:32s} time {time_ratio:5.2f}x  memory {memory_ratio:5.2f}x{flag}")
+            if flag:
+                regressions.append((run['dataset']['trips'], stage['stage']))
+    return regressions
+
+# ---------------------------------------------------------------------------
+# parse_datetime micro-benchmark
+# ---------------------------------------------------------------------------
+
+def synthetic_timestamps(n, seed=0):
+    """Citi Bike style "YYYY-MM-DD HH:MM:SS.fff" strings spread over a year."""
+    rng = np.random.default_rng(seed)
+    offsets = pd.to_timedelta(rng.integers(0, 365 * 86400 * 1000, n), unit='ms')
+    return pd.Series((pd.Timestamp('2025-01-01') + offsets).strftime('%Y-%m-%d %H:%M:%S.%f').str[:-3])
+
+def pandas_parse_datetime(trips):
+    """The original parse_datetime: infer formats and build full datetime columns."""
+    trips['started_at'] = pd.to_datetime(trips['started_at'])
+    trips['ended_at'] = pd.to_datetime(trips['ended_at'])
+    trips['day_of_week'] = trips['started_at'].dt.dayofweek
+    trips['hour'] = trips['started_at'].dt.hour
+    return trips
+
+def benchmark_timestamps(n):
+    print(f"parse_datetime ({n:,} trips)")
+    started_at = synthetic_timestamps(n)
+    trips = pd.DataFrame({'started_at': started_at, 'ended_at': started_at})
+
+    slow_trips, slow = timed(pandas_parse_datetime, trips.copy())
+    fast_trips, fast = timed(process_data.parse_datetime, trips.copy())
+
+    assert (slow_trips['day_of_week'].to_numpy() == fast_trips['day_of_week'].to_numpy()).all()
+    assert (slow_trips['hour'].to_numpy() == fast_trips['hour'].to_numpy()).all()
+    print(f"  pd.to_datetime + .dt:   {slow:7.2f}s")
+    print(f"  parse_datetime:         {fast:7.2f}s  ({slow / fast:.1f}x faster)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark NYC Bike Rhythms pipeline stages.")
+    parser.add_argument('--trips', type=int, nargs='+', default=[1_000_000],
+                        help="synthetic dataset sizes to benchmark, e.g. 1000000 10000000 50000000")
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--stations', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', type=Path, default=BENCHMARK_DIR,
+                        help="where synthetic datasets are generated and reused")
+    parser.add_argument('--output', type=Path, default=BENCHMARK_DIR / "results.json")
+    parser.add_argument('--compare', type=Path, help="baseline results JSON to check for regressions")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="ratio to baseline above which a stage counts as a regression")
+    parser.add_argument('--engines', nargs='+', choices=sorted(process_data.ENGINES),
+                        help="also aggregate with each engine and check their outputs are identical")
+    parser.add_argument('--timestamps', type=int, metavar='N',
+                        help="only run the parse_datetime micro-benchmark on N timestamps")
+    args = parser.parse_args()
+
+    if args.timestamps:
+        benchmark_timestamps(args.timestamps)
+        return
+
+    results = {
+        'version': RESULTS_VERSION,
+        'generatedAt': datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        'runs': [],
+    }
+    for trips in args.trips:
+        data_dir = synthetic_dataset(args.data_dir / f"trips-{trips}", trips,
+                                     args.months, args.stations, args.seed)
+        result = benchmark_pipeline(data_dir)
+        print_stages(result)
+        run = {
+            'dataset': {'trips': trips, 'months': args.months, 'stations': args.stations, 'seed': args.seed},
+            'pipeline': result,
+        }
+        if args.engines:
+            run['engines'] = benchmark_engines(data_dir, args.engines)
+            print(f"\nEngines ({trips:,} trips)")
+            for stage in run['engines']['stages']:
+                print(f"  {stage['stage']:32s} {stage['seconds']:8.2f}s  {stage['peakRssMb']:8.0f} MB peak")
+            print(f"  parity: {'identical outputs' if run['engines']['parity'] else 'MISMATCH'}")
+        results['runs'].append(run)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved to {args.output}")
+
+    mismatches = [mismatch for run in results['runs'] for mismatch in run.get('engines', {}).get('mismatches', [])]
+    if mismatches:
+        print(f"\nEngine outputs differ: {', '.join(mismatches)}")
+        sys.exit(1)
+
+    if args.compare:
+        regressions = compare_results(json.loads(args.compare.read_text()), results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed by more than {args.threshold:.2f}x")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
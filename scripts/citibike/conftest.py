@@ -0,0 +1,29 @@
+"""
+Shared fixtures for the pipeline tests.
+
+The tests run process_data.py against a small synthetic dataset from
+benchmark.py, with the cache and outputs in a temporary directory:
+
+    cd scripts/citibike && python -m pytest -q
+"""
+
+import pytest
+
+import benchmark
+import process_data
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    """Two months of synthetic trip zips, several CSVs each, and NTA boundaries."""
+    return benchmark.synthetic_dataset(tmp_path_factory.mktemp("dataset"), trips=30_000, months=2,
+                                       stations=300, chunk_size=10_000)
+
+@pytest.fixture
+def pipeline(dataset, tmp_path, monkeypatch):
+    """process_data pointed at the dataset, with a fresh cache and output directory."""
+    monkeypatch.setattr(process_data, 'RAW_DIR', dataset / "raw")
+    monkeypatch.setattr(process_data, 'NTA_FILE', dataset / "nta_boundaries.geojson")
+    monkeypatch.setattr(process_data, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.setattr(process_data, 'OUTPUT_DIR', tmp_path / "output")
+    monkeypatch.setattr(process_data, 'PUBLIC_DIR', tmp_path / "public")
+    return process_data
@@ -0,0 +1,123 @@
+"""
+Sparse neighborhood origin x destination x day x hour trip counts.
+
+process_data.py builds a FlowCube once from the aggregated trips and keeps it
+in its stage cache; analyses can load it directly instead of re-reading the
+raw trips:
+
+    from flow_cube import FlowCube
+    cube = FlowCube.load('cache/stages/flow_cube-<key>')
+    counts = cube.query(hours=[7, 8, 9], days=range(5), from_prefixes=['BK'], to_prefixes=['MN'])
+    # counts[i, j]: trips from cube.ntacodes[i] to cube.ntacodes[j]
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+SLOTS = 7 * 24  # one slot per day of week (0=Monday) and hour
+OUTSIDE = -1    # neighborhood code of a station outside every neighborhood
+
+class FlowCube:
+    """Trip counts for every (origin, destination, day, hour) seen at least once.
+
+    Entries are parallel columns sorted by slot (day * 24 + hour), then origin
+    and destination, so a query only reads the slots it asks for. Origins and
+    destinations index into ntacodes; OUTSIDE marks trips that start or end
+    outside every neighborhood, which count towards departures and arrivals
+    but never towards a flow.
+    """
+
+    COLUMNS = {'slot': np.int16, 'start': np.int16, 'end': np.int16, 'count': np.int64}
+
+    def __init__(self, ntacodes, slot, start, end, count):
+        self.ntacodes = list(ntacodes)
+        self.slot = slot
+        self.start = start
+        self.end = end
+        self.count = count
+        # offsets[s]:offsets[s + 1] is the row range of slot s
+        self.offsets = np.searchsorted(slot, np.arange(SLOTS + 1))
+
+    @classmethod
+    def from_codes(cls, start, end, day, hour, count, ntacodes):
+        """Sum counts over repeated (origin, destination, day, hour) rows.
+
+        start/end index into ntacodes, with OUTSIDE for unmapped stations.
+        """
+        n = len(ntacodes) + 1  # shifted by one so OUTSIDE becomes 0
+        keys = ((day.astype(np.int64) * 24 + hour) * n + start + 1) * n + end + 1
+        keys, inverse = np.unique(keys, return_inverse=True)
+        totals = np.bincount(inverse, weights=count, minlength=len(keys)).astype(np.int64)
+
+        pair, slot = keys % (n * n), keys // (n * n)
+        return cls(ntacodes, slot.astype(np.int16), (pair // n - 1).astype(np.int16),
+                   (pair % n - 1).astype(np.int16), totals)
+
+    def __len__(self):
+        return len(self.count)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.COLUMNS)
+
+    def save(self, directory):
+        """Write one .npy file per column plus the neighborhood codes."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for column in self.COLUMNS:
+            np.save(directory / f"{column}.npy", getattr(self, column))
+        (directory / "ntacodes.json").write_text(json.dumps(self.ntacodes))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Read a cube written by save(), memory-mapping its columns by default."""
+        directory = Path(directory)
+        columns = [np.load(directory / f"{column}.npy", mmap_mode=mmap_mode) for column in cls.COLUMNS]
+        return cls(json.loads((directory / "ntacodes.json").read_text()), *columns)
+
+    def _rows(self, hours, days):
+        """Row indices of the requested days and hours (all when None)."""
+        days = range(7) if days is None else days
+        hours = range(24) if hours is None else hours
+        slots = sorted({day * 24 + hour for day in days for hour in hours})
+        return np.concatenate([np.arange(self.offsets[s], self.offsets[s + 1]) for s in slots] or
+                              [np.empty(0, dtype=np.int64)])
+
+    def _prefix_mask(self, prefixes):
+        """Neighborhoods whose code starts with any of the prefixes."""
+        return np.array([ntacode.startswith(tuple(prefixes)) for ntacode in self.ntacodes], dtype=bool)
+
+    def query(self, hours=None, days=None, from_prefixes=None, to_prefixes=None):
+        """Trips between neighborhoods as a dense len(ntacodes) x len(ntacodes) array.
+
+        hours and days (0=Monday) select the slots to sum; from_prefixes and
+        to_prefixes, when given, keep only origins and destinations whose NTA
+        code starts with one of them. Trips within a neighborhood stay on the
+        diagonal.
+        """
+        rows = self._rows(hours, days)
+        start, end = self.start[rows].astype(np.int64), self.end[rows].astype(np.int64)
+
+        keep = (start != OUTSIDE) & (end != OUTSIDE)
+        if from_prefixes:
+            keep &= self._prefix_mask(from_prefixes)[start]
+        if to_prefixes:
+            keep &= self._prefix_mask(to_prefixes)[end]
+
+        n = len(self.ntacodes)
+        counts = np.bincount(start[keep] * n + end[keep], weights=self.count[rows][keep], minlength=n * n)
+        return counts.astype(np.int64).reshape(n, n)
+
+    def totals(self, hours=None, days=None):
+        """Departures and arrivals per neighborhood, including trips to or from outside."""
+        rows = self._rows(hours, days)
+        count = self.count[rows]
+        n = len(self.ntacodes)
+
+        def tally(nta):
+            mapped = nta != OUTSIDE
+            return np.bincount(nta[mapped], weights=count[mapped], minlength=n).astype(np.int64)
+
+        return tally(self.start[rows]), tally(self.end[rows])
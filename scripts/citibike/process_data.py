@@ -5,65 +5,1401 @@ Processes Citi Bike trip data to generate JSON files for visualization.
 
 Requirements:
     pip install pandas geopandas shapely
+    pip install pyarrow  # for --cache, --sample and multi-threaded CSV decoding
+    pip install brotli   # optional, for .br copies of the larger outputs
+    pip install duckdb   # for --engine duckdb
 
 Usage:
     python process_data.py
+    python process_data.py --stream [--chunk-size 500000]
+    python process_data.py --workers 8
+    python process_data.py --cache
+    python process_data.py --incremental [--workers 4]
+    python process_data.py --engine duckdb [--cache]
+    python process_data.py --engine store [--workers 4]
+    python process_data.py --profile
+    python process_data.py --only story-moments [--force]
+    python process_data.py --sample 0.05 [--seed 1]   # quick preview in cache/preview/, implies --cache
+
+Every run writes run-report.json (time, CPU, memory and row counts per stage)
+next to the outputs, and manifest.json, which maps each output to its file
+and hash. Files the site fetches are content-addressed and only rewritten
+when their contents change; full runs copy them, with manifest.json, to
+public/data/citibike. The neighborhood flow cube that flows and story moments
+are queried from is kept in cache/stages/flow_cube-<key>/ and can be loaded
+on its own with flow_cube.FlowCube.load(). Trip duration and speed
+percentiles in trip-distributions.json come from mergeable quantile sketches
+(quantile_sketch.py), so they never need every trip in memory at once.
 """
 
 import os
+import re
+import sys
 import json
+import gzip
+import time
+import pickle
+import pstats
+import inspect
+import cProfile
+import argparse
+import shutil
+import hashlib
+import resource
 import zipfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 import warnings
 warnings.filterwarnings('ignore')
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import geopandas as gpd
-from shapely.geometry import Point
+import shapely
+import shapely.geometry
+
+from flow_cube import FlowCube
+from trip_store import TripStore, TripStoreWriter
+from quantile_sketch import QuantileSketches
 
 # Paths
 SCRIPT_DIR = Path(__file__).parent
 RAW_DIR = SCRIPT_DIR / "raw"
 OUTPUT_DIR = SCRIPT_DIR.parent.parent / "data" / "citibike"
+# The site serves the files it fetches at runtime from here (see publish_outputs)
+PUBLIC_DIR = SCRIPT_DIR.parent.parent / "public" / "data" / "citibike"
 NTA_FILE = SCRIPT_DIR / "nta_boundaries.geojson"
 
-def load_and_process_trips():
-    """Load all trip data from zip files."""
+CACHE_DIR = SCRIPT_DIR / "cache"
+
+# Columns read from the monthly CSVs. Station IDs are read as strings so that
+# IDs like "5329.03" don't get type-inferred differently from chunk to chunk.
+TRIP_COLUMNS = [
+    'started_at', 'ended_at',
+    'start_station_name', 'start_station_id',
+    'start_lat', 'start_lng',
+    'end_station_name', 'end_station_id',
+    'end_lat', 'end_lng',
+    'member_casual'
+]
+TRIP_DTYPES = {'start_station_id': str, 'end_station_id': str}
+
+# Columns needed to build TripAggregates
+AGGREGATE_COLUMNS = [
+    'started_at', 'ended_at',
+    'start_station_id', 'start_lat', 'start_lng',
+    'end_station_id', 'end_lat', 'end_lng',
+    'member_casual'
+]
+
+# Leaner dtypes for the columns TripAggregates reads: categorical station IDs
+# and rider type (a small integer code per trip instead of a Python string),
+# and Arrow strings for the timestamps, which are decoded in place.
+# Coordinates stay float64: station locations are matched at 6 decimals,
+# which float32 can't hold.
+COMPACT_TRIP_DTYPES = {
+    'started_at': 'string[pyarrow]',
+    'ended_at': 'string[pyarrow]',
+    'start_station_id': 'category',
+    'end_station_id': 'category',
+    'member_casual': 'category',
+}
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+def trip_dtypes(columns, compact=False):
+    """read_csv dtypes for the given columns, optionally the compact ones."""
+    dtypes = {col: dtype for col, dtype in TRIP_DTYPES.items() if col in columns}
+    if compact:
+        try:
+            import pyarrow  # noqa: F401
+            compact_dtypes = COMPACT_TRIP_DTYPES
+        except ImportError:
+            compact_dtypes = {col: dtype for col, dtype in COMPACT_TRIP_DTYPES.items()
+                              if not dtype.endswith('[pyarrow]')}
+        dtypes.update({col: dtype for col, dtype in compact_dtypes.items() if col in columns})
+    return dtypes
+
+def _categorical_columns(columns):
+    return [col for col in columns if COMPACT_TRIP_DTYPES.get(col) == 'category']
+
+def concat_trips(frames):
+    """Concatenate trip frames, keeping categorical columns categorical.
+
+    Each file or chunk gets its own categories; they are unified first so
+    pandas doesn't fall back to object columns. Empty frames (header-only
+    CSVs) are dropped, since their categories have no string dtype to unify.
+    """
+    frames = list(frames)
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    for col in _categorical_columns(frames[0].columns) if frames else []:
+        if all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = union_categoricals([frame[col] for frame in frames]).categories
+            for frame in frames:
+                frame[col] = frame[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+def zip_csv_members(zip_path):
+    """List the CSV files inside a trip data zip."""
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        return [f for f in z.namelist() if f.endswith('.csv')]
+
+def _arrow_convert_options(columns, compact=False):
+    """pyarrow.csv options that give the trip columns explicit types.
+
+    Coordinates are float64 and everything else is read as strings, so no
+    column is type-inferred. With compact=True the categorical columns of
+    COMPACT_TRIP_DTYPES are dictionary-encoded instead.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    types = {col: pa.float64() if col.endswith(('_lat', '_lng')) else pa.string() for col in columns}
+    if compact:
+        types.update({col: pa.dictionary(pa.int32(), pa.string()) for col in _categorical_columns(columns)})
+    return pv.ConvertOptions(include_columns=list(columns), column_types=types, strings_can_be_null=True)
+
+# Bytes of CSV text pyarrow parses per block when streaming a zip member
+CSV_BLOCK_SIZE = 8 << 20
+
+def _read_zip_member(zip_path, csv_file):
+    """Decompress one CSV into memory (zlib releases the GIL while it runs)."""
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        return z.read(csv_file)
+
+def iter_zip_tables(zip_path, columns=TRIP_COLUMNS, csv_files=None, compact=False):
+    """Yield an Arrow table per CSV in a zip, decoded by pyarrow's multi-threaded reader.
+
+    The next CSV is decompressed on a background thread while the current
+    one is parsed and handed to the caller, so at most two decompressed
+    files are held at once.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    csv_files = zip_csv_members(zip_path) if csv_files is None else list(csv_files)
+    convert = _arrow_convert_options(columns, compact)
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        pending = prefetch.submit(_read_zip_member, zip_path, csv_files[0]) if csv_files else None
+        for next_file in csv_files[1:] + [None]:
+            data = pending.result()
+            if next_file is not None:
+                pending = prefetch.submit(_read_zip_member, zip_path, next_file)
+            yield pv.read_csv(pa.py_buffer(data), convert_options=convert)
+            del data
+
+def iter_zip_batches(zip_path, columns=TRIP_COLUMNS, csv_files=None, compact=False):
+    """Stream Arrow record batches from every CSV in a zip, one block at a time.
+
+    pyarrow's streaming reader reads (and so decompresses) the next block on
+    its I/O thread while the current one is converted, and only a few blocks
+    are held at once however large the file is.
+    """
+    import pyarrow.csv as pv
+
+    csv_files = zip_csv_members(zip_path) if csv_files is None else csv_files
+    convert = _arrow_convert_options(columns, compact)
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        for csv_file in csv_files:
+            with z.open(csv_file) as f:
+                yield from pv.open_csv(f, read_options=pv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                                       convert_options=convert)
+
+def _arrow_to_trips(table, compact=False):
+    """Convert Arrow trip data to pandas; compact keeps strings Arrow-backed."""
+    import pyarrow as pa
+
+    if compact:
+        return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+    return table.to_pandas()
+
+def iter_zip_trips(zip_path, columns=TRIP_COLUMNS, chunksize=None, csv_files=None, compact=False):
+    """Yield trip DataFrames for every CSV in a zip, one per file or per chunk.
+
+    Uses pyarrow.csv when pyarrow is installed and pd.read_csv otherwise.
+    Chunks are gathered from whole CSV blocks, so they can run slightly
+    over chunksize rows.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        yield from _pandas_zip_trips(zip_path, columns, chunksize, csv_files, compact)
+        return
+
+    if chunksize is None:
+        for table in iter_zip_tables(zip_path, columns, csv_files, compact):
+            yield _arrow_to_trips(table, compact)
+        return
+
+    batches, rows = [], 0
+    for batch in iter_zip_batches(zip_path, columns, csv_files, compact):
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= chunksize:
+            yield _arrow_to_trips(pa.Table.from_batches(batches), compact)
+            batches, rows = [], 0
+    if batches:
+        yield _arrow_to_trips(pa.Table.from_batches(batches), compact)
+
+def _pandas_zip_trips(zip_path, columns, chunksize, csv_files, compact):
+    """Single-threaded pd.read_csv fallback for iter_zip_trips."""
+    dtypes = trip_dtypes(columns, compact)
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        if csv_files is None:
+            csv_files = [f for f in z.namelist() if f.endswith('.csv')]
+        for csv_file in csv_files:
+            with z.open(csv_file) as f:
+                if chunksize is None:
+                    yield pd.read_csv(f, usecols=columns, dtype=dtypes)
+                else:
+                    yield from pd.read_csv(f, usecols=columns, dtype=dtypes, chunksize=chunksize)
+
+def load_and_process_trips(columns=TRIP_COLUMNS, partitions=None):
+    """Load all trip data from zip files, or from cached Parquet partitions."""
     print("Loading trip data...")
 
     all_trips = []
-    zip_files = sorted(RAW_DIR.glob("*.zip"))
-
-    for zip_path in zip_files:
-        print(f"  Processing {zip_path.name}...")
-        with zipfile.ZipFile(zip_path, 'r') as z:
-            csv_files = [f for f in z.namelist() if f.endswith('.csv')]
-            for csv_file in csv_files:
-                with z.open(csv_file) as f:
-                    df = pd.read_csv(f, usecols=[
-                        'started_at', 'ended_at',
-                        'start_station_name', 'start_station_id',
-                        'start_lat', 'start_lng',
-                        'end_station_name', 'end_station_id',
-                        'end_lat', 'end_lng',
-                        'member_casual'
-                    ])
-                    all_trips.append(df)
-
-    trips = pd.concat(all_trips, ignore_index=True)
+    if partitions is not None:
+        for partition in partitions:
+            print(f"  Reading {partition.name}...")
+            all_trips.append(read_trip_partition(partition, columns))
+    else:
+        for zip_path in sorted(RAW_DIR.glob("*.zip")):
+            print(f"  Processing {zip_path.name}...")
+            all_trips.extend(iter_zip_trips(zip_path, columns, compact=True))
+
+    trips = concat_trips(all_trips)
     print(f"  Total trips loaded: {len(trips):,}")
     return trips
 
+def read_trip_partition(partition, columns=TRIP_COLUMNS):
+    """Read a cached Parquet partition with compact (categorical) string columns."""
+    import pyarrow.parquet as pq
+
+    return pq.read_table(partition, columns=columns).to_pandas(categories=_categorical_columns(columns))
+
+def iter_trip_chunks(chunksize=DEFAULT_CHUNK_SIZE, columns=TRIP_COLUMNS, partitions=None):
+    """Yield trip data one chunk at a time, from the zip files or cached partitions."""
+    if partitions is not None:
+        import pyarrow.parquet as pq
+
+        for partition in partitions:
+            print(f"  Streaming {partition.name}...")
+            for batch in pq.ParquetFile(partition).iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas(categories=_categorical_columns(columns))
+        return
+
+    for zip_path in sorted(RAW_DIR.glob("*.zip")):
+        print(f"  Streaming {zip_path.name}...")
+        yield from iter_zip_trips(zip_path, columns, chunksize, compact=True)
+
+def file_sha256(path):
+    """Hash a file in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def zip_digest(zip_path, manifest_entry=None):
+    """Return a zip's SHA-256, reusing the manifest's hash while size and mtime match."""
+    stat = zip_path.stat()
+    if (manifest_entry and manifest_entry['size'] == stat.st_size
+            and manifest_entry['mtime_ns'] == stat.st_mtime_ns):
+        return manifest_entry['sha256']
+    return file_sha256(zip_path)
+
+def _manifest_entry(zip_path, digest, partition):
+    stat = zip_path.stat()
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': digest,
+        'partition': partition.name
+    }
+
+def _remove_stale_partitions(directory, zip_path, partition):
+    """Delete older partitions built from a previous version of zip_path.
+
+    Partitions are named {zip stem}-{hash}, optionally followed by -v{version}.
+    """
+    name = re.compile(rf"{re.escape(zip_path.stem)}-[0-9a-f]{{16}}(-v\d+)?")
+    for stale in directory.glob(f"{zip_path.stem}-*{partition.suffix}"):
+        if stale != partition and name.fullmatch(stale.stem):
+            stale.unlink()
+
+def _trip_cache_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('started_at', pa.timestamp('us')),
+        ('ended_at', pa.timestamp('us')),
+        ('start_station_name', pa.string()),
+        ('start_station_id', pa.string()),
+        ('start_lat', pa.float64()),
+        ('start_lng', pa.float64()),
+        ('end_station_name', pa.string()),
+        ('end_station_id', pa.string()),
+        ('end_lat', pa.float64()),
+        ('end_lng', pa.float64()),
+        ('member_casual', pa.string()),
+    ])
+
+def _write_trip_partition(zip_path, partition):
+    """Decode one zip into a typed Parquet file, a chunk at a time."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _trip_cache_schema()
+    tmp_path = partition.with_suffix('.tmp')
+    with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+        for chunk in iter_zip_trips(zip_path, TRIP_COLUMNS, DEFAULT_CHUNK_SIZE):
+            chunk['started_at'] = pd.to_datetime(chunk['started_at'], format='ISO8601')
+            chunk['ended_at'] = pd.to_datetime(chunk['ended_at'], format='ISO8601')
+            writer.write_table(pa.Table.from_pandas(chunk[TRIP_COLUMNS], schema=schema,
+                                                    preserve_index=False))
+    tmp_path.replace(partition)
+
+def build_trip_cache():
+    """Convert new or changed zips into one Parquet partition per month.
+
+    Partitions are named after the zip and its content hash, so a zip is only
+    decoded again when its contents change. Hashes are reused from the cache
+    manifest while a zip's size and mtime are unchanged. Returns the partition
+    paths in the same order as the zips.
+    """
+    print("Updating columnar trip cache...")
+    trip_cache = CACHE_DIR / "trips"
+    trip_cache.mkdir(parents=True, exist_ok=True)
+    manifest_path = trip_cache / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    partitions = []
+    updated = {}
+    for zip_path in sorted(RAW_DIR.glob("*.zip")):
+        digest = zip_digest(zip_path, manifest.get(zip_path.name))
+        partition = trip_cache / f"{zip_path.stem}-{digest[:16]}.parquet"
+        if partition.exists():
+            print(f"  Cached {zip_path.name}")
+        else:
+            print(f"  Converting {zip_path.name}...")
+            _write_trip_partition(zip_path, partition)
+            _remove_stale_partitions(trip_cache, zip_path, partition)
+
+        updated[zip_path.name] = _manifest_entry(zip_path, digest, partition)
+        partitions.append(partition)
+
+    manifest_path.write_text(json.dumps(updated, indent=2))
+    return partitions
+
+# Citi Bike timestamps look like "2025-01-31 17:04:12.345". Day of week and
+# hour only need the "YYYY-MM-DD HH" prefix; durations read to the second.
+TIMESTAMP_PREFIX_LEN = 13
+TIMESTAMP_SEPARATORS = {4: b'-', 7: b'-', 10: b' '}
+TIMESTAMP_SECONDS_LEN = 19
+TIMESTAMP_SECONDS_SEPARATORS = {**TIMESTAMP_SEPARATORS, 13: b':', 16: b':'}
+
+def _timestamp_prefix_bytes(timestamps, length=TIMESTAMP_PREFIX_LEN):
+    """Return an (n, length) uint8 matrix of each timestamp's first length bytes.
+
+    Arrow-backed string columns are sliced without creating Python strings;
+    anything else is converted through NumPy fixed-width bytes. Returns None
+    if some value is missing or too short.
+    """
+    n = len(timestamps)
+    if getattr(timestamps.dtype, 'storage', None) == 'pyarrow':
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        prefixes = pc.utf8_slice_codeunits(pa.array(timestamps), 0, length)
+        if isinstance(prefixes, pa.ChunkedArray):
+            prefixes = prefixes.combine_chunks()
+        if n == 0 or prefixes.null_count or pc.min(pc.utf8_length(prefixes)).as_py() != length:
+            return None
+        _, offsets, data = prefixes.buffers()
+        offset_type = np.int64 if pa.types.is_large_string(prefixes.type) else np.int32
+        first = int(np.frombuffer(offsets, dtype=offset_type)[prefixes.offset])
+        chars = np.frombuffer(data, dtype=np.uint8, count=n * length, offset=first)
+        return chars.reshape(n, length)
+
+    try:
+        prefixes = timestamps.to_numpy(dtype=f'S{length}')
+    except (TypeError, ValueError, UnicodeEncodeError):
+        return None
+    return prefixes.view(np.uint8).reshape(n, length)
+
+def _two_digits(chars, pos):
+    return (chars[:, pos] - 48) * 10 + (chars[:, pos + 1] - 48)
+
+def _timestamp_fields(timestamps, length, separators):
+    """Decode (year, month, day, hour[, minute, second]) from fixed-layout timestamp strings.
+
+    Returns None if some value is missing, too short, or has a separator,
+    digit or field out of place.
+    """
+    chars = _timestamp_prefix_bytes(timestamps, length)
+    if chars is None:
+        return None
+    for pos, sep in separators.items():
+        if not (chars[:, pos] == ord(sep)).all():
+            return None
+    digits = np.delete(chars, list(separators), axis=1)
+    if ((digits < ord('0')) | (digits > ord('9'))).any():
+        return None
+
+    chars = chars.astype(np.int16)
+    year = _two_digits(chars, 0) * 100 + _two_digits(chars, 2)
+    fields = [year] + [_two_digits(chars, pos) for pos in range(5, length, 3)]
+    month, day, hour = fields[1:4]
+    if ((month < 1) | (month > 12) | (day < 1) | (day > 31) | (hour > 23)).any():
+        return None
+    if any((field > 59).any() for field in fields[4:]):
+        return None
+    return fields
+
+def _epoch_days(year, month, day):
+    """Days since 1970-01-01, via a table of the first day of each month in range."""
+    month_index = (year.astype(np.int64) - 1970) * 12 + month - 1
+    first_month = month_index.min()
+    months = np.arange(first_month, month_index.max() + 1).astype('datetime64[M]')
+    return months.astype('datetime64[D]').astype(np.int64)[month_index - first_month] + day - 1
+
+def decode_day_and_hour(timestamps):
+    """Compute day of week (0=Monday) and hour straight from timestamp strings.
+
+    Skips building datetime columns entirely. Returns None if any value doesn't
+    follow the fixed "YYYY-MM-DD HH..." layout, so the caller can fall back to
+    pd.to_datetime.
+    """
+    fields = _timestamp_fields(timestamps, TIMESTAMP_PREFIX_LEN, TIMESTAMP_SEPARATORS)
+    if fields is None:
+        return None
+    year, month, day, hour = fields
+    # 1970-01-01 was a Thursday
+    day_of_week = (_epoch_days(year, month, day) + 3) % 7
+    return day_of_week.astype(np.int8), hour.astype(np.int8)
+
+def timestamp_seconds(timestamps):
+    """Seconds since 1970 of each timestamp as floats, dropping fractions of a second.
+
+    Strings in the standard layout are decoded straight from their bytes;
+    anything else goes through pandas. Missing timestamps give NaN.
+    """
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        fields = _timestamp_fields(timestamps, TIMESTAMP_SECONDS_LEN, TIMESTAMP_SECONDS_SEPARATORS)
+        if fields is not None:
+            year, month, day, hour, minute, second = (field.astype(np.int64) for field in fields)
+            days = _epoch_days(year, month, day)
+            return (days * 86400 + hour * 3600 + minute * 60 + second).astype(np.float64)
+        timestamps = pd.to_datetime(timestamps, errors='coerce')
+
+    values = timestamps.to_numpy(dtype='datetime64[ns]').astype('datetime64[s]')
+    seconds = values.astype(np.int64).astype(np.float64)
+    seconds[np.isnat(values)] = np.nan
+    return seconds
+
+# Trip durations (seconds) and straight-line speeds (km/h) are kept as quantile
+# sketches per start station and hour. Durations outside DURATION_RANGE and
+# speeds outside SPEED_RANGE (clock glitches, bikes docked a day later, bad
+# coordinates) are left out, as are the speeds of trips that end within
+# MIN_SPEED_DISTANCE_KM of their start, mostly round trips to one station.
+DURATION_RANGE = (60, 24 * 3600)
+SPEED_RANGE = (1, 50)
+MIN_SPEED_DISTANCE_KM = 0.1
+SKETCH_ACCURACY = 0.02
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between coordinate arrays."""
+    radians = np.pi / 180
+    lat1, lng1, lat2, lng2 = (np.asarray(x, dtype=np.float64) * radians for x in (lat1, lng1, lat2, lng2))
+    half_dlat = np.sin((lat2 - lat1) / 2)
+    half_dlng = np.sin((lng2 - lng1) / 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(half_dlat * half_dlat + np.cos(lat1) * np.cos(lat2)
+                                                   * (half_dlng * half_dlng)))
+
+def trip_metrics(trips):
+    """Duration (seconds) and straight-line speed (km/h) of each trip, NaN where not kept."""
+    duration = timestamp_seconds(trips['ended_at']) - timestamp_seconds(trips['started_at'])
+    duration[(duration < DURATION_RANGE[0]) | (duration > DURATION_RANGE[1])] = np.nan
+
+    distance = haversine_km(trips['start_lat'], trips['start_lng'], trips['end_lat'], trips['end_lng'])
+    speed = distance / (duration / 3600)
+    speed[~(distance >= MIN_SPEED_DISTANCE_KM) | (speed < SPEED_RANGE[0]) | (speed > SPEED_RANGE[1])] = np.nan
+    return duration, speed
+
 def parse_datetime(trips):
-    """Parse datetime columns."""
+    """Add day_of_week and hour columns.
+
+    String timestamps in the standard Citi Bike layout are decoded directly
+    without building datetime columns; anything else (and already-parsed
+    timestamps from the Parquet cache) goes through pandas.
+    """
     print("Parsing datetime...")
+    if not pd.api.types.is_datetime64_any_dtype(trips['started_at']):
+        decoded = decode_day_and_hour(trips['started_at'])
+        if decoded is not None:
+            trips['day_of_week'], trips['hour'] = decoded
+            return trips
+
     trips['started_at'] = pd.to_datetime(trips['started_at'])
-    trips['ended_at'] = pd.to_datetime(trips['ended_at'])
-    trips['day_of_week'] = trips['started_at'].dt.dayofweek  # 0=Monday
-    trips['hour'] = trips['started_at'].dt.hour
+    if 'ended_at' in trips:
+        trips['ended_at'] = pd.to_datetime(trips['ended_at'])
+    trips['day_of_week'] = trips['started_at'].dt.dayofweek.astype(np.int8)  # 0=Monday
+    trips['hour'] = trips['started_at'].dt.hour.astype(np.int8)
     return trips
 
+# Bit layout of the packed origin-destination keys: start station (20 bits),
+# end station (20 bits), day of week (3 bits), hour (5 bits).
+OD_START_SHIFT = 28
+OD_END_SHIFT = 8
+OD_DAY_SHIFT = 5
+STATION_CODE_MASK = (1 << 20) - 1
+
+def pack_od_keys(start, end, day, hour):
+    """Pack station codes, day of week and hour into one int64 key per trip."""
+    return ((np.asarray(start, dtype=np.int64) << OD_START_SHIFT)
+            | (np.asarray(end, dtype=np.int64) << OD_END_SHIFT)
+            | (np.asarray(day, dtype=np.int64) << OD_DAY_SHIFT)
+            | np.asarray(hour, dtype=np.int64))
+
+# Merge buffered per-chunk counts into the running totals once they reach this
+# many entries (or the size of the running totals, whichever is larger).
+COMPACT_THRESHOLD = 2_000_000
+
+class TripAggregates:
+    """Running trip counts that every output is built from.
+
+    Trips are folded in one chunk at a time and then dropped, so memory depends
+    on the number of distinct stations and station pairs rather than on the
+    number of trips. Stations are integer-coded in order of first appearance
+    (code 0 is reserved for a missing station ID) and counts are kept per
+    start station x end station x day x hour, so the station-to-neighborhood
+    mapping can be applied once every station has been seen.
+    """
+
+    def __init__(self):
+        self.station_ids = [None]
+        self._station_codes = {}
+        self.start_coords = {}  # station code -> (lat, lng) first seen as a start
+        self.end_coords = {}    # station code -> (lat, lng) first seen as an end
+        self.total_trips = 0
+        self.member_trips = 0
+        self.first_start = None
+        self.last_start = None
+        self._od_keys = np.empty(0, dtype=np.int64)
+        self._od_counts = np.empty(0, dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+        # Groups are start station code * 24 + hour
+        self.durations = QuantileSketches(*DURATION_RANGE, SKETCH_ACCURACY)
+        self.speeds = QuantileSketches(*SPEED_RANGE, SKETCH_ACCURACY)
+
+    def add_trips(self, trips):
+        """Fold a chunk of parsed trips into the running counts."""
+        start, end = self.encode_trips(trips)
+        hour = trips['hour'].to_numpy()
+        self.add_od_keys(pack_od_keys(start, end, trips['day_of_week'].to_numpy(), hour))
+        if 'ended_at' in trips:
+            self.add_metric_buckets(start, hour, *self.metric_buckets(trips))
+
+    def metric_buckets(self, trips):
+        """Sketch bucket of each trip's duration and speed, -1 where it has none."""
+        return tuple(np.where(np.isnan(values), -1, sketch.bucket(np.nan_to_num(values, nan=1.0)))
+                     for values, sketch in zip(trip_metrics(trips), (self.durations, self.speeds)))
+
+    def add_metric_buckets(self, start, hour, duration_buckets, speed_buckets):
+        """Count trips' duration and speed buckets (see metric_buckets) by start station and hour."""
+        groups = np.asarray(start, dtype=np.int64) * 24 + np.asarray(hour, dtype=np.int64)
+        for sketch, buckets in ((self.durations, duration_buckets), (self.speeds, speed_buckets)):
+            kept = np.asarray(buckets) >= 0
+            sketch.add_buckets(groups[kept], buckets[kept])
+
+    def _sketch_group_map(self, remap):
+        """Sketch group renumbering for a station code remap."""
+        return (remap[:, None] * 24 + np.arange(24)).ravel()
+
+    def add_od_keys(self, keys):
+        """Count one packed key per trip (see pack_od_keys)."""
+        keys, counts = np.unique(keys, return_counts=True)
+        self._pending.append((keys, counts.astype(np.int64)))
+        self._pending_size += len(keys)
+        if self._pending_size >= max(COMPACT_THRESHOLD, len(self._od_keys)):
+            self._compact()
+
+    def encode_trips(self, trips):
+        """Fold in everything about a chunk except its OD counts.
+
+        Codes its stations, records first-seen coordinates, trip totals and the
+        date range, and returns the start and end station codes.
+        """
+        start = self._encode_stations(trips['start_station_id'])
+        end = self._encode_stations(trips['end_station_id'])
+        self._record_coords(self.start_coords, start, trips['start_lat'], trips['start_lng'])
+        self._record_coords(self.end_coords, end, trips['end_lat'], trips['end_lng'])
+
+        self.total_trips += len(trips)
+        self.member_trips += int((trips['member_casual'] == 'member').sum())
+
+        # Works on raw strings too: the fixed timestamp layout sorts chronologically
+        first = pd.Timestamp(trips['started_at'].min())
+        last = pd.Timestamp(trips['started_at'].max())
+        if self.first_start is None or first < self.first_start:
+            self.first_start = first
+        if self.last_start is None or last > self.last_start:
+            self.last_start = last
+        return start, end
+
+    def _station_code(self, station_id):
+        code = self._station_codes.get(station_id)
+        if code is None:
+            code = len(self.station_ids)
+            self._station_codes[station_id] = code
+            self.station_ids.append(station_id)
+        return code
+
+    def _encode_stations(self, station_ids):
+        local_codes, uniques = pd.factorize(station_ids)
+        table = np.fromiter((self._station_code(s) for s in uniques), dtype=np.int64,
+                            count=len(uniques))
+        # factorize marks missing IDs with -1, which picks up the trailing 0
+        return np.append(table, 0)[local_codes]
+
+    def _record_coords(self, coords, codes, lat, lng):
+        first_seen = pd.DataFrame({
+            'code': codes, 'lat': lat.to_numpy(), 'lng': lng.to_numpy()
+        }).drop_duplicates('code')
+        for code, station_lat, station_lng in first_seen.itertuples(index=False):
+            if code != 0 and code not in coords:
+                coords[code] = (station_lat, station_lng)
+
+    def merge(self, other):
+        """Fold in the aggregates of trips that come after the ones seen so far.
+
+        Merging partial aggregates in source order gives the same station
+        coordinates and counts as folding every chunk into one instance.
+        """
+        remap = np.fromiter(
+            (0 if station_id is None else self._station_code(station_id)
+             for station_id in other.station_ids),
+            dtype=np.int64, count=len(other.station_ids))
+
+        for coords, other_coords in ((self.start_coords, other.start_coords),
+                                     (self.end_coords, other.end_coords)):
+            for code, location in other_coords.items():
+                coords.setdefault(int(remap[code]), location)
+
+        if other._pending:
+            other._compact()
+        keys = other._od_keys
+        keys = ((remap[keys >> OD_START_SHIFT] << OD_START_SHIFT)
+                | (remap[(keys >> OD_END_SHIFT) & STATION_CODE_MASK] << OD_END_SHIFT)
+                | (keys & ((1 << OD_END_SHIFT) - 1)))
+        self._pending.append((keys, other._od_counts))
+        self._pending_size += len(keys)
+        if self._pending_size >= max(COMPACT_THRESHOLD, len(self._od_keys)):
+            self._compact()
+        self.durations.merge(other.durations, self._sketch_group_map(remap))
+        self.speeds.merge(other.speeds, self._sketch_group_map(remap))
+
+        self.total_trips += other.total_trips
+        self.member_trips += other.member_trips
+        if other.first_start is not None:
+            if self.first_start is None or other.first_start < self.first_start:
+                self.first_start = other.first_start
+            if self.last_start is None or other.last_start > self.last_start:
+                self.last_start = other.last_start
+
+    def save(self, path):
+        """Write the aggregates to an .npz file."""
+        if self._pending:
+            self._compact()
+        meta = {
+            'station_ids': self.station_ids[1:],
+            'total_trips': self.total_trips,
+            'member_trips': self.member_trips,
+            'first_start': None if self.first_start is None else self.first_start.isoformat(),
+            'last_start': None if self.last_start is None else self.last_start.isoformat()
+        }
+        arrays = {'od_keys': self._od_keys, 'od_counts': self._od_counts,
+                  **self.durations.to_arrays('duration'), **self.speeds.to_arrays('speed')}
+        for name, coords in (('start', self.start_coords), ('end', self.end_coords)):
+            arrays[f'{name}_codes'] = np.fromiter(coords.keys(), dtype=np.int64, count=len(coords))
+            arrays[f'{name}_coords'] = np.array(list(coords.values()), dtype=float).reshape(-1, 2)
+
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        """Read aggregates written by save()."""
+        aggregates = cls()
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            for station_id in meta['station_ids']:
+                aggregates._station_code(station_id)
+            aggregates.total_trips = meta['total_trips']
+            aggregates.member_trips = meta['member_trips']
+            if meta['first_start'] is not None:
+                aggregates.first_start = pd.Timestamp(meta['first_start'])
+                aggregates.last_start = pd.Timestamp(meta['last_start'])
+            aggregates._od_keys = data['od_keys']
+            aggregates._od_counts = data['od_counts']
+            aggregates.durations.from_arrays(data, 'duration')
+            aggregates.speeds.from_arrays(data, 'speed')
+            for name, coords in (('start', aggregates.start_coords), ('end', aggregates.end_coords)):
+                for code, (lat, lng) in zip(data[f'{name}_codes'].tolist(), data[f'{name}_coords'].tolist()):
+                    coords[code] = (lat, lng)
+        return aggregates
+
+    @classmethod
+    def from_counts(cls, od, start_coords, end_coords, station_order, metric_buckets=None):
+        """Build aggregates from counts computed outside pandas, e.g. in SQL.
+
+        od has start_station_id, end_station_id (None for a missing station),
+        day_of_week, hour and count columns. start_coords and end_coords map
+        station IDs to first-seen (lat, lng), and station_order lists every
+        station ID in the order it first appeared. metric_buckets, if given,
+        maps 'durations' and 'speeds' to start_station_id, hour, bucket and
+        count columns. Trip totals and the date range are left for the caller
+        to fill in.
+        """
+        aggregates = cls()
+        for station_id in station_order:
+            aggregates._station_code(station_id)
+        for coords, first_seen in ((aggregates.start_coords, start_coords),
+                                   (aggregates.end_coords, end_coords)):
+            for station_id, location in first_seen.items():
+                coords[aggregates._station_codes[station_id]] = location
+
+        station_ids = aggregates.station_ids[1:]
+        start = pd.Categorical(od['start_station_id'], categories=station_ids).codes.astype(np.int64) + 1
+        end = pd.Categorical(od['end_station_id'], categories=station_ids).codes.astype(np.int64) + 1
+        keys = pack_od_keys(start, end, od['day_of_week'].to_numpy(), od['hour'].to_numpy())
+        order = np.argsort(keys, kind='stable')
+        aggregates._od_keys = keys[order]
+        aggregates._od_counts = od['count'].to_numpy(dtype=np.int64)[order]
+
+        for name, counts in (metric_buckets or {}).items():
+            start = pd.Categorical(counts['start_station_id'], categories=station_ids).codes.astype(np.int64) + 1
+            getattr(aggregates, name).add_bucket_counts(
+                start * 24 + counts['hour'].to_numpy(dtype=np.int64),
+                counts['bucket'].to_numpy(dtype=np.int64), counts['count'].to_numpy(dtype=np.int64))
+        return aggregates
+
+    @classmethod
+    def from_trip_store(cls, directory, rows=slice(None), chunksize=DEFAULT_CHUNK_SIZE):
+        """Count one row slice of a trip store built by build_trip_store().
+
+        Station codes, coordinates and the date range come from the store's
+        stations.npz, so the aggregates of different slices share station
+        codes and merge back into exactly the serial result.
+        """
+        aggregates = cls.load(Path(directory) / "stations.npz")
+        store = TripStore.load(directory)
+        start, stop, _ = rows.indices(len(store))
+        aggregates.total_trips = stop - start
+        aggregates.member_trips = 0
+        for lo in range(start, stop, chunksize):
+            chunk = slice(lo, min(lo + chunksize, stop))
+            aggregates.add_od_keys(pack_od_keys(store.start[chunk], store.end[chunk],
+                                                store.day[chunk], store.hour[chunk]))
+            aggregates.add_metric_buckets(store.start[chunk], store.hour[chunk],
+                                          store.duration_bucket[chunk], store.speed_bucket[chunk])
+            aggregates.member_trips += int(np.count_nonzero(store.member[chunk]))
+        return aggregates
+
+    def _compact(self):
+        keys = np.concatenate([self._od_keys] + [k for k, _ in self._pending])
+        counts = np.concatenate([self._od_counts] + [c for _, c in self._pending])
+        order = np.argsort(keys, kind='stable')
+        keys, counts = keys[order], counts[order]
+        boundaries = np.flatnonzero(np.diff(keys)) + 1
+        starts = np.concatenate([[0], boundaries]) if len(keys) else boundaries
+        self._od_keys = keys[starts]
+        self._od_counts = np.add.reduceat(counts, starts) if len(keys) else counts
+        self._pending = []
+        self._pending_size = 0
+
+    def scale_counts(self, factor):
+        """Multiply every count by factor, e.g. to scale a sample back up."""
+        if self._pending:
+            self._compact()
+        self._od_counts = self._od_counts * factor
+        self.durations.scale(factor)
+        self.speeds.scale(factor)
+        self.total_trips *= factor
+        self.member_trips *= factor
+
+    def od_frame(self):
+        """Return station-level trip counts by start/end station, day and hour."""
+        if self._pending:
+            self._compact()
+        keys = self._od_keys
+        return pd.DataFrame({
+            'start_station': keys >> OD_START_SHIFT,
+            'end_station': (keys >> OD_END_SHIFT) & STATION_CODE_MASK,
+            'day_of_week': (keys >> OD_DAY_SHIFT) & 7,
+            'hour': keys & 31,
+            'count': self._od_counts
+        })
+
+    def stations(self):
+        """Return each station's first-seen location, preferring start coordinates.
+
+        lat/lng is the first start location (or the first end location for
+        stations that never appear as a start); end_lat/end_lng is the first
+        end location, if any.
+        """
+        missing = (np.nan, np.nan)
+        rows = [(self.station_ids[code], lat, lng) + self.end_coords.get(code, missing)
+                for code, (lat, lng) in self.start_coords.items()]
+        rows += [(self.station_ids[code], lat, lng, lat, lng)
+                 for code, (lat, lng) in self.end_coords.items()
+                 if code not in self.start_coords]
+        stations = pd.DataFrame(rows, columns=['station_id', 'lat', 'lng', 'end_lat', 'end_lng'])
+        return stations.dropna(subset=['station_id', 'lat', 'lng'])
+
+    @property
+    def total_stations(self):
+        """Number of distinct start stations."""
+        return len(self.start_coords)
+
+    @property
+    def member_pct(self):
+        return self.member_trips / self.total_trips * 100
+
+class TripSummary:
+    """Trip totals and date range from TripAggregates.
+
+    This is all that the story moments and metadata need, and it reloads
+    instantly from the stage cache without the full OD counts.
+    """
+
+    def __init__(self, aggregates):
+        self.total_trips = aggregates.total_trips
+        self.member_trips = aggregates.member_trips
+        self.total_stations = aggregates.total_stations
+        self.first_start = aggregates.first_start
+        self.last_start = aggregates.last_start
+
+    @property
+    def member_pct(self):
+        return self.member_trips / self.total_trips * 100
+
+def stream_trip_aggregates(chunksize=DEFAULT_CHUNK_SIZE, partitions=None):
+    """Fold all trips into TripAggregates without loading the full year at once."""
+    print(f"Streaming trip data in chunks of {chunksize:,}...")
+
+    aggregates = TripAggregates()
+    for chunk in iter_trip_chunks(chunksize, AGGREGATE_COLUMNS, partitions):
+        aggregates.add_trips(parse_datetime(chunk))
+
+    print(f"  Total trips loaded: {aggregates.total_trips:,}")
+    return aggregates
+
+def _trip_months(started_at):
+    """Year and month (YYYYMM) of each trip's start."""
+    if not pd.api.types.is_datetime64_any_dtype(started_at):
+        chars = _timestamp_prefix_bytes(started_at)
+        if chars is not None:
+            chars = chars.astype(np.int32)
+            return (_two_digits(chars, 0) * 100 + _two_digits(chars, 2)) * 100 + _two_digits(chars, 5)
+        started_at = pd.to_datetime(started_at)
+    return (started_at.dt.year * 100 + started_at.dt.month).to_numpy()
+
+class StratifiedSampler:
+    """Keeps one in `scale` trips of every (month, start station) stratum.
+
+    Selection is systematic in file order, from an offset derived from the
+    seed and the stratum, so every run picks the same trips and each
+    stratum's sample is within one trip of its size / scale.
+    """
+
+    def __init__(self, scale, seed=0):
+        self.scale = scale
+        self.seed = seed
+        self._seen = {}  # (month, station ID) -> trips seen so far
+
+    def _offset(self, stratum):
+        digest = hashlib.sha256(f"{self.seed}|{stratum[0]}|{stratum[1]}".encode()).digest()
+        return int.from_bytes(digest[:8], 'little') % self.scale
+
+    def keep(self, started_at, start_station_id):
+        """Mask of the sampled trips in a chunk, continuing each stratum's count."""
+        month_codes, months = pd.factorize(_trip_months(started_at))
+        station_codes, stations = pd.factorize(start_station_id)
+        strata, unique_strata = pd.factorize(month_codes * (len(stations) + 1) + station_codes + 1)
+
+        # Position of each trip within its stratum, across all chunks so far
+        base = np.empty(len(unique_strata), dtype=np.int64)
+        keys = []
+        for i, combined in enumerate(unique_strata.tolist()):
+            month, station = divmod(combined, len(stations) + 1)
+            key = (int(months[month]), stations[station - 1] if station else None)
+            keys.append(key)
+            base[i] = self._seen.get(key, 0) + self._offset(key)
+        position = base[strata] + pd.Series(strata).groupby(strata).cumcount().to_numpy()
+
+        for key, count in zip(keys, np.bincount(strata, minlength=len(keys)).tolist()):
+            self._seen[key] = self._seen.get(key, 0) + count
+        return position % self.scale == 0
+
+def sample_trip_aggregates(partitions, scale, seed=0, chunksize=DEFAULT_CHUNK_SIZE):
+    """Aggregate a stratified 1-in-`scale` sample of the cached trips, scaled back up.
+
+    Only each batch's start times and stations are converted to pick the
+    sample; the other columns are filtered in Arrow, so the trips left out
+    never reach pandas.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    print(f"Sampling 1 in {scale:,} trips per month and start station...")
+
+    sampler = StratifiedSampler(scale, seed)
+    aggregates = TripAggregates()
+    categories = _categorical_columns(AGGREGATE_COLUMNS)
+    for partition in partitions:
+        print(f"  Sampling {partition.name}...")
+        for batch in pq.ParquetFile(partition).iter_batches(batch_size=chunksize, columns=AGGREGATE_COLUMNS):
+            strata = batch.select(['started_at', 'start_station_id']).to_pandas(categories=['start_station_id'])
+            keep = sampler.keep(strata['started_at'], strata['start_station_id'])
+            aggregates.add_trips(parse_datetime(batch.filter(pa.array(keep)).to_pandas(categories=categories)))
+    print(f"  Sampled {aggregates.total_trips:,} trips")
+
+    aggregates.scale_counts(scale)
+    print(f"  Estimated total trips: {aggregates.total_trips:,}")
+    return aggregates
+
+def _aggregate_trip_source(source, chunksize):
+    """Process-pool worker: aggregate one zip member or cached row group."""
+    path, part = source
+    if isinstance(part, int):
+        import pyarrow.parquet as pq
+
+        row_group = pq.ParquetFile(path).read_row_group(part, columns=AGGREGATE_COLUMNS)
+        chunks = (batch.to_pandas(categories=_categorical_columns(AGGREGATE_COLUMNS))
+                  for batch in row_group.to_batches(max_chunksize=chunksize))
+    else:
+        chunks = iter_zip_trips(path, AGGREGATE_COLUMNS, chunksize, [part], compact=True)
+
+    aggregates = TripAggregates()
+    for chunk in chunks:
+        aggregates.add_trips(parse_datetime(chunk))
+    aggregates._compact()
+    return aggregates
+
+def parallel_trip_aggregates(workers, chunksize=DEFAULT_CHUNK_SIZE, partitions=None):
+    """Aggregate each zip member (or cached row group) in a process pool.
+
+    Workers return partial TripAggregates, which are merged in source order so
+    the result matches the serial path exactly.
+    """
+    if partitions is not None:
+        import pyarrow.parquet as pq
+
+        sources = [(partition, row_group)
+                   for partition in partitions
+                   for row_group in range(pq.ParquetFile(partition).num_row_groups)]
+    else:
+        sources = [(zip_path, csv_file)
+                   for zip_path in sorted(RAW_DIR.glob("*.zip"))
+                   for csv_file in zip_csv_members(zip_path)]
+    print(f"Aggregating {len(sources)} trip files with {workers} workers...")
+
+    aggregates = TripAggregates()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partials = pool.map(_aggregate_trip_source, sources, [chunksize] * len(sources))
+        for (path, part), partial in zip(sources, partials):
+            print(f"  Merged {path.name}:{part} ({partial.total_trips:,} trips)")
+            aggregates.merge(partial)
+
+    print(f"  Total trips loaded: {aggregates.total_trips:,}")
+    return aggregates
+
+# Bump when TripAggregates changes in a way that invalidates saved partitions
+AGGREGATES_VERSION = 2
+
+def _aggregate_month(zip_path, chunksize, trip_partition=None):
+    """Process-pool worker: aggregate every trip in one monthly zip."""
+    if trip_partition is not None:
+        chunks = iter_trip_chunks(chunksize, AGGREGATE_COLUMNS, [trip_partition])
+    else:
+        chunks = iter_zip_trips(zip_path, AGGREGATE_COLUMNS, chunksize, compact=True)
+
+    aggregates = TripAggregates()
+    for chunk in chunks:
+        aggregates.add_trips(parse_datetime(chunk))
+    return aggregates
+
+def incremental_trip_aggregates(workers=1, chunksize=DEFAULT_CHUNK_SIZE, partitions=None):
+    """Aggregate only new or changed zips, reusing saved per-month partitions.
+
+    Each zip's TripAggregates is saved under cache/aggregates/, named after
+    the zip and its content hash. Saved months are merged in zip order, so
+    the result is identical to aggregating every zip from scratch.
+    """
+    print("Updating monthly aggregate partitions...")
+    store = CACHE_DIR / "aggregates"
+    store.mkdir(parents=True, exist_ok=True)
+    manifest_path = store / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    zip_files = sorted(RAW_DIR.glob("*.zip"))
+    trip_partitions = partitions if partitions is not None else [None] * len(zip_files)
+    month_partitions = []
+    missing = []
+    updated = {}
+    for zip_path, trip_partition in zip(zip_files, trip_partitions):
+        digest = zip_digest(zip_path, manifest.get(zip_path.name))
+        partition = store / f"{zip_path.stem}-{digest[:16]}-v{AGGREGATES_VERSION}.npz"
+        if not partition.exists():
+            missing.append((zip_path, trip_partition, partition))
+        updated[zip_path.name] = _manifest_entry(zip_path, digest, partition)
+        month_partitions.append(partition)
+    print(f"  {len(zip_files) - len(missing)} months cached, {len(missing)} to process")
+
+    def save_month(zip_path, partition, month):
+        month.save(partition)
+        _remove_stale_partitions(store, zip_path, partition)
+        print(f"  Saved {partition.name} ({month.total_trips:,} trips)")
+
+    if workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            months = pool.map(_aggregate_month, [z for z, _, _ in missing],
+                              [chunksize] * len(missing), [t for _, t, _ in missing])
+            for (zip_path, _, partition), month in zip(missing, months):
+                save_month(zip_path, partition, month)
+    else:
+        for zip_path, trip_partition, partition in missing:
+            save_month(zip_path, partition, _aggregate_month(zip_path, chunksize, trip_partition))
+
+    manifest_path.write_text(json.dumps(updated, indent=2))
+
+    aggregates = TripAggregates()
+    for partition in month_partitions:
+        aggregates.merge(TripAggregates.load(partition))
+
+    print(f"  Total trips loaded: {aggregates.total_trips:,}")
+    return aggregates
+
+# Bump when the trip store's columns, station coding or sketch buckets change
+TRIP_STORE_VERSION = 2
+
+def build_trip_store(chunksize=DEFAULT_CHUNK_SIZE, partitions=None):
+    """Decode every trip once into a memory-mapped TripStore under cache/store/.
+
+    The store is named after the zips' content hashes (reused from its
+    manifest while a zip's size and mtime are unchanged), so later runs
+    attach to it without decoding anything. Stations are coded in order of
+    first appearance; their IDs, first-seen coordinates, the trip totals and
+    the date range are saved next to the columns as stations.npz, a
+    TripAggregates without counts. Returns the store directory.
+    """
+    print("Updating columnar trip store...")
+    root = CACHE_DIR / "store"
+    root.mkdir(parents=True, exist_ok=True)
+    manifest_path = root / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    zip_files = sorted(RAW_DIR.glob("*.zip"))
+    digests = [zip_digest(zip_path, manifest.get(zip_path.name)) for zip_path in zip_files]
+    key = hashlib.sha256(json.dumps([TRIP_STORE_VERSION, digests]).encode()).hexdigest()[:16]
+    directory = root / key
+
+    if directory.exists():
+        print(f"  Cached {directory.name}")
+    else:
+        stations = TripAggregates()
+        with TripStoreWriter(directory) as writer:
+            for chunk in iter_trip_chunks(chunksize, AGGREGATE_COLUMNS, partitions):
+                chunk = parse_datetime(chunk)
+                start, end = stations.encode_trips(chunk)
+                duration_bucket, speed_bucket = stations.metric_buckets(chunk)
+                writer.append(start=start, end=end, day=chunk['day_of_week'].to_numpy(),
+                              hour=chunk['hour'].to_numpy(),
+                              member=(chunk['member_casual'] == 'member').to_numpy(),
+                              duration_bucket=duration_bucket, speed_bucket=speed_bucket)
+            stations.save(writer.path / "stations.npz")
+        for stale in root.iterdir():
+            if stale.is_dir() and stale != directory:
+                shutil.rmtree(stale)
+        print(f"  Stored {writer.rows:,} trips in {directory.name}")
+
+    manifest_path.write_text(json.dumps(
+        {zip_path.name: _manifest_entry(zip_path, digest, directory)
+         for zip_path, digest in zip(zip_files, digests)}, indent=2))
+    return directory
+
+def _aggregate_store_rows(directory, rows, chunksize):
+    """Process-pool worker: count one row slice of the trip store."""
+    aggregates = TripAggregates.from_trip_store(directory, rows, chunksize)
+    aggregates._compact()
+    return aggregates
+
+def store_trip_aggregates(directory, workers=1, chunksize=DEFAULT_CHUNK_SIZE):
+    """Aggregate a trip store in contiguous row slices, one per worker.
+
+    Workers are only sent the store's path and their row range and memory-map
+    the same column files, so memory holds one copy of the trips however many
+    workers run. Slices share station codes and are merged in row order, which
+    gives exactly the serial result.
+    """
+    slices = TripStore.load(directory).row_slices(workers)
+    print(f"Aggregating stored trips in {len(slices)} slices...")
+
+    aggregates = TripAggregates()
+    if workers > 1 and len(slices) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = pool.map(_aggregate_store_rows, [directory] * len(slices), slices,
+                                [chunksize] * len(slices))
+            for partial in partials:
+                aggregates.merge(partial)
+    else:
+        for rows in slices:
+            aggregates.merge(TripAggregates.from_trip_store(directory, rows, chunksize))
+
+    print(f"  Total trips loaded: {aggregates.total_trips:,}")
+    return aggregates
+
+# Aggregation engines turn the raw zips (or the Parquet trip cache) into
+# TripAggregates. Everything downstream works on the aggregates, so engines
+# only have to agree on those.
+class PandasEngine:
+    """In-process pandas readers: in memory, --stream, --workers or --incremental."""
+
+    name = 'pandas'
+
+    def __init__(self, args):
+        self.args = args
+
+    def trip_aggregates(self, report, partitions=None):
+        args = self.args
+        if args.incremental or args.workers > 1 or args.stream:
+            name = ('incremental_trip_aggregates' if args.incremental else
+                    'parallel_trip_aggregates' if args.workers > 1 else 'stream_trip_aggregates')
+            with report.stage(name) as stage:
+                if args.incremental:
+                    aggregates = incremental_trip_aggregates(args.workers, args.chunk_size, partitions)
+                elif args.workers > 1:
+                    aggregates = parallel_trip_aggregates(args.workers, args.chunk_size, partitions)
+                else:
+                    aggregates = stream_trip_aggregates(args.chunk_size, partitions)
+                stage['rowsOut'] = aggregates.total_trips
+            return aggregates
+
+        with report.stage('load_and_process_trips') as stage:
+            trips = load_and_process_trips(AGGREGATE_COLUMNS, partitions)
+            stage['rowsOut'] = len(trips)
+            stage['frameMb'] = frame_mb(trips)
+        with report.stage('parse_datetime', rows_in=len(trips)) as stage:
+            trips = parse_datetime(trips)
+            stage['rowsOut'] = len(trips)
+            stage['frameMb'] = frame_mb(trips)
+        with report.stage('aggregate_trips', rows_in=len(trips)) as stage:
+            aggregates = TripAggregates()
+            aggregates.add_trips(trips)
+            del trips
+            stage['rowsOut'] = aggregates.total_trips
+        return aggregates
+
+class DuckDBEngine:
+    """Aggregate with DuckDB SQL, using every core and spilling to disk.
+
+    Cached Parquet partitions are queried in place. Zips are decoded by
+    iter_zip_batches and streamed into an on-disk DuckDB table, so the trips never
+    have to fit in memory. Each trip keeps its position in the source files,
+    which makes "first seen" station locations match the pandas engine.
+    --workers N caps DuckDB at N threads.
+    """
+
+    name = 'duckdb'
+
+    # Position of a trip across all sources: file index in the high bits
+    FILE_SHIFT = 40
+
+    def __init__(self, args):
+        self.threads = args.workers if args.workers > 1 else None
+        self.workdir = CACHE_DIR / "duckdb"
+
+    def _connect(self):
+        import duckdb
+
+        if self.workdir.exists():
+            shutil.rmtree(self.workdir)
+        self.workdir.mkdir(parents=True)
+        con = duckdb.connect(str(self.workdir / "trips.duckdb"))
+        con.execute(f"SET temp_directory = '{self.workdir / 'tmp'}'")
+        con.execute("SET preserve_insertion_order = false")
+        if self.threads:
+            con.execute(f"SET threads = {self.threads}")
+        return con
+
+    def _zip_batches(self, schema):
+        import pyarrow as pa
+
+        for file_index, zip_path in enumerate(sorted(RAW_DIR.glob("*.zip"))):
+            print(f"  Reading {zip_path.name}...")
+            position = file_index << self.FILE_SHIFT
+            for batch in iter_zip_batches(zip_path, AGGREGATE_COLUMNS):
+                order = pa.array(np.arange(position, position + batch.num_rows))
+                position += batch.num_rows
+                yield pa.RecordBatch.from_arrays(batch.columns + [order], schema=schema)
+
+    def _load_trips(self, con, partitions):
+        """Expose the trips as a `trips` relation with a trip_order column."""
+        if partitions is not None:
+            sources = [f"SELECT ({i}::BIGINT << {self.FILE_SHIFT}) + file_row_number AS trip_order, "
+                       f"{', '.join(AGGREGATE_COLUMNS)} "
+                       f"FROM read_parquet('{partition}', file_row_number = true)"
+                       for i, partition in enumerate(partitions)]
+            con.execute("CREATE VIEW trips AS " + " UNION ALL ".join(sources))
+            return
+
+        import pyarrow as pa
+
+        types = {'start_lat': pa.float64(), 'start_lng': pa.float64(),
+                 'end_lat': pa.float64(), 'end_lng': pa.float64()}
+        schema = pa.schema([(col, types.get(col, pa.string())) for col in AGGREGATE_COLUMNS]
+                           + [('trip_order', pa.int64())])
+        con.register('trip_stream', pa.RecordBatchReader.from_batches(schema, self._zip_batches(schema)))
+        con.execute("CREATE TABLE trips AS SELECT * FROM trip_stream")
+        con.unregister('trip_stream')
+
+    def _first_locations(self, con, role):
+        frame = con.execute(f"""
+            SELECT {role}_station_id AS station_id,
+                   min(trip_order) AS first_seen,
+                   arg_min_null({role}_lat, trip_order) AS lat,
+                   arg_min_null({role}_lng, trip_order) AS lng
+            FROM trips
+            WHERE {role}_station_id IS NOT NULL
+            GROUP BY ALL
+            ORDER BY first_seen
+        """).df()
+        locations = {station_id: (float(lat), float(lng))
+                     for station_id, lat, lng in zip(frame['station_id'], frame['lat'], frame['lng'])}
+        return locations, frame[['station_id', 'first_seen']]
+
+    def _metric_buckets(self, con):
+        """Duration and speed sketch buckets by start station and hour.
+
+        Mirrors trip_metrics and QuantileSketches.bucket operation for
+        operation, so the buckets match the pandas engine's.
+        """
+        radians = repr(np.pi / 180)
+        con.execute(f"""
+            CREATE TEMP TABLE trip_metrics AS
+            SELECT start_station_id,
+                   hour(CAST(started_at AS TIMESTAMP)) AS hour,
+                   epoch(date_trunc('second', CAST(ended_at AS TIMESTAMP)))
+                       - epoch(date_trunc('second', CAST(started_at AS TIMESTAMP))) AS duration,
+                   sin((end_lat * {radians} - start_lat * {radians}) / 2) AS half_dlat,
+                   sin((end_lng * {radians} - start_lng * {radians}) / 2) AS half_dlng,
+                   2 * {EARTH_RADIUS_KM!r} * asin(sqrt(half_dlat * half_dlat + cos(start_lat * {radians})
+                       * cos(end_lat * {radians}) * (half_dlng * half_dlng))) AS distance,
+                   distance / (duration / 3600) AS speed
+            FROM trips
+            WHERE duration BETWEEN {DURATION_RANGE[0]} AND {DURATION_RANGE[1]}
+        """)
+
+        buckets = {}
+        for name, value, bounds, kept in (
+                ('durations', 'duration', DURATION_RANGE, 'TRUE'),
+                ('speeds', 'speed', SPEED_RANGE, f"distance >= {MIN_SPEED_DISTANCE_KM!r} "
+                                                 f"AND speed BETWEEN {SPEED_RANGE[0]} AND {SPEED_RANGE[1]}")):
+            sketch = QuantileSketches(*bounds, SKETCH_ACCURACY)
+            buckets[name] = con.execute(f"""
+                SELECT start_station_id, hour,
+                       least(greatest(ceil(ln({value} / {sketch.min_value!r}) / {float(np.log(sketch.gamma))!r}), 0),
+                             {sketch.buckets - 1})::INTEGER AS bucket,
+                       count(*) AS count
+                FROM trip_metrics
+                WHERE {kept}
+                GROUP BY ALL
+            """).df()
+        return buckets
+
+    def trip_aggregates(self, report, partitions=None):
+        print("Aggregating trips with DuckDB...")
+        con = self._connect()
+        try:
+            with report.stage('duckdb_load_trips') as stage:
+                self._load_trips(con, partitions)
+                stage['rowsOut'] = con.execute("SELECT count(*) FROM trips").fetchone()[0]
+
+            with report.stage('duckdb_aggregate_trips') as stage:
+                od = con.execute("""
+                    SELECT start_station_id, end_station_id,
+                           isodow(CAST(started_at AS TIMESTAMP)) - 1 AS day_of_week,
+                           hour(CAST(started_at AS TIMESTAMP)) AS hour,
+                           count(*) AS count
+                    FROM trips
+                    GROUP BY ALL
+                """).df()
+                start_coords, start_seen = self._first_locations(con, 'start')
+                end_coords, end_seen = self._first_locations(con, 'end')
+                metric_buckets = self._metric_buckets(con)
+                total, members, first, last = con.execute("""
+                    SELECT count(*),
+                           count(*) FILTER (WHERE member_casual = 'member'),
+                           min(CAST(started_at AS TIMESTAMP)),
+                           max(CAST(started_at AS TIMESTAMP))
+                    FROM trips
+                """).fetchone()
+
+                # Stations in order of first appearance as a start or an end
+                seen = pd.concat([start_seen, end_seen]).sort_values('first_seen', kind='stable')
+                station_order = seen['station_id'].drop_duplicates().tolist()
+
+                aggregates = TripAggregates.from_counts(od, start_coords, end_coords, station_order,
+                                                        metric_buckets)
+                aggregates.total_trips = int(total)
+                aggregates.member_trips = int(members)
+                if total:
+                    aggregates.first_start = pd.Timestamp(first)
+                    aggregates.last_start = pd.Timestamp(last)
+                stage['rowsIn'] = aggregates.total_trips
+                stage['rowsOut'] = len(od)
+        finally:
+            con.close()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+        print(f"  Total trips loaded: {aggregates.total_trips:,}")
+        return aggregates
+
+class StoreEngine:
+    """Decode once into the memory-mapped trip store, then count it in slices.
+
+    --workers N splits the store's rows across N processes, which attach to
+    the same column files instead of being sent trips. Reruns with the zips
+    unchanged skip decoding entirely.
+    """
+
+    name = 'store'
+
+    def __init__(self, args):
+        self.args = args
+
+    def trip_aggregates(self, report, partitions=None):
+        with report.stage('build_trip_store') as stage:
+            directory = build_trip_store(self.args.chunk_size, partitions)
+            store = TripStore.load(directory)
+            stage['rowsOut'] = len(store)
+            stage['frameMb'] = store.nbytes / 1024 ** 2
+        with report.stage('store_trip_aggregates', rows_in=len(store)) as stage:
+            aggregates = store_trip_aggregates(directory, self.args.workers, self.args.chunk_size)
+            stage['rowsOut'] = aggregates.total_trips
+        return aggregates
+
+ENGINES = {engine.name: engine for engine in (PandasEngine, DuckDBEngine, StoreEngine)}
+
 def load_neighborhoods():
     """Load and prepare neighborhood boundaries."""
     print("Loading neighborhood boundaries...")
@@ -74,30 +1410,91 @@ def load_neighborhoods():
     nta = nta.to_crs(epsg=4326)  # Ensure WGS84
     return nta
 
-def create_station_to_nta_mapping(trips, nta):
-    """Map each station to its neighborhood."""
+# Station locations are rounded to ~0.1 m before lookup, so GPS jitter in the
+# trip data doesn't defeat the station-to-neighborhood cache.
+STATION_COORD_DECIMALS = 6
+
+def _station_location_keys(station_ids, lat, lng):
+    lat = np.round(lat.to_numpy(dtype=float), STATION_COORD_DECIMALS)
+    lng = np.round(lng.to_numpy(dtype=float), STATION_COORD_DECIMALS)
+    return [f"{station_id}|{y:.{STATION_COORD_DECIMALS}f}|{x:.{STATION_COORD_DECIMALS}f}"
+            for station_id, y, x in zip(station_ids, lat, lng)]
+
+def locate_points_in_ntas(lat, lng, nta):
+    """Return the index into nta of the polygon containing each point, or -1.
+
+    Uses an STRtree over the neighborhood polygons. Points on a shared border
+    go to the first matching neighborhood in nta order.
+    """
+    polygons = nta.geometry.to_numpy()
+    tree = shapely.STRtree(polygons)
+    points = shapely.points(np.asarray(lng, dtype=float), np.asarray(lat, dtype=float))
+    point_idx, polygon_idx = tree.query(points, predicate='within')
+
+    located = np.full(len(points), -1, dtype=np.int64)
+    order = np.lexsort((polygon_idx, point_idx))
+    first_points, first = np.unique(point_idx[order], return_index=True)
+    located[first_points] = polygon_idx[order][first]
+    return located
+
+def create_station_to_nta_mapping(stations, nta, cache_path=None):
+    """Map each station to its neighborhood.
+
+    Lookups are cached on disk by (station ID, rounded location), and the cache
+    is invalidated whenever the NTA boundary file changes, so each run only
+    locates new or moved stations. A station is placed by its first start
+    location; stations whose first end location falls in a different
+    neighborhood are counted and reported, but always resolved to the start.
+    """
     print("Creating station-to-neighborhood mapping...")
-
-    # Get unique stations
-    start_stations = trips[['start_station_id', 'start_lat', 'start_lng']].drop_duplicates()
-    start_stations.columns = ['station_id', 'lat', 'lng']
-
-    end_stations = trips[['end_station_id', 'end_lat', 'end_lng']].drop_duplicates()
-    end_stations.columns = ['station_id', 'lat', 'lng']
-
-    stations = pd.concat([start_stations, end_stations]).drop_duplicates('station_id')
-    stations = stations.dropna()
-
-    # Create GeoDataFrame
-    geometry = [Point(xy) for xy in zip(stations['lng'], stations['lat'])]
-    stations_gdf = gpd.GeoDataFrame(stations, geometry=geometry, crs="EPSG:4326")
-
-    # Spatial join
-    stations_with_nta = gpd.sjoin(stations_gdf, nta, how='left', predicate='within')
-
-    # Create mapping
-    mapping = stations_with_nta.set_index('station_id')[['ntacode', 'ntaname']].to_dict('index')
-    print(f"  Mapped {len(mapping)} stations to neighborhoods")
+    cache_path = cache_path or CACHE_DIR / "station-nta.json"
+    nta_hash = file_sha256(NTA_FILE)
+
+    cache = {}
+    if cache_path.exists():
+        cached = json.loads(cache_path.read_text())
+        if cached.get('ntaFile') == nta_hash:
+            cache = cached['stations']
+
+    start_keys = _station_location_keys(stations['station_id'], stations['lat'], stations['lng'])
+    end_keys = _station_location_keys(stations['station_id'], stations['end_lat'], stations['end_lng'])
+    has_end = stations['end_lat'].notna().to_numpy() & stations['end_lng'].notna().to_numpy()
+
+    # Locate every (station, location) pair that isn't cached yet in one query
+    lookups = {}
+    for key, lat, lng in zip(start_keys, stations['lat'], stations['lng']):
+        if key not in cache:
+            lookups[key] = (lat, lng)
+    for key, lat, lng, valid in zip(end_keys, stations['end_lat'], stations['end_lng'], has_end):
+        if valid and key not in cache:
+            lookups[key] = (lat, lng)
+
+    if lookups:
+        polygons = nta[nta.geometry.notna()].reset_index(drop=True)
+        lat, lng = np.array(list(lookups.values()), dtype=float).reshape(-1, 2).T
+        located = locate_points_in_ntas(np.round(lat, STATION_COORD_DECIMALS),
+                                        np.round(lng, STATION_COORD_DECIMALS), polygons)
+        codes = polygons['ntacode'].to_numpy()
+        names = polygons['ntaname'].to_numpy()
+        for key, idx in zip(lookups, located):
+            cache[key] = [codes[idx], names[idx]] if idx >= 0 else None
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(json.dumps({'ntaFile': nta_hash, 'stations': cache}))
+
+    mapping = {}
+    disagreements = 0
+    for station_id, start_key, end_key, valid in zip(stations['station_id'], start_keys, end_keys, has_end):
+        located = cache[start_key]
+        ntacode, ntaname = located if located else (None, None)
+        mapping[station_id] = {'ntacode': ntacode, 'ntaname': ntaname}
+        if valid and cache[end_key] != located:
+            disagreements += 1
+
+    print(f"  Mapped {len(mapping)} stations to neighborhoods ({len(lookups)} new lookups)")
+    if disagreements:
+        print(f"  {disagreements} stations have start and end locations in different "
+              f"neighborhoods; using the start location")
     return mapping
 
 def calculate_centroids(nta):
@@ -110,111 +1507,177 @@ def calculate_centroids(nta):
             centroids[row['ntacode']] = [round(centroid.x, 5), round(centroid.y, 5)]
     return centroids
 
-def aggregate_by_neighborhood(trips, station_mapping):
-    """Aggregate trips by neighborhood, day, and hour."""
-    print("Aggregating trips by neighborhood...")
+def station_nta_table(station_ids, station_mapping):
+    """Build a station code -> NTA code lookup table.
 
-    # Map stations to neighborhoods
-    trips['start_nta'] = trips['start_station_id'].map(
-        lambda x: station_mapping.get(x, {}).get('ntacode')
-    )
-    trips['end_nta'] = trips['end_station_id'].map(
-        lambda x: station_mapping.get(x, {}).get('ntacode')
-    )
+    Returns (table, nta_codes): table[station_code] is an index into the
+    sorted nta_codes, or -1 for stations without a neighborhood.
+    """
+    station_ntas = [station_mapping.get(station_id, {}).get('ntacode') for station_id in station_ids]
+    nta_codes = pd.Index(sorted({nta for nta in station_ntas if pd.notna(nta)}))
+    table = nta_codes.get_indexer(pd.Series(station_ntas, dtype=object))
+    return table, nta_codes
 
-    # Departures by neighborhood/day/hour
-    departures = trips.groupby(['start_nta', 'day_of_week', 'hour']).size().reset_index(name='departures')
-    departures.columns = ['ntacode', 'day', 'hour', 'departures']
+class PatternCube:
+    """Trip counts as a dense neighborhood x day x hour x measure array.
 
-    # Arrivals by neighborhood/day/hour
-    arrivals = trips.groupby(['end_nta', 'day_of_week', 'hour']).size().reset_index(name='arrivals')
-    arrivals.columns = ['ntacode', 'day', 'hour', 'arrivals']
+    counts[i, day, hour] holds (departures, arrivals, net) for ntacodes[i];
+    ntacodes only lists neighborhoods with at least one trip.
+    """
 
-    # Merge
-    patterns = departures.merge(arrivals, on=['ntacode', 'day', 'hour'], how='outer').fillna(0)
-    patterns['departures'] = patterns['departures'].astype(int)
-    patterns['arrivals'] = patterns['arrivals'].astype(int)
-    patterns['net'] = patterns['arrivals'] - patterns['departures']
+    DEPARTURES, ARRIVALS, NET = 0, 1, 2
 
-    return patterns, trips
+    def __init__(self, ntacodes, counts):
+        self.ntacodes = list(ntacodes)
+        self.counts = counts
 
-def generate_flows(trips, centroids):
-    """Generate origin-destination flow data, optimized for size."""
-    print("Generating flow data...")
+    @classmethod
+    def from_od(cls, start_nta, end_nta, day, hour, count, nta_codes):
+        """Build the cube in one bincount pass over integer-coded OD counts.
 
-    # Filter trips with valid NTA mappings
-    valid_trips = trips.dropna(subset=['start_nta', 'end_nta'])
-    # Exclude trips within same neighborhood
-    valid_trips = valid_trips[valid_trips['start_nta'] != valid_trips['end_nta']]
-
-    # Create day type: weekday (0-4) or weekend (5-6)
-    valid_trips['day_type'] = valid_trips['day_of_week'].apply(lambda x: 'weekday' if x < 5 else 'weekend')
-
-    # Create time periods for more compact data
-    def get_time_period(hour):
-        if 6 <= hour < 10:
-            return 'morning_rush'
-        elif 10 <= hour < 12:
-            return 'late_morning'
-        elif 12 <= hour < 16:
-            return 'midday'
-        elif 16 <= hour < 20:
-            return 'evening_rush'
-        elif 20 <= hour < 24:
-            return 'night'
-        else:
-            return 'late_night'
+        start_nta/end_nta index into nta_codes, with -1 for unmapped stations.
+        """
+        slots = len(nta_codes) * 7 * 24
+
+        def tally(nta):
+            mapped = nta >= 0
+            flat = (nta[mapped] * 7 + day[mapped]) * 24 + hour[mapped]
+            # Weighted bincount returns floats, exact for any realistic trip count
+            return np.bincount(flat, weights=count[mapped], minlength=slots).astype(np.int64)
+
+        departures = tally(start_nta).reshape(len(nta_codes), 7, 24)
+        arrivals = tally(end_nta).reshape(len(nta_codes), 7, 24)
+        counts = np.stack([departures, arrivals, arrivals - departures], axis=-1)
 
-    valid_trips['time_period'] = valid_trips['hour'].apply(get_time_period)
+        active = (departures + arrivals).reshape(len(nta_codes), -1).any(axis=1)
+        return cls(np.asarray(nta_codes)[active], counts[active])
 
-    # Group by origin-destination-day_type-time_period
-    flow_counts = valid_trips.groupby(
-        ['start_nta', 'end_nta', 'day_type', 'time_period']
-    ).size().reset_index(name='count')
+def aggregate_by_neighborhood(aggregates, station_mapping):
+    """Aggregate trips by neighborhood, day, and hour.
 
-    # Filter to significant flows (minimum 200 trips)
-    flow_counts = flow_counts[flow_counts['count'] >= 200]
+    Returns a PatternCube of departures/arrivals/net per neighborhood, day
+    and hour, and a FlowCube of neighborhood-to-neighborhood counts by day
+    and hour. Neighborhoods stay integer-coded over the sorted NTA codes.
+    """
+    print("Aggregating trips by neighborhood...")
+
+    # Map stations to neighborhoods with a single array lookup
+    station_nta, nta_codes = station_nta_table(aggregates.station_ids, station_mapping)
+
+    od = aggregates.od_frame()
+    flow_cube = FlowCube.from_codes(
+        station_nta[od['start_station']], station_nta[od['end_station']],
+        od['day_of_week'].to_numpy(), od['hour'].to_numpy(), od['count'].to_numpy(), list(nta_codes))
+
+    # The cube already holds every neighborhood pair, so patterns sum far fewer rows
+    patterns = PatternCube.from_od(
+        flow_cube.start.astype(np.int64), flow_cube.end.astype(np.int64),
+        flow_cube.slot // 24, flow_cube.slot % 24, flow_cube.count, nta_codes)
+
+    return patterns, flow_cube
+
+def aggregate_by_station(aggregates):
+    """Aggregate trips by station, day, and hour.
+
+    Returns a PatternCube whose rows are stations rather than neighborhoods
+    (its ntacodes hold station IDs). Station codes index the cube directly,
+    so this is two bincounts over the station-level OD counts, linear in the
+    number of trips and never materializing a station x slot frame.
+    """
+    print("Aggregating trips by station...")
+
+    od = aggregates.od_frame()
+    # Station code 0 is a missing station ID; shift it to -1 (unmapped)
+    return PatternCube.from_od(
+        od['start_station'].to_numpy() - 1, od['end_station'].to_numpy() - 1,
+        od['day_of_week'].to_numpy(), od['hour'].to_numpy(), od['count'].to_numpy(),
+        aggregates.station_ids[1:])
+
+# Flow time periods, in the order of the TimePeriod type, and the period index
+# of each hour of the day
+TIME_PERIODS = ['morning_rush', 'late_morning', 'midday', 'evening_rush', 'night', 'late_night']
+HOUR_PERIODS = np.array([5] * 6 + [0] * 4 + [1] * 2 + [2] * 4 + [3] * 4 + [4] * 4)
+DAY_TYPES = ['weekday', 'weekend']
+
+def round_coord(coord):
+    """Round a centroid to reduce file size."""
+    return [round(coord[0], 4), round(coord[1], 4)]
+
+# Flows with fewer trips (per day type and period) are left out of the flow bundles
+MIN_FLOW_TRIPS = 200
+
+def generate_flows(flow_cube, centroids):
+    """Generate origin-destination flow data, optimized for size.
+
+    The flow cube is queried once per day type and time period into a dense
+    (origin x destination x day type x period) array, which is thresholded
+    and emitted straight from the surviving indices.
+    """
+    print("Generating flow data...")
+
+    ntacodes = flow_cube.ntacodes
+    n = len(ntacodes)
+
+    # Day types are 0=weekday, 1=weekend. Periods are numbered alphabetically
+    # here so records come out sorted by name.
+    period_names = sorted(TIME_PERIODS)
+    shape = (n, n, len(DAY_TYPES), len(TIME_PERIODS))
+    flow_counts = np.zeros(shape, dtype=np.int64)
+    for d, days in enumerate((range(5), range(5, 7))):
+        for p, period in enumerate(period_names):
+            hours = np.flatnonzero(HOUR_PERIODS == TIME_PERIODS.index(period)).tolist()
+            flow_counts[:, :, d, p] = flow_cube.query(hours=hours, days=days)
+
+    # Exclude trips within same neighborhood
+    flow_counts[np.arange(n), np.arange(n)] = 0
+    flow_counts = flow_counts.ravel()
 
-    print(f"  Found {len(flow_counts):,} significant flows")
+    # Filter to significant flows
+    significant = np.flatnonzero(flow_counts >= MIN_FLOW_TRIPS)
+    print(f"  Found {len(significant):,} significant flows")
 
-    # Round centroids to reduce file size
-    def round_coord(coord):
-        return [round(coord[0], 4), round(coord[1], 4)]
+    # Round centroids once per neighborhood
+    has_centroid = np.array([ntacode in centroids for ntacode in ntacodes], dtype=bool)
+    rounded = [round_coord(centroids[ntacode]) if ntacode in centroids else None for ntacode in ntacodes]
 
     # Build flow list
-    flows = []
-    for _, row in flow_counts.iterrows():
-        from_nta = row['start_nta']
-        to_nta = row['end_nta']
-
-        if from_nta in centroids and to_nta in centroids:
-            flows.append({
-                'f': from_nta,
-                't': to_nta,
-                'fc': round_coord(centroids[from_nta]),
-                'tc': round_coord(centroids[to_nta]),
-                'd': 0 if row['day_type'] == 'weekday' else 1,  # 0=weekday, 1=weekend
-                'p': row['time_period'],
-                'c': int(row['count'])
-            })
+    from_nta, to_nta, day_idx, period_idx = np.unravel_index(significant, shape)
+    keep = has_centroid[from_nta] & has_centroid[to_nta]
+    flows = [
+        {
+            'f': ntacodes[f],
+            't': ntacodes[t],
+            'fc': rounded[f],
+            'tc': rounded[t],
+            'd': d,  # 0=weekday, 1=weekend
+            'p': period_names[p],
+            'c': c
+        }
+        for f, t, d, p, c in zip(
+            from_nta[keep].tolist(), to_nta[keep].tolist(), day_idx[keep].tolist(),
+            period_idx[keep].tolist(), flow_counts[significant][keep].tolist()
+        )
+    ]
 
     # Top flows (aggregated across all time)
-    agg_flows = valid_trips.groupby(['start_nta', 'end_nta']).size().reset_index(name='count')
-    agg_flows = agg_flows[agg_flows['count'] >= 1000]
-    agg_flows = agg_flows.sort_values('count', ascending=False).head(150)
-
-    top_flows = []
-    for _, row in agg_flows.iterrows():
-        from_nta = row['start_nta']
-        to_nta = row['end_nta']
-        if from_nta in centroids and to_nta in centroids:
-            top_flows.append({
-                'f': from_nta,
-                't': to_nta,
-                'fc': round_coord(centroids[from_nta]),
-                'tc': round_coord(centroids[to_nta]),
-                'c': int(row['count'])
-            })
+    pair_counts = flow_counts.reshape(n * n, -1).sum(axis=1)
+    candidates = np.flatnonzero(pair_counts >= 1000)
+    # Same (unstable) sort as DataFrame.sort_values, so ties keep their old order
+    order = pd.Series(pair_counts[candidates]).sort_values(ascending=False).head(150).index
+    top_pairs = candidates[order]
+    top_from, top_to = np.unravel_index(top_pairs, (n, n))
+    keep = has_centroid[top_from] & has_centroid[top_to]
+
+    top_flows = [
+        {
+            'f': ntacodes[f],
+            't': ntacodes[t],
+            'fc': rounded[f],
+            'tc': rounded[t],
+            'c': c
+        }
+        for f, t, c in zip(top_from[keep].tolist(), top_to[keep].tolist(), pair_counts[top_pairs][keep].tolist())
+    ]
 
     # Compact centroids
     compact_centroids = {k: round_coord(v) for k, v in centroids.items()}
@@ -225,110 +1688,415 @@ def generate_flows(trips, centroids):
         'centroids': compact_centroids
     }
 
+def encode_flows_compact(flow_data):
+    """Dictionary-encode flow data into parallel arrays, for generate_flow_bundles.
+
+    Layout:
+        ntas       NTA codes; every other field refers to them by index
+        centroids  [lng, lat] for each entry in ntas
+        periods    time period names; flows refer to them by index
+        flows      {f, t, d, p, c}: from/to NTA index, day type, period index, count
+        topFlows   {f, t, c}
+    """
+    ntas = list(flow_data['centroids'])
+    nta_index = {ntacode: i for i, ntacode in enumerate(ntas)}
+    period_index = {period: i for i, period in enumerate(TIME_PERIODS)}
+    flows, top_flows = flow_data['flows'], flow_data['topFlows']
+
+    return {
+        'ntas': ntas,
+        'centroids': [flow_data['centroids'][ntacode] for ntacode in ntas],
+        'periods': TIME_PERIODS,
+        'flows': {
+            'f': [nta_index[flow['f']] for flow in flows],
+            't': [nta_index[flow['t']] for flow in flows],
+            'd': [flow['d'] for flow in flows],
+            'p': [period_index[flow['p']] for flow in flows],
+            'c': [flow['c'] for flow in flows]
+        },
+        'topFlows': {
+            'f': [nta_index[flow['f']] for flow in top_flows],
+            't': [nta_index[flow['t']] for flow in top_flows],
+            'c': [flow['c'] for flow in top_flows]
+        }
+    }
+
 def generate_weekly_patterns(patterns):
     """Generate weekly patterns JSON."""
     print("Generating weekly patterns...")
 
     weekly = {}
-    for ntacode in patterns['ntacode'].dropna().unique():
-        nta_data = patterns[patterns['ntacode'] == ntacode]
-        days = []
-        for day in range(7):
-            day_data = nta_data[nta_data['day'] == day].sort_values('hour')
-            hours = []
-            for hour in range(24):
-                hour_row = day_data[day_data['hour'] == hour]
-                if len(hour_row) > 0:
-                    hours.append({
-                        'hour': hour,
-                        'departures': int(hour_row['departures'].iloc[0]),
-                        'arrivals': int(hour_row['arrivals'].iloc[0]),
-                        'net': int(hour_row['net'].iloc[0])
-                    })
-                else:
-                    hours.append({'hour': hour, 'departures': 0, 'arrivals': 0, 'net': 0})
-            days.append(hours)
-        weekly[ntacode] = {'data': days}
+    for ntacode, nta_counts in zip(patterns.ntacodes, patterns.counts.tolist()):
+        weekly[ntacode] = {'data': [
+            [
+                {'hour': hour, 'departures': departures, 'arrivals': arrivals, 'net': net}
+                for hour, (departures, arrivals, net) in enumerate(day_counts)
+            ]
+            for day_counts in nta_counts
+        ]}
 
     return weekly
 
-def generate_neighborhoods_geojson(nta, patterns):
-    """Generate simplified neighborhoods GeoJSON with stats."""
-    print("Generating neighborhoods GeoJSON...")
+# Bump when the station-imbalance.json layout changes
+STATION_IMBALANCE_VERSION = 1
+TOP_IMBALANCED_STATIONS = 50
+
+def generate_station_imbalance(station_patterns, stations, station_mapping):
+    """Net flow per station by day and hour, plus the most imbalanced stations.
+
+    Layout:
+        stations  station IDs; every other field refers to them by index
+        coords    [lng, lat] of each station's first-seen location
+        ntas      NTA code of each station, or null outside every neighborhood
+        net       arrivals - departures, 168 values per station (day * 24 + hour)
+        top       {s, imbalance, surplus, deficit}: stations with the largest
+                  weekly sum of |net|; surplus/deficit are the [slot, net] with
+                  the most arrivals and departures in excess
+    """
+    print("Generating station imbalance...")
+
+    # Stations are listed by ID, so the file doesn't depend on the order they
+    # were first seen in. Stations without a known location are left out.
+    locations = stations.set_index('station_id')[['lng', 'lat']]
+    locations = locations[~locations.index.duplicated()].reindex(station_patterns.ntacodes)
+    located = locations['lat'].notna().to_numpy()
+    rows = np.flatnonzero(located)
+    rows = rows[np.argsort(np.asarray(station_patterns.ntacodes, dtype=object)[rows], kind='stable')]
+
+    station_ids = [station_patterns.ntacodes[row] for row in rows]
+    coords = np.round(locations.to_numpy(dtype=float)[rows], 5).tolist()
+    net = station_patterns.counts[rows][..., PatternCube.NET].reshape(len(station_ids), -1)
+    imbalance = np.abs(net).sum(axis=1)
+
+    order = np.argsort(-imbalance, kind='stable')[:TOP_IMBALANCED_STATIONS]
+    surplus, deficit = net.argmax(axis=1), net.argmin(axis=1)
+    top = [
+        {
+            's': s,
+            'imbalance': int(imbalance[s]),
+            'surplus': [int(surplus[s]), int(net[s, surplus[s]])],
+            'deficit': [int(deficit[s]), int(net[s, deficit[s]])]
+        }
+        for s in order.tolist()
+    ]
+    print(f"  {len(station_ids):,} stations; most imbalanced: {station_ids[order[0]] if len(order) else None}")
+
+    return {
+        'version': STATION_IMBALANCE_VERSION,
+        'stations': station_ids,
+        'coords': coords,
+        'ntas': [station_mapping.get(station_id, {}).get('ntacode') for station_id in station_ids],
+        'net': net.tolist(),
+        'top': top
+    }
 
+TRIP_DISTRIBUTIONS_VERSION = 1
+DISTRIBUTION_QUANTILES = [0.5, 0.9, 0.99]
+
+def generate_trip_distributions(aggregates, station_mapping):
+    """Trip duration and speed quantiles per neighborhood and start hour.
+
+    Trips count towards the neighborhood they start in. Station sketches are
+    merged per neighborhood, so no trip-level values are needed.
+
+    Layout:
+        quantiles  the quantiles every distribution lists, e.g. [0.5, 0.9, 0.99]
+        ntas       NTA codes; the per-neighborhood arrays below follow this order
+        duration   {unit: "s", overall, hourly, n}: overall[i] holds the
+                   quantiles of ntas[i] over all hours, hourly[i][h] those of
+                   trips starting at hour h (null without trips), n[i][h] the
+                   number of trips behind them
+        speed      the same for straight-line speed, in km/h
+    """
+    print("Generating trip duration and speed distributions...")
+
+    station_nta, nta_codes = station_nta_table(aggregates.station_ids, station_mapping)
+    # Sketch groups are station code * 24 + hour
+    hourly_map = np.where(station_nta[:, None] >= 0, station_nta[:, None] * 24 + np.arange(24), -1).ravel()
+    overall_map = np.repeat(station_nta, 24)
+
+    def distribution(sketches, unit, decimals):
+        def rounded(values):
+            values = np.round(values, decimals)
+            return (values.astype(int) if decimals == 0 else values).tolist()
+
+        groups, counts, values = sketches.regroup(hourly_map).quantiles(DISTRIBUTION_QUANTILES)
+        hourly = [[None] * 24 for _ in nta_codes]
+        n = [[0] * 24 for _ in nta_codes]
+        for group, count, quantiles in zip(groups.tolist(), counts.tolist(), rounded(values)):
+            hourly[group // 24][group % 24] = quantiles
+            n[group // 24][group % 24] = count
+
+        overall = [None] * len(nta_codes)
+        groups, _, values = sketches.regroup(overall_map).quantiles(DISTRIBUTION_QUANTILES)
+        for group, quantiles in zip(groups.tolist(), rounded(values)):
+            overall[group] = quantiles
+        return {'unit': unit, 'overall': overall, 'hourly': hourly, 'n': n}
+
+    distributions = {
+        'version': TRIP_DISTRIBUTIONS_VERSION,
+        'quantiles': DISTRIBUTION_QUANTILES,
+        'ntas': list(nta_codes),
+        'duration': distribution(aggregates.durations, 's', 0),
+        'speed': distribution(aggregates.speeds, 'km/h', 1)
+    }
+    trips = sum(map(sum, distributions['duration']['n']))
+    print(f"  {len(nta_codes)} neighborhoods, {trips:,} trips with a duration")
+    return distributions
+
+def neighborhood_stats(nta, patterns):
+    """Neighborhood boundaries with trip stats, for neighborhoods with any trips.
+
+    Adds integer departures, arrivals, total_trips and peakHour columns, a
+    classification and nta_row, each neighborhood's row in the NTA file;
+    geometry is left at full resolution.
+    """
     # Aggregate stats per neighborhood
-    nta_stats = patterns.groupby('ntacode').agg({
-        'departures': 'sum',
-        'arrivals': 'sum'
-    }).reset_index()
+    totals = patterns.counts.sum(axis=(1, 2))
+    nta_stats = pd.DataFrame({
+        'ntacode': patterns.ntacodes,
+        'departures': totals[:, PatternCube.DEPARTURES],
+        'arrivals': totals[:, PatternCube.ARRIVALS]
+    })
     nta_stats['total_trips'] = nta_stats['departures'] + nta_stats['arrivals']
 
-    # Peak hour per neighborhood (weekday only)
-    weekday_patterns = patterns[patterns['day'] < 5]  # Mon-Fri
-    peak_hours = weekday_patterns.groupby(['ntacode', 'hour'])['departures'].sum().reset_index()
-    peak_hours = peak_hours.loc[peak_hours.groupby('ntacode')['departures'].idxmax()]
-    peak_hours = peak_hours.set_index('ntacode')['hour'].to_dict()
-
-    # Merge with NTA boundaries
-    nta_with_stats = nta.merge(nta_stats, on='ntacode', how='left')
+    # Peak hour per neighborhood (weekday only). Only hours with any weekday
+    # activity are candidates; ties go to the earliest hour.
+    weekday = patterns.counts[:, :5]  # Mon-Fri
+    weekday_departures = weekday[..., PatternCube.DEPARTURES].sum(axis=1)
+    active_hours = (weekday[..., [PatternCube.DEPARTURES, PatternCube.ARRIVALS]] > 0).any(axis=(1, 3))
+    peak = np.where(active_hours, weekday_departures, -1).argmax(axis=1)
+    peak_hours = {
+        ntacode: np.int64(hour)
+        for ntacode, hour, active in zip(patterns.ntacodes, peak, active_hours.any(axis=1))
+        if active
+    }
 
-    # Simplify geometry
-    nta_with_stats['geometry'] = nta_with_stats['geometry'].simplify(0.001, preserve_topology=True)
+    # Merge with NTA boundaries, keeping neighborhoods with data
+    nta_with_stats = nta.assign(nta_row=np.arange(len(nta))).merge(nta_stats, on='ntacode', how='inner')
+    nta_with_stats = nta_with_stats[nta_with_stats['total_trips'] > 0].reset_index(drop=True)
 
     # Add peak hour
-    nta_with_stats['peakHour'] = nta_with_stats['ntacode'].map(peak_hours)
+    nta_with_stats['peakHour'] = nta_with_stats['ntacode'].map(peak_hours).astype('Int64')
 
     # Classify neighborhoods
     def classify(row):
-        if pd.isna(row['total_trips']) or row['total_trips'] == 0:
-            return None
         # Simple classification based on peak hour
-        if row['peakHour'] and row['peakHour'] < 9:
+        if pd.notna(row['peakHour']) and row['peakHour'] and row['peakHour'] < 9:
             return 'residential'
-        elif row['peakHour'] and row['peakHour'] >= 9 and row['peakHour'] < 11:
+        elif pd.notna(row['peakHour']) and row['peakHour'] and row['peakHour'] >= 9 and row['peakHour'] < 11:
             return 'commercial'
         else:
             return 'mixed'
 
     nta_with_stats['classification'] = nta_with_stats.apply(classify, axis=1)
+    return nta_with_stats
+
+# Columns emitted as feature properties, in output order
+NEIGHBORHOOD_PROPERTIES = ['ntacode', 'ntaname', 'boroname', 'departures', 'arrivals',
+                           'total_trips', 'peakHour', 'classification']
+
+def _neighborhood_properties(nta_with_stats):
+    """Feature properties with stats as plain ints (missing peak hours dropped)."""
+    properties = []
+    for row in nta_with_stats[NEIGHBORHOOD_PROPERTIES].itertuples(index=False):
+        props = {}
+        for name, value in zip(NEIGHBORHOOD_PROPERTIES, row):
+            if pd.isna(value):
+                continue
+            props[name] = int(value) if isinstance(value, (int, np.integer)) else value
+        properties.append(props)
+    return properties
+
+# Decimal places kept in neighborhoods.json (1e-5 degrees is about 1 m)
+GEOJSON_COORD_DECIMALS = 5
+
+def generate_neighborhoods_geojson(nta, patterns):
+    """Generate simplified neighborhoods GeoJSON with integer stats.
+
+    Feature ids are the neighborhoods' NTA file rows as strings, as
+    GeoDataFrame.to_json() wrote them.
+    """
+    print("Generating neighborhoods GeoJSON...")
+
+    nta_with_stats = neighborhood_stats(nta, patterns)
+    geometry = nta_with_stats.geometry.simplify(0.001, preserve_topology=True)
+    geometry = shapely.transform(geometry.to_numpy(), lambda coords: np.round(coords, GEOJSON_COORD_DECIMALS))
+
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'id': str(row), 'type': 'Feature', 'properties': props, 'geometry': shapely.geometry.mapping(geom)}
+            for row, props, geom in zip(nta_with_stats['nta_row'], _neighborhood_properties(nta_with_stats),
+                                        geometry)
+        ]
+    }
 
-    # Filter to neighborhoods with data
-    nta_with_stats = nta_with_stats[nta_with_stats['total_trips'] > 0]
+# Levels of detail written to neighborhoods/<lod>.json. Arcs are simplified
+# with `tolerance` and snapped to a grid of `quantum`, both in degrees
+# (0.0001 degrees is about 10 m). The page fetches the level its map zoom
+# needs (NEIGHBORHOOD_DETAIL_ZOOM in lib/citibike.ts). The low level only
+# carries the properties the map needs to draw and select neighborhoods.
+NEIGHBORHOOD_TOPOLOGY_DIR = "neighborhoods"
+NEIGHBORHOOD_LODS = {
+    'low': {'tolerance': 0.003, 'quantum': 0.0005, 'properties': ['ntacode', 'ntaname', 'boroname']},
+    'medium': {'tolerance': 0.001, 'quantum': 0.0001, 'properties': None},
+    'high': {'tolerance': 0.0002, 'quantum': 0.00001, 'properties': None},
+}
+# Vertices are matched at this many decimals when finding shared borders
+TOPOLOGY_DECIMALS = 6
+
+def _polygon_rings(geometry):
+    """[[ring, ...], ...] per polygon, each ring a list of (x, y) without the closing point."""
+    polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+    return [
+        [[(round(x, TOPOLOGY_DECIMALS), round(y, TOPOLOGY_DECIMALS)) for x, y in ring.coords[:-1]]
+         for ring in [polygon.exterior, *polygon.interiors]]
+        for polygon in polygons
+    ]
 
-    # Convert to GeoJSON
-    geojson = json.loads(nta_with_stats.to_json())
+def build_arcs(geometries):
+    """Cut polygon rings into arcs so that shared borders are stored once.
+
+    As in TopoJSON, a vertex is a junction where the rings passing through it
+    disagree about its neighbours; rings are split at junctions and identical
+    (or reversed) pieces become one arc. Returns the arcs as point lists and,
+    per geometry, its polygons' rings as arc indices (~i for a reversed arc).
+    """
+    polygons = [_polygon_rings(geometry) for geometry in geometries]
+    rings = [ring for geometry in polygons for polygon in geometry for ring in polygon]
+
+    neighbours = {}
+    for ring in rings:
+        for i, point in enumerate(ring):
+            neighbours.setdefault(point, set()).add(frozenset((ring[i - 1], ring[(i + 1) % len(ring)])))
+    junctions = {point for point, pairs in neighbours.items() if len(pairs) > 1}
+
+    arcs = []
+    arc_index = {}
+
+    def add_arc(points):
+        key = tuple(points)
+        if key in arc_index:
+            return arc_index[key]
+        reverse_key = key[::-1]
+        if reverse_key in arc_index:
+            return ~arc_index[reverse_key]
+        arc_index[key] = len(arcs)
+        arcs.append(points)
+        return arc_index[key]
+
+    def ring_arcs(ring):
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # A ring that touches nothing is one closed arc, started at its
+            # smallest vertex so that a matching hole can share it
+            start = ring.index(min(ring))
+            return [add_arc(ring[start:] + ring[:start + 1])]
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [cut - cuts[0] for cut in cuts] + [len(ring)]
+        ring = ring + ring[:1]
+        return [add_arc(ring[start:end + 1]) for start, end in zip(cuts, cuts[1:])]
+
+    shapes = [[[ring_arcs(ring) for ring in polygon] for polygon in geometry] for geometry in polygons]
+    return arcs, shapes
+
+def _encode_arc(points, tolerance, quantum, origin):
+    """Simplify an arc, snap it to the grid and delta-encode it."""
+    closed = points[0] == points[-1]
+    line = shapely.LineString(points)
+    simplified = np.asarray(line.simplify(tolerance, preserve_topology=False).coords)
+    if closed and len(simplified) < 4:
+        simplified = np.asarray(line.coords)
+    grid = np.round((simplified - origin) / quantum).astype(np.int64)
+    keep = np.concatenate([[True], (np.diff(grid, axis=0) != 0).any(axis=1)])
+    grid = grid[keep] if keep.sum() > 1 else grid[[0, -1]]
+    return np.concatenate([grid[:1], np.diff(grid, axis=0)]).tolist()
+
+def generate_neighborhood_topologies(nta, patterns):
+    """Generate one quantized, TopoJSON-style topology per level of detail.
+
+    Shared borders are found once at full resolution and every arc is then
+    simplified on its own, so neighbouring polygons stay gap-free at every
+    level. Returns {lod: topology}.
+    """
+    print("Generating neighborhood topologies...")
+
+    nta_with_stats = neighborhood_stats(nta, patterns)
+    return encode_topologies(nta_with_stats.geometry, _neighborhood_properties(nta_with_stats))
+
+def encode_topologies(geometries, properties):
+    """Encode polygons and their properties at every level in NEIGHBORHOOD_LODS.
+
+    Rings that collapse to fewer than three points at a level are dropped
+    there, along with polygons that lose their exterior ring.
+    """
+    arcs, shapes = build_arcs(geometries)
+    origin = np.array(shapely.total_bounds(np.asarray(geometries))[:2])
+
+    topologies = {}
+    for lod, settings in NEIGHBORHOOD_LODS.items():
+        quantum = settings['quantum']
+        translate = np.round(origin / quantum) * quantum
+        encoded = [_encode_arc(arc, settings['tolerance'], quantum, translate) for arc in arcs]
+
+        def distinct_points(ring):
+            return sum(len(encoded[index if index >= 0 else ~index]) - 1 for index in ring)
+
+        objects = []
+        for props, polygons in zip(properties, shapes):
+            polygons = [[ring for ring in polygon if distinct_points(ring) >= 3]
+                        for polygon in polygons if distinct_points(polygon[0]) >= 3]
+            if not polygons:
+                continue
+            if settings['properties'] is not None:
+                props = {name: value for name, value in props.items() if name in settings['properties']}
+            if len(polygons) == 1:
+                objects.append({'type': 'Polygon', 'arcs': polygons[0], 'properties': props})
+            else:
+                objects.append({'type': 'MultiPolygon', 'arcs': polygons, 'properties': props})
+
+        topologies[lod] = {
+            'type': 'Topology',
+            'transform': {'scale': [quantum, quantum], 'translate': translate.round(TOPOLOGY_DECIMALS).tolist()},
+            'arcs': encoded,
+            'objects': {'neighborhoods': {'type': 'GeometryCollection', 'geometries': objects}}
+        }
+    return topologies
 
-    return geojson
+def save_neighborhood_topologies(out, topologies):
+    for lod, topology in topologies.items():
+        save_json(out, topology, f"{NEIGHBORHOOD_TOPOLOGY_DIR}/{lod}.json", hashed=True)
 
-def generate_story_moments(patterns, trips):
+def generate_story_moments(flow_cube, aggregates):
     """Generate story moments with compelling narratives and flow filters."""
     print("Generating story moments...")
 
-    total_trips = len(trips)
+    total_trips = aggregates.total_trips
 
     # Calculate stats
-    weekday = patterns[patterns['day'] < 5]
-    weekend = patterns[patterns['day'] >= 5]
+    weekdays, weekend = range(5), range(5, 7)
+
+    def departures(days, hours):
+        return flow_cube.totals(hours, days)[0].sum()
 
     # Morning rush (7-9 AM weekdays)
-    morning_rush = weekday[(weekday['hour'] >= 7) & (weekday['hour'] < 10)]
-    morning_rush_trips = morning_rush['departures'].sum()
+    morning_rush_trips = departures(weekdays, range(7, 10))
 
     # Evening rush (5-7 PM weekdays)
-    evening_rush = weekday[(weekday['hour'] >= 17) & (weekday['hour'] < 19)]
-    evening_rush_trips = evening_rush['departures'].sum()
+    evening_rush_trips = departures(weekdays, range(17, 19))
 
     # Friday night (10 PM - 2 AM)
-    friday = patterns[patterns['day'] == 4]
-    friday_night = friday[(friday['hour'] >= 22) | (friday['hour'] < 2)]
-    friday_night_trips = friday_night['arrivals'].sum()
+    friday_night_trips = flow_cube.totals([22, 23, 0, 1], [4])[1].sum()
 
     # Weekend leisure
-    weekend_leisure = weekend[(weekend['hour'] >= 10) & (weekend['hour'] < 16)]
-    weekend_leisure_trips = weekend_leisure['departures'].sum()
+    weekend_leisure_trips = departures(weekend, range(10, 16))
+
+    # Neighborhoods with at least one trip
+    active_neighborhoods = np.count_nonzero(sum(flow_cube.totals()))
 
     # Member vs casual percentage
-    member_pct = (trips['member_casual'] == 'member').mean() * 100
+    member_pct = aggregates.member_pct
     casual_pct = 100 - member_pct
 
     moments = [
@@ -440,80 +2208,934 @@ def generate_story_moments(patterns, trips):
         {
             "id": "gap",
             "title": "The Gap",
-            "description": f"{patterns['ntacode'].nunique()} neighborhoods analyzed. But Citi Bike only reaches 40% of New York. The system's boundaries trace familiar lines — income, race, historical investment. The invisible geography has invisible edges.",
+            "description": f"{active_neighborhoods} neighborhoods analyzed. But Citi Bike only reaches 40% of New York. The system's boundaries trace familiar lines — income, race, historical investment. The invisible geography has invisible edges.",
             "mapState": {"center": [-73.97, 40.73], "zoom": 11.5, "bearing": 0, "pitch": 0},
             "highlightNeighborhoods": [],
             "flowFilter": None,
-            "statistic": {"label": "Neighborhoods Covered", "value": f"{patterns['ntacode'].nunique()}"}
+            "statistic": {"label": "Neighborhoods Covered", "value": f"{active_neighborhoods}"}
         }
     ]
 
     return moments
 
-def generate_metadata(trips):
-    """Generate metadata file."""
-    member_pct = (trips['member_casual'] == 'member').mean() * 100
+# Each story moment's flowFilter is evaluated at build time against the flow
+# cube's exact day and hour counts, and its strongest flows are written to
+# story-flows/<moment id>.json. Moments showing every direction get more
+# flows so the whole city is covered.
+STORY_FLOW_DIR = "story-flows"
+STORY_FLOW_LIMITS = {'all': 500, 'inbound': 200, 'outbound': 200}
+
+def generate_story_flows(moments, flow_cube, centroids):
+    """Ready-to-draw flows for every story moment that has a flowFilter.
+
+    Returns {moment id: flow set}, each a self-contained
+    {trips, ntas, centroids, f, t, c}: trips is the exact total matching the
+    filter, and f/t index into the set's own ntas and centroids.
+    """
+    print("Generating story moment flows...")
+
+    ntacodes = flow_cube.ntacodes
+    n = len(ntacodes)
+    has_centroid = np.array([ntacode in centroids for ntacode in ntacodes], dtype=bool)
+
+    flow_sets = {}
+    for moment in moments:
+        flow_filter = moment.get('flowFilter')
+        if not flow_filter:
+            continue
+        counts = flow_cube.query(flow_filter['hours'], flow_filter['days'],
+                                 flow_filter.get('fromPrefixes'), flow_filter.get('toPrefixes'))
+        counts[np.arange(n), np.arange(n)] = 0
+        counts[~has_centroid] = 0
+        counts[:, ~has_centroid] = 0
+
+        # Strongest pairs first; ties keep origin/destination order
+        flat = counts.ravel()
+        candidates = np.flatnonzero(flat)
+        order = np.argsort(-flat[candidates], kind='stable')[:STORY_FLOW_LIMITS[flow_filter['direction']]]
+        from_nta, to_nta = np.unravel_index(candidates[order], counts.shape)
+
+        used = sorted(set(from_nta.tolist()) | set(to_nta.tolist()))
+        index = {nta: i for i, nta in enumerate(used)}
+        flow_sets[moment['id']] = {
+            'trips': int(counts.sum()),
+            'ntas': [ntacodes[nta] for nta in used],
+            'centroids': [round_coord(centroids[ntacodes[nta]]) for nta in used],
+            'f': [index[nta] for nta in from_nta.tolist()],
+            't': [index[nta] for nta in to_nta.tolist()],
+            'c': flat[candidates[order]].tolist()
+        }
+        print(f"  {moment['id']}: {len(order):,} flows, {flow_sets[moment['id']]['trips']:,} trips")
+    return flow_sets
+
+def save_story_flows(out, flow_sets):
+    """Write each moment's content-addressed flow set and return {moment id: {file, sha256, trips}}."""
+    refs, sizes = {}, []
+    for moment_id, flow_set in flow_sets.items():
+        entry = save_json(out, flow_set, f"{STORY_FLOW_DIR}/{moment_id}.json", hashed=True)
+        sizes.append(entry['bytes'])
+        refs[moment_id] = {'file': entry['file'], 'sha256': entry['sha256'], 'trips': flow_set['trips']}
+
+    if sizes:
+        print(f"  {len(refs)} story flow sets in {STORY_FLOW_DIR}/ (largest {max(sizes) / 1024:.1f} KB)")
+    return refs
+
+# --sample runs read and write everything under CACHE_DIR/preview/ (outputs,
+# sample-errors.json and their own stage cache), so a preview never replaces
+# the published data or evicts the full run's memoized stages.
+PREVIEW_DIR_NAME = "preview"
+# Estimates with a larger relative standard error are reported as noisy
+NOISY_RSE = 0.1
+
+def sample_scale(fraction):
+    """Keep one trip in this many for a --sample fraction."""
+    return max(1, round(1 / fraction))
+
+def relative_standard_error(counts, scale):
+    """Relative standard error of counts scaled up from a 1-in-scale sample.
+
+    A count N estimated as scale * Binomial(N, 1 / scale) has variance
+    N * (scale - 1), so rse = sqrt((scale - 1) / N). Stratifying only lowers
+    it, so this is an upper bound. Zero counts give None.
+    """
+    counts = np.asarray(counts, dtype=float)
+    with np.errstate(divide='ignore'):
+        errors = np.sqrt((scale - 1) / counts)
+    return [round(float(error), 4) if np.isfinite(error) else None for error in errors]
+
+def generate_sample_errors(flow_data, patterns, summary, scale):
+    """Relative standard error of every aggregate behind the outputs.
+
+    Each flow is trusted when the low end of its 95% interval still clears
+    MIN_FLOW_TRIPS, so it would survive the cutoff on the full data.
+    Neighborhoods list the error of their total trips and, in hourlyRse,
+    of every cell of their weekly pattern: departures and arrivals, each as
+    7 days of 24 hours like weekly-patterns.json (None where the sample has
+    no trips).
+    """
+    print("Estimating sampling errors...")
+
+    flows = flow_data['flows']
+    flow_rse = relative_standard_error([flow['c'] for flow in flows], scale)
+    trusted = [error is not None and flow['c'] * (1 - 1.96 * error) >= MIN_FLOW_TRIPS
+               for flow, error in zip(flows, flow_rse)]
+    top_flows = flow_data['topFlows']
+    top_rse = relative_standard_error([flow['c'] for flow in top_flows], scale)
+
+    totals = patterns.counts[..., [PatternCube.DEPARTURES, PatternCube.ARRIVALS]].sum(axis=(1, 2, 3))
+    slots = patterns.counts.shape[:3]
+    hourly_rse = {
+        name: np.array(relative_standard_error(patterns.counts[..., measure].ravel(), scale),
+                       dtype=object).reshape(slots).tolist()
+        for name, measure in (('departures', PatternCube.DEPARTURES), ('arrivals', PatternCube.ARRIVALS))
+    }
+    neighborhoods = {
+        ntacode: {'trips': int(total), 'rse': total_rse,
+                  'hourlyRse': {name: errors[i] for name, errors in hourly_rse.items()}}
+        for i, (ntacode, total, total_rse) in enumerate(zip(
+            patterns.ntacodes, totals, relative_standard_error(totals, scale)))
+    }
+
+    noisy = sum(error is None or error > NOISY_RSE for error in flow_rse)
+    print(f"  {noisy:,} of {len(flows):,} flows have a relative error above {NOISY_RSE:.0%}; "
+          f"{len(flows) - sum(trusted):,} may not clear the {MIN_FLOW_TRIPS}-trip cutoff")
+
+    return {
+        'scale': scale,
+        'trips': {'estimate': int(summary.total_trips),
+                  'rse': relative_standard_error([summary.total_trips], scale)[0]},
+        'noisyFlows': noisy,
+        'untrustedFlows': len(flows) - sum(trusted),
+        'flows': [
+            {'f': flow['f'], 't': flow['t'], 'd': flow['d'], 'p': flow['p'], 'c': flow['c'],
+             'rse': error, 'trusted': ok}
+            for flow, error, ok in zip(flows, flow_rse, trusted)
+        ],
+        'topFlows': [
+            {'f': flow['f'], 't': flow['t'], 'c': flow['c'], 'rse': error}
+            for flow, error in zip(top_flows, top_rse)
+        ],
+        'neighborhoods': neighborhoods
+    }
+
+def generate_metadata(aggregates):
+    """Generate metadata file.
+
+    Only depends on the data, so rebuilding unchanged data leaves it unchanged.
+    """
+    member_pct = aggregates.member_pct
     return {
         "dataYear": 2025,
-        "totalTrips": int(len(trips)),
-        "totalStations": int(trips['start_station_id'].nunique()),
+        "totalTrips": int(aggregates.total_trips),
+        "totalStations": int(aggregates.total_stations),
         "memberPct": round(member_pct, 1),
         "casualPct": round(100 - member_pct, 1),
         "dateRange": {
-            "start": trips['started_at'].min().strftime('%Y-%m-%d'),
-            "end": trips['started_at'].max().strftime('%Y-%m-%d')
-        },
-        "generatedAt": datetime.now().isoformat()
+            "start": aggregates.first_start.strftime('%Y-%m-%d'),
+            "end": aggregates.last_start.strftime('%Y-%m-%d')
+        }
     }
 
-def save_json(data, filename):
-    """Save data to JSON file."""
-    output_path = OUTPUT_DIR / filename
-    with open(output_path, 'w') as f:
-        json.dump(data, f, separators=(',', ':'))
-    size_kb = output_path.stat().st_size / 1024
-    print(f"  Saved {filename} ({size_kb:.1f} KB)")
+# Flow bundles are written to this subdirectory of the output directory. Bump
+# FLOW_BUNDLES_VERSION (and its twin in lib/citibike.ts) when the layout changes.
+FLOW_BUNDLE_DIR = "flows"
+FLOW_BUNDLES_VERSION = 1
 
-def main():
-    print("=" * 60)
-    print("NYC Bike Rhythms Data Processing")
-    print("=" * 60)
+def flow_bundle_key(day_type, period):
+    return f"{day_type}/{period}"
 
-    # Ensure output directory exists
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+def flow_bundle_file(key):
+    return f"{FLOW_BUNDLE_DIR}/{key.replace('/', '-')}.json"
 
-    # Load data
-    trips = load_and_process_trips()
-    trips = parse_datetime(trips)
-    nta = load_neighborhoods()
+# Every bundle generate_flow_bundles writes, in manifest order
+FLOW_BUNDLE_KEYS = ['centroids', 'top'] + [flow_bundle_key(day_type, period)
+                                           for day_type in DAY_TYPES for period in TIME_PERIODS]
 
-    # Process
-    station_mapping = create_station_to_nta_mapping(trips, nta)
-    centroids = calculate_centroids(nta)
-    patterns, trips_with_nta = aggregate_by_neighborhood(trips, station_mapping)
+def generate_flow_bundles(flow_data):
+    """Split flow data into small bundles that the page can fetch on demand.
 
-    # Generate outputs
-    print("\nGenerating output files...")
+    Returns {key: bundle}:
+        centroids                shared {ntas, centroids} table that flows index into
+        top                      top flows as {f, t, c} parallel arrays
+        <day type>/<period>      flows for one day type and time period, {f, t, c}
+    """
+    compact = encode_flows_compact(flow_data)
+    flows = compact['flows']
 
-    weekly = generate_weekly_patterns(patterns)
-    save_json(weekly, 'weekly-patterns.json')
+    bundles = {
+        'centroids': {'ntas': compact['ntas'], 'centroids': compact['centroids']},
+        'top': compact['topFlows']
+    }
+    for d, day_type in enumerate(DAY_TYPES):
+        for p, period in enumerate(TIME_PERIODS):
+            rows = [i for i, (flow_d, flow_p) in enumerate(zip(flows['d'], flows['p']))
+                    if flow_d == d and flow_p == p]
+            bundles[flow_bundle_key(day_type, period)] = {
+                'f': [flows['f'][i] for i in rows],
+                't': [flows['t'][i] for i in rows],
+                'c': [flows['c'][i] for i in rows]
+            }
+    return bundles
+
+def save_flow_bundles(out, bundles):
+    """Write content-addressed flow bundles plus a manifest of each bundle's file, size and hash."""
+    entries = [{'key': key, **save_json(out, bundle, flow_bundle_file(key), hashed=True)}
+               for key, bundle in bundles.items()]
+
+    largest = max(entry['bytes'] for entry in entries) / 1024
+    print(f"  {len(entries)} flow bundles in {FLOW_BUNDLE_DIR}/ (largest {largest:.1f} KB)")
+    save_json(out, {'version': FLOW_BUNDLES_VERSION, 'bundles': entries}, f"{FLOW_BUNDLE_DIR}/manifest.json",
+              hashed=True)
+
+# Every run writes run-report.json next to its outputs; --profile adds cProfile stats
+# per stage under CACHE_DIR/profiles.
+RUN_REPORT_VERSION = 1
+
+def _proc_status_mb(field):
+    """A memory field from /proc/self/status in MB, or None off Linux."""
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter; returns False where that isn't possible."""
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak RSS since the last reset_peak_rss() (or process start) in MB."""
+    peak = _proc_status_mb('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return peak
+
+def current_rss_mb():
+    return _proc_status_mb('VmRSS')
+
+def frame_mb(frame):
+    """In-memory size of a DataFrame, including the strings in object columns."""
+    return frame.memory_usage(deep=True).sum() / 1024 ** 2
+
+def _cpu_seconds():
+    # Includes finished worker processes, so --workers runs are fully counted
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class RunReport:
+    """Wall time, CPU time, peak RSS and row counts for each pipeline stage.
+
+    Wrap each stage in `with report.stage(name, rows_in=...) as stage:` and
+    set stage['rowsOut'] / stage['frameMb'] inside the block. With a
+    profile_dir, every stage is also run under cProfile and its stats are
+    written there as <stage>.prof plus a readable <stage>.txt summary.
+    """
+
+    def __init__(self, args=None, profile_dir=None):
+        self.args = vars(args) if args is not None else {}
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.generated_at = datetime.now().isoformat()
+        self._started = time.perf_counter()
+        self._cpu_started = _cpu_seconds()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = {'stage': name}
+        if rows_in is not None:
+            record['rowsIn'] = int(rows_in)
+
+        per_stage_peak = reset_peak_rss()
+        profiler = cProfile.Profile() if self.profile_dir else None
+        wall, cpu = time.perf_counter(), _cpu_seconds()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+            record['wallSeconds'] = round(time.perf_counter() - wall, 3)
+            record['cpuSeconds'] = round(_cpu_seconds() - cpu, 3)
+            record['peakRssMb'] = round(peak_rss_mb(), 1)
+            record['peakRssPerStage'] = per_stage_peak
+            if 'frameMb' in record:
+                record['frameMb'] = round(record['frameMb'], 1)
+            if profiler:
+                record['profile'] = self._save_profile(name, profiler)
+            self.stages.append(record)
+
+    def skip(self, name, reason):
+        self.stages.append({'stage': name, 'skipped': reason})
+
+    def _save_profile(self, name, profiler):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        path = self.profile_dir / f"{name}.prof"
+        profiler.dump_stats(path)
+        with open(path.with_suffix('.txt'), 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(30)
+        return str(path)
+
+    def to_dict(self):
+        return {
+            'version': RUN_REPORT_VERSION,
+            'generatedAt': self.generated_at,
+            'args': self.args,
+            'wallSeconds': round(time.perf_counter() - self._started, 3),
+            'cpuSeconds': round(_cpu_seconds() - self._cpu_started, 3),
+            'stages': self.stages,
+        }
 
-    neighborhoods = generate_neighborhoods_geojson(nta, patterns)
-    save_json(neighborhoods, 'neighborhoods.json')
+    def print_summary(self):
+        print("\nStage timings:")
+        for stage in self.stages:
+            if 'skipped' in stage:
+                print(f"  {stage['stage']:32s} {stage['skipped']}")
+                continue
+            rows = f"{stage['rowsOut']:>12,} rows" if 'rowsOut' in stage else ' ' * 17
+            if stage.get('cached'):
+                rows += " (cached)"
+            print(f"  {stage['stage']:32s} {stage['wallSeconds']:8.2f}s wall {stage['cpuSeconds']:8.2f}s cpu "
+                  f"{stage['peakRssMb']:8.0f} MB peak {rows}")
+
+# Every output is listed in <output dir>/manifest.json under its logical name
+# ("flows/top.json") with the file that holds it, its size and SHA-256. Files
+# the site fetches at runtime are content-addressed ("flows/top.<hash>.json"),
+# so they can be served as immutable; the rest keep their plain names. Outputs
+# are only rewritten when their bytes change, so an unchanged rebuild leaves
+# every file, its mtime and any CDN copy alone.
+OUTPUT_MANIFEST = "manifest.json"
+OUTPUT_MANIFEST_VERSION = 1
+CONTENT_HASH_LEN = 12
+
+class OutputDir:
+    """A directory the pipeline writes outputs to, and what this run saved there.
+
+    written maps each output's logical name to the manifest entry written
+    by this run; saved lists every file saved (written or found unchanged),
+    relative to path.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.written = {}
+        self.saved = []
+
+def encode_json(data):
+    """Serialize compactly; the same data always gives the same bytes."""
+    return json.dumps(data, separators=(',', ':'), allow_nan=False).encode()
+
+def write_if_changed(path, content):
+    """Write content to path unless the file already holds exactly these bytes."""
+    if path.exists() and path.stat().st_size == len(content) and path.read_bytes() == content:
+        return False
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(content)
+    tmp_path.replace(path)
+    return True
+
+def content_addressed_name(filename, content):
+    """"flows/top.json" -> "flows/top.<first 12 hex digits of its SHA-256>.json"."""
+    path = Path(filename)
+    digest = hashlib.sha256(content).hexdigest()[:CONTENT_HASH_LEN]
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}"))
+
+def _remove_stale_versions(directory, filename, current):
+    """Delete earlier content-addressed copies of filename in directory (and their .gz/.br)."""
+    path = directory / filename
+    pattern = re.compile(rf"{re.escape(path.stem)}\.[0-9a-f]{{{CONTENT_HASH_LEN}}}"
+                         rf"{re.escape(path.suffix)}(\.gz|\.br)?")
+    keep = Path(current).name
+    for stale in path.parent.glob(f"{path.stem}.*"):
+        if pattern.fullmatch(stale.name) and stale.name not in (keep, f"{keep}.gz", f"{keep}.br"):
+            stale.unlink()
+
+def save_output(out, content, filename, precompress=False, hashed=False, listed=True):
+    """Write one output file to the OutputDir out and return its manifest entry.
+
+    hashed=True stores it under its content-addressed name and removes older
+    versions. Unchanged files are not rewritten. precompress adds .gz/.br
+    siblings for static hosting; listed=False keeps it out of the manifest.
+    """
+    target = content_addressed_name(filename, content) if hashed else filename
+    output_path = out.path / target
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if write_if_changed(output_path, content):
+        print(f"  Saved {target} ({len(content) / 1024:.1f} KB)")
+    else:
+        print(f"  Unchanged {target}")
+    saved = [output_path] + (save_precompressed(output_path) if precompress else [])
+    out.saved.extend(path.relative_to(out.path).as_posix() for path in saved)
+    if hashed:
+        _remove_stale_versions(out.path, filename, target)
+
+    entry = {'file': target, 'bytes': len(content), 'sha256': hashlib.sha256(content).hexdigest()}
+    if listed:
+        out.written[filename] = entry
+    return entry
+
+def save_json(out, data, filename, precompress=False, hashed=False, listed=True):
+    """Save data as compact JSON (see save_output) and return its manifest entry."""
+    return save_output(out, encode_json(data), filename, precompress, hashed, listed)
+
+def save_precompressed(path):
+    """Write gzip and (if the brotli package is installed) brotli copies of a file.
+
+    Copies newer than the file are kept, since it hasn't been rewritten since.
+    Returns the paths of the copies.
+    """
+    targets = {suffix: path.with_name(path.name + suffix) for suffix in ('.gz', '.br')}
+    stale = [suffix for suffix, target in targets.items()
+             if not target.exists() or target.stat().st_mtime_ns < path.stat().st_mtime_ns]
+    if not stale:
+        return list(targets.values())
+
+    content = path.read_bytes()
+    compressed = {}
+    if '.gz' in stale:
+        compressed['.gz'] = gzip.compress(content, compresslevel=9, mtime=0)
+    if '.br' in stale:
+        try:
+            import brotli
+            compressed['.br'] = brotli.compress(content, quality=11)
+        except ImportError:
+            print("    (brotli not installed, skipping .br)")
+
+    for suffix, data in compressed.items():
+        targets[suffix].write_bytes(data)
+        print(f"    {targets[suffix].name} ({len(data) / 1024:.1f} KB)")
+    return [target for target in targets.values() if target.exists()]
+
+def output_manifest(out):
+    """Manifest entries of every output on disk in out, including this run's writes."""
+    path = out.path / OUTPUT_MANIFEST
+    files = json.loads(path.read_text())['files'] if path.exists() else {}
+    files.update(out.written)
+    return {name: entry for name, entry in sorted(files.items()) if (out.path / entry['file']).exists()}
+
+def save_output_manifest(out):
+    """Write manifest.json; outputs skipped this run keep their earlier entries."""
+    save_output(out, encode_json({'version': OUTPUT_MANIFEST_VERSION, 'files': output_manifest(out)}),
+                OUTPUT_MANIFEST, listed=False)
+
+def publish_outputs(out, public_dir):
+    """Copy manifest.json and the content-addressed outputs the site fetches to public_dir.
+
+    The manifest is copied byte for byte, so both directories always list
+    the same outputs. Earlier versions of the copied files are removed.
+    """
+    manifest = (out.path / OUTPUT_MANIFEST).read_bytes()
+    published = 0
+    for name, entry in json.loads(manifest)['files'].items():
+        if entry['file'] == name:
+            continue  # only content-addressed files are fetched at runtime
+        path = public_dir / entry['file']
+        path.parent.mkdir(parents=True, exist_ok=True)
+        published += write_if_changed(path, (out.path / entry['file']).read_bytes())
+        _remove_stale_versions(public_dir, name, entry['file'])
+    public_dir.mkdir(parents=True, exist_ok=True)
+    write_if_changed(public_dir / OUTPUT_MANIFEST, manifest)
+    print(f"  Published to {public_dir} ({published} files updated)")
+
+# The pipeline as a graph of stages. Each stage lists the stages it reads; the
+# code its result depends on is found by following the names its function
+# uses. Results are memoized under CACHE_DIR/stages, keyed by a hash of that
+# code, the stage's external inputs and the keys of the stages it reads.
+# Editing one output generator therefore re-runs only that generator. Bump
+# STAGE_CACHE_VERSION to drop every memo.
+STAGE_CACHE_VERSION = 2
+
+class PipelineStage:
+    """One node of the stage graph.
+
+    run(graph, *dep_values) computes the stage. Stages with outputs are the
+    leaves: they write those files to graph.out and are skipped while their
+    key is unchanged and every file they wrote last time is still there.
+    Every other stage returns a value that is pickled to the stage cache,
+    unless memoize=False. A stage whose value class is given as `persist` is
+    instead stored with value.save(directory) and read back with
+    persist.load(directory).
+    """
+
+    def __init__(self, name, run, deps=(), inputs=None, outputs=(), memoize=True, persist=None):
+        self.name = name
+        self.run = run
+        self.deps = deps
+        self.code = tuple(root for root in (run, persist) if root is not None)
+        self.inputs = inputs
+        self.outputs = outputs
+        self.memoize = memoize
+        self.persist = persist
+
+def _referenced_names(code):
+    """Names a code object and the functions and comprehensions nested in it look up."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _referenced_names(const)
+    return names
+
+def _code_name(item):
+    """Script and qualified name of a pipeline function or class, or None for library code."""
+    try:
+        path = Path(inspect.getsourcefile(item)).resolve()
+    except TypeError:
+        return None
+    return f"{path.stem}.{item.__qualname__}" if path.parent == SCRIPT_DIR.resolve() else None
+
+def _code_in(value):
+    """Functions and classes held by a constant, e.g. the engine classes in ENGINES."""
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [item for member in value for item in _code_in(member)]
+    return [value] if inspect.isfunction(value) or inspect.isclass(value) else []
+
+def stage_code(roots):
+    """The functions, classes and constants of these scripts that roots depend on.
+
+    Functions are followed through the global names their code uses, classes
+    through their methods and base classes, and constants through any code
+    they hold. Constants are the UPPER_CASE globals other than paths, which
+    are inputs rather than code. Returns ({name: function or class},
+    {name: constant value}).
+    """
+    code, constants = {}, {}
+    pending = list(roots)
+    while pending:
+        item = pending.pop()
+        if not (inspect.isfunction(item) or inspect.isclass(item)):
+            continue
+        name = _code_name(item)
+        if name is None or name in code:
+            continue
+        code[name] = item
+
+        if inspect.isclass(item):
+            pending.extend(item.__bases__)
+            for member in vars(item).values():
+                if isinstance(member, property):
+                    pending.extend([member.fget, member.fset, member.fdel])
+                else:
+                    pending.append(getattr(member, '__func__', member))  # unwrap static/class methods
+            continue
+
+        script = name.split('.')[0]
+        for global_name in _referenced_names(item.__code__):
+            if global_name not in item.__globals__:
+                continue
+            value = item.__globals__[global_name]
+            if global_name.isupper() and not isinstance(value, Path):
+                constants[f"{script}.{global_name}"] = value
+                pending.extend(_code_in(value))
+            else:
+                pending.append(value)
+    return code, constants
+
+def _constant_repr(value):
+    """repr() that is the same in every process: code by name, arrays by value."""
+    if inspect.isfunction(value) or inspect.isclass(value):
+        return _code_name(value) or f"{value.__module__}.{value.__qualname__}"
+    if isinstance(value, np.ndarray):
+        return repr(value.tolist())
+    if isinstance(value, dict):
+        return '{' + ', '.join(f"{_constant_repr(k)}: {_constant_repr(v)}" for k, v in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}({', '.join(_constant_repr(member) for member in value)})"
+    return repr(value)
+
+_sources = {}
+
+def _code_fingerprint(roots):
+    """Hash the source and default arguments of the code roots depend on, and its constants."""
+    code, constants = stage_code(roots)
+    digest = hashlib.sha256()
+    for name in sorted(code):
+        item = code[name]
+        if item not in _sources:
+            _sources[item] = inspect.getsource(item)
+        digest.update(f"{name}\n{_sources[item]}".encode())
+        if inspect.isfunction(item):
+            digest.update(_constant_repr((item.__defaults__, item.__kwdefaults__)).encode())
+    for name in sorted(constants):
+        digest.update(f"{name} = {_constant_repr(constants[name])}\n".encode())
+    return digest.hexdigest()
+
+class StageGraph:
+    """Runs the stages needed for the requested outputs, reusing memoized results."""
+
+    def __init__(self, stages, args, report, out, force=False, cache_dir=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.args = args
+        self.report = report
+        self.out = out
+        self.force = force
+        self.cache_dir = cache_dir or CACHE_DIR / "stages"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.state_path = self.cache_dir / f"outputs-v{STAGE_CACHE_VERSION}.json"
+        self.state = json.loads(self.state_path.read_text()) if self.state_path.exists() else {}
+        self._keys = {}
+        self._values = {}
+
+    def key(self, name):
+        """Content key of a stage, derived from its code, inputs and dependencies."""
+        if name not in self._keys:
+            stage = self.stages[name]
+            payload = {
+                'version': STAGE_CACHE_VERSION,
+                'stage': name,
+                'code': _code_fingerprint(stage.code),
+                'inputs': stage.inputs(self) if stage.inputs else None,
+                'deps': {dep: self.key(dep) for dep in stage.deps}
+            }
+            self._keys[name] = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        return self._keys[name]
+
+    def value(self, name):
+        """Result of a stage: from memory, from the stage cache, or computed."""
+        if name in self._values:
+            return self._values[name]
+
+        stage = self.stages[name]
+        path = self.cache_dir / f"{name}-{self.key(name)[:16]}{'' if stage.persist else '.pkl'}"
+        if stage.memoize and path.exists() and not self.force:
+            with self.report.stage(name) as record:
+                if stage.persist:
+                    value = stage.persist.load(path)
+                else:
+                    with open(path, 'rb') as f:
+                        value = pickle.load(f)
+                record['cached'] = True
+        else:
+            value = stage.run(self, *[self.value(dep) for dep in stage.deps])
+            if stage.memoize:
+                tmp_path = path.with_suffix('.tmp')
+                if stage.persist:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    value.save(tmp_path)
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    with open(tmp_path, 'wb') as f:
+                        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                tmp_path.replace(path)
+                for stale in self.cache_dir.glob(f"{name}-*{'' if stage.persist else '.pkl'}"):
+                    if stale == path:
+                        continue
+                    if stale.is_dir():
+                        shutil.rmtree(stale)
+                    else:
+                        stale.unlink()
+
+        self._values[name] = value
+        return value
+
+    def build(self, name):
+        """Write an output stage's files unless they are already up to date.
+
+        A stage is up to date while its key is unchanged, its outputs are in
+        the manifest and every file it saved last time (bundles, story flow
+        sets, compressed copies) is still on disk.
+        """
+        stage = self.stages[name]
+        key = self.key(name)
+        built = self.state.get(name, {})
+        if (not self.force and built.get('key') == key
+                and set(stage.outputs) <= output_manifest(self.out).keys()
+                and all((self.out.path / file).exists() for file in built['files'])):
+            print(f"  {name}: up to date")
+            self.report.skip(name, 'up to date')
+            return
+
+        first_file = len(self.out.saved)
+        stage.run(self, *[self.value(dep) for dep in stage.deps])
+        self.state[name] = {'key': key, 'files': sorted(set(self.out.saved[first_file:]))}
+        self.state_path.write_text(json.dumps(self.state, indent=2))
+
+def _zip_fingerprints(graph):
+    """Content hashes of the raw zips, reusing hashes while size and mtime match."""
+    memo_path = graph.cache_dir / "zips.json"
+    memo = json.loads(memo_path.read_text()) if memo_path.exists() else {}
+    fingerprints = {}
+    for zip_path in sorted(RAW_DIR.glob("*.zip")):
+        stat = zip_path.stat()
+        digest = zip_digest(zip_path, memo.get(zip_path.name))
+        fingerprints[zip_path.name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+    if fingerprints != memo:
+        memo_path.write_text(json.dumps(fingerprints, indent=2))
+    return {name: entry['sha256'] for name, entry in fingerprints.items()}
+
+def _trip_inputs(graph):
+    fingerprints = _zip_fingerprints(graph)
+    if graph.args.sample:
+        return {'zips': fingerprints, 'sample': [sample_scale(graph.args.sample), graph.args.seed]}
+    return fingerprints
+
+def _output_dir_input(graph):
+    return str(graph.out.path)
+
+def _run_trips(graph):
+    args, report = graph.args, graph.report
+    partitions = None
+    # Samples are drawn from the cache, whose columns can be read separately
+    if args.cache or args.sample:
+        with report.stage('build_trip_cache') as stage:
+            partitions = build_trip_cache()
+            stage['rowsOut'] = len(partitions)
+
+    if args.sample:
+        with report.stage('sample_trip_aggregates') as stage:
+            aggregates = sample_trip_aggregates(partitions, sample_scale(args.sample), args.seed,
+                                                args.chunk_size)
+            stage['rowsOut'] = aggregates.total_trips
+        return aggregates
+
+    return ENGINES[args.engine](args).trip_aggregates(report, partitions)
+
+def _run_summary(graph, aggregates):
+    return TripSummary(aggregates)
+
+def _run_nta(graph):
+    with graph.report.stage('load_neighborhoods') as stage:
+        nta = load_neighborhoods()
+        stage['rowsOut'] = len(nta)
+    return nta
+
+def _run_station_mapping(graph, aggregates, nta):
+    with graph.report.stage('create_station_to_nta_mapping') as stage:
+        stations = aggregates.stations()
+        stage['rowsIn'] = len(stations)
+        station_mapping = create_station_to_nta_mapping(stations, nta)
+        stage['rowsOut'] = len(station_mapping)
+    return station_mapping
+
+def _run_centroids(graph, nta):
+    with graph.report.stage('calculate_centroids', rows_in=len(nta)) as stage:
+        centroids = calculate_centroids(nta)
+        stage['rowsOut'] = len(centroids)
+    return centroids
 
-    flows = generate_flows(trips_with_nta, centroids)
-    save_json(flows, 'flows.json')
+def _run_neighborhood_trips(graph, aggregates, station_mapping):
+    with graph.report.stage('aggregate_by_neighborhood', rows_in=aggregates.total_trips) as stage:
+        patterns, flow_cube = aggregate_by_neighborhood(aggregates, station_mapping)
+        stage['rowsOut'] = len(flow_cube)
+        stage['frameMb'] = round(flow_cube.nbytes / 2**20, 1)
+    return patterns, flow_cube
+
+def _run_station_patterns(graph, aggregates):
+    with graph.report.stage('aggregate_by_station', rows_in=aggregates.total_trips) as stage:
+        station_patterns = aggregate_by_station(aggregates)
+        stage['rowsOut'] = len(station_patterns.ntacodes)
+    return station_patterns
+
+def _run_stations(graph, aggregates):
+    return aggregates.stations()
+
+def _run_patterns(graph, neighborhood_trips):
+    return neighborhood_trips[0]
+
+def _run_flow_cube(graph, neighborhood_trips):
+    return neighborhood_trips[1]
+
+def _write_weekly_patterns(graph, patterns):
+    with graph.report.stage('generate_weekly_patterns') as stage:
+        weekly = generate_weekly_patterns(patterns)
+        save_json(graph.out, weekly, 'weekly-patterns.json')
+        stage['rowsOut'] = len(weekly)
+
+def _write_neighborhoods(graph, nta, patterns):
+    with graph.report.stage('generate_neighborhoods_geojson', rows_in=len(nta)) as stage:
+        neighborhoods = generate_neighborhoods_geojson(nta, patterns)
+        save_json(graph.out, neighborhoods, 'neighborhoods.json')
+        save_neighborhood_topologies(graph.out, generate_neighborhood_topologies(nta, patterns))
+        stage['rowsOut'] = len(neighborhoods['features'])
+
+def _write_station_imbalance(graph, station_patterns, stations, station_mapping):
+    with graph.report.stage('generate_station_imbalance', rows_in=len(station_patterns.ntacodes)) as stage:
+        imbalance = generate_station_imbalance(station_patterns, stations, station_mapping)
+        save_json(graph.out, imbalance, 'station-imbalance.json', precompress=True)
+        stage['rowsOut'] = len(imbalance['stations'])
+
+def _write_trip_distributions(graph, aggregates, station_mapping):
+    with graph.report.stage('generate_trip_distributions') as stage:
+        distributions = generate_trip_distributions(aggregates, station_mapping)
+        save_json(graph.out, distributions, 'trip-distributions.json', precompress=True)
+        stage['rowsOut'] = len(distributions['ntas'])
+
+def _write_flows(graph, flow_cube, centroids):
+    with graph.report.stage('generate_flows', rows_in=len(flow_cube)) as stage:
+        flows = generate_flows(flow_cube, centroids)
+        save_flow_bundles(graph.out, generate_flow_bundles(flows))
+        stage['rowsOut'] = len(flows['flows'])
+
+def _write_story_moments(graph, flow_cube, summary, centroids):
+    with graph.report.stage('generate_story_moments', rows_in=len(flow_cube)) as stage:
+        moments = generate_story_moments(flow_cube, summary)
+        flow_refs = save_story_flows(graph.out, generate_story_flows(moments, flow_cube, centroids))
+        for moment in moments:
+            if moment['id'] in flow_refs:
+                moment['flowSet'] = flow_refs[moment['id']]
+        save_json(graph.out, moments, 'story-moments.json')
+        stage['rowsOut'] = len(moments)
+
+def _write_sample_errors(graph, flow_cube, centroids, patterns, summary):
+    with graph.report.stage('generate_sample_errors') as stage:
+        flows = generate_flows(flow_cube, centroids)
+        errors = generate_sample_errors(flows, patterns, summary, sample_scale(graph.args.sample))
+        save_json(graph.out, errors, 'sample-errors.json')
+        stage['rowsOut'] = len(errors['flows'])
+
+def _write_metadata(graph, summary):
+    with graph.report.stage('generate_metadata'):
+        save_json(graph.out, generate_metadata(summary), 'metadata.json')
+
+PIPELINE_STAGES = [
+    PipelineStage('trips', _run_trips, inputs=_trip_inputs),
+    PipelineStage('summary', _run_summary, deps=('trips',)),
+    PipelineStage('nta', _run_nta, inputs=lambda graph: file_sha256(NTA_FILE)),
+    PipelineStage('station_mapping', _run_station_mapping, deps=('trips', 'nta')),
+    PipelineStage('centroids', _run_centroids, deps=('nta',)),
+    PipelineStage('neighborhood_trips', _run_neighborhood_trips, deps=('trips', 'station_mapping'), memoize=False),
+    PipelineStage('patterns', _run_patterns, deps=('neighborhood_trips',)),
+    PipelineStage('station_patterns', _run_station_patterns, deps=('trips',)),
+    PipelineStage('stations', _run_stations, deps=('trips',)),
+    PipelineStage('flow_cube', _run_flow_cube, deps=('neighborhood_trips',), persist=FlowCube),
+    PipelineStage('weekly-patterns', _write_weekly_patterns, deps=('patterns',),
+                  inputs=_output_dir_input, outputs=('weekly-patterns.json',)),
+    PipelineStage('neighborhoods', _write_neighborhoods, deps=('nta', 'patterns'), inputs=_output_dir_input,
+                  outputs=('neighborhoods.json', *(f"{NEIGHBORHOOD_TOPOLOGY_DIR}/{lod}.json"
+                                                  for lod in NEIGHBORHOOD_LODS))),
+    PipelineStage('station-imbalance', _write_station_imbalance,
+                  deps=('station_patterns', 'stations', 'station_mapping'),
+                  inputs=_output_dir_input, outputs=('station-imbalance.json',)),
+    PipelineStage('trip-distributions', _write_trip_distributions, deps=('trips', 'station_mapping'),
+                  inputs=_output_dir_input, outputs=('trip-distributions.json',)),
+    PipelineStage('flows', _write_flows, deps=('flow_cube', 'centroids'), inputs=_output_dir_input,
+                  outputs=(f"{FLOW_BUNDLE_DIR}/manifest.json", *(flow_bundle_file(key) for key in FLOW_BUNDLE_KEYS))),
+    # One story-flows/<id>.json per moment with a flowFilter, recorded when written
+    PipelineStage('story-moments', _write_story_moments, deps=('flow_cube', 'summary', 'centroids'),
+                  inputs=_output_dir_input, outputs=('story-moments.json',)),
+    PipelineStage('sample-errors', _write_sample_errors, deps=('flow_cube', 'centroids', 'patterns', 'summary'),
+                  inputs=_output_dir_input, outputs=('sample-errors.json',)),
+    PipelineStage('metadata', _write_metadata, deps=('summary',),
+                  inputs=_output_dir_input, outputs=('metadata.json',)),
+]
+
+OUTPUT_STAGES = [stage.name for stage in PIPELINE_STAGES if stage.outputs]
+# Outputs that only exist for --sample runs
+SAMPLE_OUTPUT_STAGES = ['sample-errors']
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process Citi Bike trip data for NYC Bike Rhythms.")
+    parser.add_argument('--stream', action='store_true',
+                        help="read trips in chunks instead of loading the full year into memory")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"rows per chunk in streaming mode (default: {DEFAULT_CHUNK_SIZE:,})")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="aggregate zip members in parallel with this many processes")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only aggregate new or changed zips, reusing saved monthly partitions")
+    parser.add_argument('--cache', action='store_true',
+                        help=f"convert the zips into a Parquet cache under {CACHE_DIR.name}/ and read from it")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='pandas',
+                        help="engine that aggregates the trips; duckdb is multi-threaded and "
+                             "spills to disk, store decodes once into memory-mapped columns "
+                             f"under {CACHE_DIR.name}/store/ shared by --workers (default: pandas)")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"run each stage under cProfile and save the stats to {CACHE_DIR.name}/profiles/")
+    parser.add_argument('--only', nargs='+', choices=OUTPUT_STAGES, metavar='OUTPUT',
+                        help=f"only rebuild these outputs ({', '.join(OUTPUT_STAGES)})")
+    parser.add_argument('--force', action='store_true',
+                        help="ignore memoized stage results and rebuild everything requested")
+    parser.add_argument('--sample', type=float, metavar='FRACTION',
+                        help=f"preview from a stratified sample of about this fraction of the trips, "
+                             f"drawn from the --cache Parquet files (built if needed) and "
+                             f"written to {CACHE_DIR.name}/{PREVIEW_DIR_NAME}/ with sample-errors.json")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed that picks the --sample trips (default: 0)")
+    args = parser.parse_args(argv)
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error("--sample must be a fraction in (0, 1]")
+    if not args.sample and set(args.only or ()) & set(SAMPLE_OUTPUT_STAGES):
+        parser.error(f"{', '.join(SAMPLE_OUTPUT_STAGES)} can only be built with --sample")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = RunReport(args, CACHE_DIR / "profiles" if args.profile else None)
+
+    out = OutputDir(CACHE_DIR / PREVIEW_DIR_NAME if args.sample else OUTPUT_DIR)
+    stage_cache = out.path / "stages" if args.sample else None
+
+    print("=" * 60)
+    print("NYC Bike Rhythms Data Processing")
+    print("=" * 60)
+
+    # Ensure output directory exists
+    out.path.mkdir(parents=True, exist_ok=True)
 
-    moments = generate_story_moments(patterns, trips)
-    save_json(moments, 'story-moments.json')
+    # Build each requested output, computing (or reloading) only the stages it needs
+    graph = StageGraph(PIPELINE_STAGES, args, report, out, force=args.force, cache_dir=stage_cache)
+    outputs = [name for name in OUTPUT_STAGES if args.sample or name not in SAMPLE_OUTPUT_STAGES]
+    for name in args.only or outputs:
+        graph.build(name)
 
-    metadata = generate_metadata(trips)
-    save_json(metadata, 'metadata.json')
+    save_output_manifest(out)
+    if not args.sample:
+        publish_outputs(out, PUBLIC_DIR)
+    report.print_summary()
+    save_json(out, report.to_dict(), 'run-report.json', listed=False)
 
     print("\n" + "=" * 60)
     print("Processing complete!")
-    print(f"Output files saved to: {OUTPUT_DIR}")
+    print(f"Output files saved to: {out.path}")
     print("=" * 60)
+    return out
 
 if __name__ == "__main__":
     main()
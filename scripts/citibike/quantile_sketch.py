@@ -0,0 +1,144 @@
+"""
+Mergeable quantile sketches for many groups at once.
+
+Values are counted in logarithmic buckets, as in DDSketch: bucket i holds
+values in (min_value * gamma^(i-1), min_value * gamma^i], and every quantile
+read back is within relative_accuracy of a value in its bucket. Sketches
+built from different chunks, workers or months merge by adding bucket
+counts, so memory depends on the number of groups and buckets in use rather
+than on the number of values:
+
+    from quantile_sketch import QuantileSketches
+    sketches = QuantileSketches(60, 86400, relative_accuracy=0.02)
+    sketches.add(groups, durations)       # one call per chunk
+    groups, counts, values = sketches.quantiles([0.5, 0.9])
+"""
+
+import numpy as np
+
+# Merge buffered per-chunk counts once they reach this many entries (or the
+# size of the running counts, whichever is larger)
+COMPACT_THRESHOLD = 1_000_000
+
+class QuantileSketches:
+    """One bucket histogram per integer group, stored sparsely.
+
+    keys are group * buckets + bucket, sorted, with a count per key. Values
+    below min_value or above max_value are counted in the first or last
+    bucket, so callers should drop values they don't trust first.
+    """
+
+    def __init__(self, min_value, max_value, relative_accuracy=0.02):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = int(np.ceil(np.log(max_value / min_value) / np.log(self.gamma))) + 1
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+
+    def bucket(self, values):
+        """Bucket index of each value."""
+        index = np.ceil(np.log(np.asarray(values, dtype=np.float64) / self.min_value) / np.log(self.gamma))
+        return np.clip(index, 0, self.buckets - 1).astype(np.int64)
+
+    def bucket_value(self, buckets):
+        """The value that represents each bucket: within relative_accuracy of its whole range."""
+        buckets = np.asarray(buckets)
+        upper = self.min_value * self.gamma ** buckets.astype(np.float64)
+        return np.where(buckets == 0, self.min_value, 2 * upper / (self.gamma + 1))
+
+    def add(self, groups, values):
+        """Count one value per entry of groups."""
+        self.add_buckets(groups, self.bucket(values))
+
+    def add_buckets(self, groups, buckets):
+        """Count values that are already bucketed, one per entry of groups."""
+        keys = np.asarray(groups, dtype=np.int64) * self.buckets + np.asarray(buckets, dtype=np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        self._add_counts(keys, counts.astype(np.int64))
+
+    def add_bucket_counts(self, groups, buckets, counts):
+        """Add counts of bucketed values, e.g. tallied in SQL; rows may repeat."""
+        keys = np.asarray(groups, dtype=np.int64) * self.buckets + np.asarray(buckets, dtype=np.int64)
+        self._add_counts(keys, np.asarray(counts, dtype=np.int64))
+
+    def _add_counts(self, keys, counts):
+        self._pending.append((keys, counts))
+        self._pending_size += len(keys)
+        if self._pending_size >= max(COMPACT_THRESHOLD, len(self.keys)):
+            self.compact()
+
+    def compact(self):
+        """Fold buffered counts into the sorted running counts."""
+        if not self._pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, _ in self._pending])
+        counts = np.concatenate([self.counts] + [c for _, c in self._pending])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        self.keys = keys
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+        self._pending = []
+        self._pending_size = 0
+
+    def merge(self, other, group_map=None):
+        """Add another sketch's counts, optionally renumbering its groups.
+
+        group_map[g] is the new group of other's group g; groups mapped to
+        -1 are dropped. Both sketches must share min, max and accuracy.
+        """
+        if (other.min_value, other.max_value, other.buckets) != (self.min_value, self.max_value, self.buckets):
+            raise ValueError("Can only merge sketches with the same range and accuracy")
+        other.compact()
+        keys, counts = other.keys, other.counts
+        if group_map is not None:
+            groups = np.asarray(group_map, dtype=np.int64)[keys // self.buckets]
+            kept = groups >= 0
+            keys, counts = groups[kept] * self.buckets + keys[kept] % self.buckets, counts[kept]
+        self._add_counts(keys, counts)
+
+    def regroup(self, group_map):
+        """A new sketch with groups renumbered (and combined) by group_map."""
+        regrouped = QuantileSketches(self.min_value, self.max_value, self.relative_accuracy)
+        regrouped.merge(self, group_map)
+        regrouped.compact()
+        return regrouped
+
+    def scale(self, factor):
+        """Multiply every count by factor, e.g. to scale a sample back up."""
+        self.compact()
+        self.counts = self.counts * factor
+
+    def quantiles(self, qs):
+        """Quantiles of every group that has values.
+
+        Returns (groups, counts, values): the sorted group ids, the number of
+        values in each, and values[i, j], the qs[j] quantile of groups[i].
+        """
+        self.compact()
+        groups = self.keys // self.buckets
+        starts = np.flatnonzero(np.diff(groups, prepend=-1))
+        cumulative = np.cumsum(self.counts)
+        before = np.concatenate([[0], cumulative])[starts]
+        totals = np.add.reduceat(self.counts, starts) if len(starts) else np.empty(0, dtype=np.int64)
+
+        # The q quantile is the value of rank max(1, ceil(q * n)) within its group
+        ranks = np.maximum(1, np.ceil(np.outer(totals, qs) - 1e-9)).astype(np.int64)
+        positions = np.searchsorted(cumulative, before[:, None] + ranks)
+        values = self.bucket_value(self.keys[positions] % self.buckets)
+        return groups[starts], totals, values
+
+    def to_arrays(self, prefix):
+        """Arrays for np.savez; read back with from_arrays."""
+        self.compact()
+        return {f'{prefix}_keys': self.keys, f'{prefix}_counts': self.counts}
+
+    def from_arrays(self, arrays, prefix):
+        """Replace the counts with ones saved by to_arrays."""
+        self.keys = np.asarray(arrays[f'{prefix}_keys'], dtype=np.int64)
+        self.counts = np.asarray(arrays[f'{prefix}_counts'], dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+        return self
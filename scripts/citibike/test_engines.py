@@ -0,0 +1,127 @@
+"""Every aggregation engine must produce exactly the pandas engine's outputs."""
+
+import argparse
+import importlib.util
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from test_trips import add_header_only_member
+
+needs_duckdb = pytest.mark.skipif(importlib.util.find_spec('duckdb') is None, reason="duckdb is not installed")
+
+def aggregate(pipeline, engine, workers=1, stream=False, partitions=None, incremental=False):
+    # Small chunks, so every engine merges many partial aggregates
+    args = argparse.Namespace(stream=stream, workers=workers, incremental=incremental, chunk_size=4_000)
+    return pipeline.ENGINES[engine](args).trip_aggregates(pipeline.RunReport(), partitions)
+
+def by_station_id(aggregates):
+    """OD counts, duration/speed sketches and stations keyed by station ID.
+
+    Station codes follow the order stations are first seen in each chunk, so
+    engines that chunk differently may number them differently.
+    """
+    ids = np.array([station_id or '' for station_id in aggregates.station_ids], dtype=object)
+    od = aggregates.od_frame()
+    od['start_station'] = ids[od['start_station']]
+    od['end_station'] = ids[od['end_station']]
+    state = {
+        'od': od.sort_values(['start_station', 'end_station', 'day_of_week', 'hour']),
+        'stations': aggregates.stations().sort_values('station_id'),
+    }
+    for name in ('durations', 'speeds'):
+        sketch = getattr(aggregates, name)
+        arrays = sketch.to_arrays(name)
+        groups, buckets = np.divmod(arrays[f'{name}_keys'], sketch.buckets)
+        state[name] = pd.DataFrame({'station': ids[groups // 24], 'hour': groups % 24, 'bucket': buckets,
+                                    'count': arrays[f'{name}_counts']}).sort_values(['station', 'hour', 'bucket'])
+    return {name: frame.reset_index(drop=True) for name, frame in state.items()}
+
+def assert_same_aggregates(actual, expected):
+    """Stations, first-seen coordinates, OD counts, sketches and totals all match."""
+    expected_state = by_station_id(expected)
+    for name, frame in by_station_id(actual).items():
+        pd.testing.assert_frame_equal(frame, expected_state[name], obj=name)
+    assert ((actual.total_trips, actual.member_trips, actual.first_start, actual.last_start)
+            == (expected.total_trips, expected.member_trips, expected.first_start, expected.last_start))
+
+def outputs(pipeline, aggregates):
+    """The pattern cube, flows, trip distributions and metadata built from one set of aggregates."""
+    nta = pipeline.load_neighborhoods()
+    station_mapping = pipeline.create_station_to_nta_mapping(aggregates.stations(), nta)
+    patterns, flow_cube = pipeline.aggregate_by_neighborhood(aggregates, station_mapping)
+    return patterns, {
+        'flows': pipeline.generate_flows(flow_cube, pipeline.calculate_centroids(nta)),
+        'trip-distributions': pipeline.generate_trip_distributions(aggregates, station_mapping),
+        'metadata': pipeline.generate_metadata(aggregates),
+    }
+
+ENGINE_MODES = [
+    ('pandas', 1, True),
+    ('pandas', 2, False),
+    pytest.param('duckdb', 1, False, marks=needs_duckdb),
+    pytest.param('duckdb', 2, False, marks=needs_duckdb),
+    ('store', 1, False),
+    ('store', 2, False),
+]
+
+@pytest.mark.parametrize('engine, workers, stream', ENGINE_MODES)
+def test_engine_matches_pandas(pipeline, engine, workers, stream):
+    expected_patterns, expected = outputs(pipeline, aggregate(pipeline, 'pandas'))
+    patterns, actual = outputs(pipeline, aggregate(pipeline, engine, workers, stream))
+
+    assert patterns.ntacodes == expected_patterns.ntacodes
+    assert np.array_equal(patterns.counts, expected_patterns.counts)
+    for name in expected:
+        assert actual[name] == expected[name], f"{name} differs"
+
+@pytest.mark.parametrize('workers', [2, 3])
+@pytest.mark.parametrize('cache', [False, True], ids=['zips', 'cache'])
+def test_parallel_aggregates_match_serial(pipeline, workers, cache):
+    # With the cache, workers split the Parquet partitions by row group instead of by zip member
+    partitions = pipeline.build_trip_cache() if cache else None
+    expected = aggregate(pipeline, 'pandas', partitions=partitions)
+    assert_same_aggregates(aggregate(pipeline, 'pandas', workers, partitions=partitions), expected)
+
+@pytest.mark.parametrize('engine, workers, stream', [('pandas', 1, False)] + ENGINE_MODES)
+def test_header_only_members_add_no_trips(pipeline, tmp_path, monkeypatch, engine, workers, stream):
+    expected = aggregate(pipeline, 'pandas')
+    monkeypatch.setattr(pipeline, 'RAW_DIR', add_header_only_member(pipeline.RAW_DIR, tmp_path / "raw"))
+    assert_same_aggregates(aggregate(pipeline, engine, workers, stream), expected)
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_incremental_aggregates_match_full_rebuild(pipeline, workers):
+    expected = aggregate(pipeline, 'pandas')
+    assert_same_aggregates(aggregate(pipeline, 'pandas', workers, incremental=True), expected)
+
+def test_incremental_reaggregates_only_changed_zips(pipeline, tmp_path, monkeypatch):
+    zips = sorted(pipeline.RAW_DIR.glob("*.zip"))
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    shutil.copy(zips[0], raw)
+    monkeypatch.setattr(pipeline, 'RAW_DIR', raw)
+
+    aggregated = []
+    aggregate_month = pipeline._aggregate_month
+    def record(zip_path, *args):
+        aggregated.append(zip_path.name)
+        return aggregate_month(zip_path, *args)
+    monkeypatch.setattr(pipeline, '_aggregate_month', record)
+
+    def update(expected_names):
+        aggregated.clear()
+        assert_same_aggregates(aggregate(pipeline, 'pandas', incremental=True), aggregate(pipeline, 'pandas'))
+        assert aggregated == expected_names
+        assert len(list((pipeline.CACHE_DIR / "aggregates").glob("*.npz"))) == len(list(raw.glob("*.zip")))
+
+    update([zips[0].name])
+    update([])
+    # A new month
+    shutil.copy(zips[1], raw)
+    update([zips[1].name])
+    # A changed month, whose stale partition is replaced
+    changed = add_header_only_member(raw, tmp_path / "changed")
+    shutil.copy(changed / zips[0].name, raw)
+    update([zips[0].name])
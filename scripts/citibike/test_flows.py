@@ -0,0 +1,67 @@
+"""Flows must match a plain pandas groupby of the neighborhood OD counts."""
+
+import argparse
+
+import pandas as pd
+
+# The synthetic trips are too few for any flow to reach the thresholds, so
+# their counts are scaled up; equal multiples also make ties in topFlows
+SCALE = 150
+
+def reference_flows(od, centroids):
+    """Significant flows by day type and period, and the top flows overall."""
+    valid = od[od['start_nta'] != od['end_nta']].copy()
+    valid['day_type'] = valid['day_of_week'].apply(lambda day: 'weekday' if day < 5 else 'weekend')
+
+    def time_period(hour):
+        if 6 <= hour < 10:
+            return 'morning_rush'
+        elif 10 <= hour < 12:
+            return 'late_morning'
+        elif 12 <= hour < 16:
+            return 'midday'
+        elif 16 <= hour < 20:
+            return 'evening_rush'
+        elif 20 <= hour < 24:
+            return 'night'
+        return 'late_night'
+    valid['time_period'] = valid['hour'].apply(time_period)
+
+    def coord(ntacode):
+        return [round(centroids[ntacode][0], 4), round(centroids[ntacode][1], 4)]
+
+    counts = valid.groupby(['start_nta', 'end_nta', 'day_type', 'time_period'],
+                           observed=True)['count'].sum().reset_index()
+    counts = counts[counts['count'] >= 200]
+    flows = [{'f': row.start_nta, 't': row.end_nta, 'fc': coord(row.start_nta), 'tc': coord(row.end_nta),
+              'd': 0 if row.day_type == 'weekday' else 1, 'p': row.time_period, 'c': int(row.count)}
+             for row in counts.itertuples()
+             if row.start_nta in centroids and row.end_nta in centroids]
+
+    totals = valid.groupby(['start_nta', 'end_nta'], observed=True)['count'].sum().reset_index()
+    totals = totals[totals['count'] >= 1000].sort_values('count', ascending=False).head(150)
+    top_flows = [{'f': row.start_nta, 't': row.end_nta, 'fc': coord(row.start_nta),
+                  'tc': coord(row.end_nta), 'c': int(row.count)}
+                 for row in totals.itertuples()
+                 if row.start_nta in centroids and row.end_nta in centroids]
+    return flows, top_flows
+
+def test_flows_match_groupby(pipeline):
+    args = argparse.Namespace(stream=False, workers=1, incremental=False, chunk_size=4_000)
+    aggregates = pipeline.ENGINES['pandas'](args).trip_aggregates(pipeline.RunReport())
+    aggregates.scale_counts(SCALE)
+    nta = pipeline.load_neighborhoods()
+    centroids = pipeline.calculate_centroids(nta)
+    station_mapping = pipeline.create_station_to_nta_mapping(aggregates.stations(), nta)
+    _, flow_cube = pipeline.aggregate_by_neighborhood(aggregates, station_mapping)
+
+    od = aggregates.od_frame()
+    station_nta, nta_codes = pipeline.station_nta_table(aggregates.station_ids, station_mapping)
+    od['start_nta'] = pd.Categorical.from_codes(station_nta[od['start_station']], categories=nta_codes)
+    od['end_nta'] = pd.Categorical.from_codes(station_nta[od['end_station']], categories=nta_codes)
+    flows, top_flows = reference_flows(od, centroids)
+
+    actual = pipeline.generate_flows(flow_cube, centroids)
+    assert flows and top_flows
+    assert actual['flows'] == flows
+    assert actual['topFlows'] == top_flows
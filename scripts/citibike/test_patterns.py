@@ -0,0 +1,53 @@
+"""Neighborhood patterns must match a plain pandas groupby of the trips."""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+def neighborhood_patterns(pipeline):
+    """The PatternCube, the trips it was built from and their station mapping."""
+    args = argparse.Namespace(stream=False, workers=1, incremental=False, chunk_size=4_000)
+    aggregates = pipeline.ENGINES['pandas'](args).trip_aggregates(pipeline.RunReport())
+    nta = pipeline.load_neighborhoods()
+    station_mapping = pipeline.create_station_to_nta_mapping(aggregates.stations(), nta)
+    patterns, _ = pipeline.aggregate_by_neighborhood(aggregates, station_mapping)
+    trips = pipeline.parse_datetime(pipeline.load_and_process_trips(pipeline.AGGREGATE_COLUMNS))
+    return patterns, trips, station_mapping, nta
+
+def reference_patterns(trips, station_mapping):
+    """Departures, arrivals and net per neighborhood, day and hour, one row per slot with trips."""
+    ntacodes = {station_id: entry['ntacode'] for station_id, entry in station_mapping.items()}
+    counts = {}
+    for measure, column in (('departures', 'start_station_id'), ('arrivals', 'end_station_id')):
+        ntacode = trips[column].astype(object).map(ntacodes).rename('ntacode')
+        counts[measure] = trips.groupby([ntacode, 'day_of_week', 'hour']).size()
+    patterns = pd.concat(counts, axis=1).fillna(0).astype(np.int64)
+    patterns['net'] = patterns['arrivals'] - patterns['departures']
+    return patterns
+
+def test_pattern_cube_matches_groupby(pipeline):
+    patterns, trips, station_mapping, _ = neighborhood_patterns(pipeline)
+    expected = reference_patterns(trips, station_mapping)
+
+    ntacodes = sorted(expected.index.unique('ntacode'))
+    slots = pd.MultiIndex.from_product([ntacodes, range(7), range(24)])
+    dense = expected.reindex(slots, fill_value=0)[['departures', 'arrivals', 'net']].to_numpy()
+
+    assert patterns.ntacodes == ntacodes
+    assert np.array_equal(patterns.counts, dense.reshape(len(ntacodes), 7, 24, 3))
+
+def test_peak_hours_match_groupby(pipeline):
+    patterns, trips, station_mapping, nta = neighborhood_patterns(pipeline)
+    expected = reference_patterns(trips, station_mapping).reset_index()
+
+    # Weekday departures by hour, over the hours with any weekday trips;
+    # idxmax keeps the earliest of tied hours
+    weekday = expected[expected['day_of_week'] < 5].groupby(['ntacode', 'hour'])['departures'].sum()
+    peak_hours = weekday.groupby('ntacode').idxmax().str[1].to_dict()
+    totals = expected.groupby('ntacode')[['departures', 'arrivals']].sum()
+
+    stats = pipeline.neighborhood_stats(nta, patterns).set_index('ntacode')
+    assert stats['peakHour'].dropna().astype(int).to_dict() == peak_hours
+    pd.testing.assert_frame_equal(stats[['departures', 'arrivals']].sort_index(), totals,
+                                  check_names=False, check_dtype=False)
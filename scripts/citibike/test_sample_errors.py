@@ -0,0 +1,20 @@
+"""sample-errors.json must describe the cells the outputs actually show."""
+
+import json
+import math
+
+def test_hourly_errors_follow_each_weekly_pattern_cell(pipeline):
+    out = pipeline.main(['--sample', '0.5'])
+    errors = json.loads((out.path / "sample-errors.json").read_text())
+    weekly = json.loads((out.path / "weekly-patterns.json").read_text())
+    scale = errors['scale']
+
+    assert errors['neighborhoods'].keys() == weekly.keys()
+    for ntacode, pattern in weekly.items():
+        hourly = errors['neighborhoods'][ntacode]['hourlyRse']
+        for measure in ('departures', 'arrivals'):
+            assert len(hourly[measure]) == 7 and all(len(day) == 24 for day in hourly[measure])
+            for day, day_counts in enumerate(pattern['data']):
+                for cell in day_counts:
+                    expected = round(math.sqrt((scale - 1) / cell[measure]), 4) if cell[measure] else None
+                    assert hourly[measure][day][cell['hour']] == expected
@@ -0,0 +1,61 @@
+"""Stage keys must follow the code a stage uses, and stages must rebuild missing files."""
+
+import json
+
+def keys(pipeline, tmp_path):
+    graph = pipeline.StageGraph(pipeline.PIPELINE_STAGES, pipeline.parse_args([]), pipeline.RunReport(),
+                                pipeline.OutputDir(tmp_path / "output"), cache_dir=tmp_path / "stages")
+    return {name: graph.key(name) for name in graph.stages}
+
+def test_stage_code_follows_helpers_and_constants(pipeline):
+    code, constants = pipeline.stage_code(pipeline.PipelineStage('trips', pipeline._run_trips).code)
+    for helper in ('timestamp_seconds', 'QuantileSketches', 'TripStore', 'PandasEngine', 'DuckDBEngine'):
+        assert any(name.endswith(f".{helper}") for name in code), helper
+    assert 'process_data.ENGINES' in constants
+    assert not any(name.endswith(('_DIR', '_FILE')) for name in constants)
+
+    code, _ = pipeline.stage_code(pipeline.PipelineStage('metadata', pipeline._write_metadata).code)
+    assert {'process_data.save_json', 'process_data.encode_json', 'process_data.save_output'} <= code.keys()
+
+def test_constant_changes_only_the_stages_using_it(pipeline, tmp_path, monkeypatch):
+    before = keys(pipeline, tmp_path)
+    monkeypatch.setattr(pipeline, 'STORY_FLOW_LIMITS', {**pipeline.STORY_FLOW_LIMITS, 'all': 1})
+    after = keys(pipeline, tmp_path)
+    assert {name for name in before if before[name] != after[name]} == {'story-moments'}
+
+def test_missing_files_are_rebuilt(pipeline):
+    output = pipeline.main([]).path
+    moment = next(moment for moment in json.loads((output / "story-moments.json").read_text()) if 'flowSet' in moment)
+    story_flows = output / moment['flowSet']['file']
+    manifest = json.loads((output / pipeline.OUTPUT_MANIFEST).read_text())['files']
+    bundle = output / manifest[pipeline.flow_bundle_file(pipeline.FLOW_BUNDLE_KEYS[-1])]['file']
+    compressed = output / manifest['trip-distributions.json']['file']
+    compressed = compressed.with_name(compressed.name + '.gz')
+    for path in (story_flows, bundle, compressed):
+        path.unlink()
+
+    out = pipeline.main([])
+    assert story_flows.exists() and bundle.exists() and compressed.exists()
+    assert not any(name.startswith(('weekly-patterns', 'metadata')) for name in out.saved)
+
+def test_sample_runs_write_only_to_the_preview(pipeline):
+    output_dir = pipeline.OUTPUT_DIR
+    out = pipeline.main(['--sample', '0.5'])
+
+    assert out.path == pipeline.CACHE_DIR / pipeline.PREVIEW_DIR_NAME
+    assert (out.path / "sample-errors.json").exists()
+    assert pipeline.OUTPUT_DIR == output_dir and not output_dir.exists()
+    assert not pipeline.PUBLIC_DIR.exists()
+
+def test_public_copy_matches_outputs(pipeline):
+    out = pipeline.main([])
+    public = pipeline.PUBLIC_DIR
+    manifest = (out.path / pipeline.OUTPUT_MANIFEST).read_bytes()
+    assert (public / pipeline.OUTPUT_MANIFEST).read_bytes() == manifest
+
+    files = json.loads(manifest)['files']
+    fetched = {name: entry['file'] for name, entry in files.items() if entry['file'] != name}
+    assert {'flows/manifest.json', 'neighborhoods/low.json'} <= fetched.keys()
+    for file in fetched.values():
+        assert (public / file).read_bytes() == (out.path / file).read_bytes()
+    assert not (public / 'metadata.json').exists()
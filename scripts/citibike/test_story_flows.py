@@ -0,0 +1,42 @@
+"""Story moments written by the pipeline must point at flow sets the site can load."""
+
+import hashlib
+import json
+import sys
+
+def test_story_moments_load_their_flow_sets(pipeline, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['process_data.py'])
+    pipeline.main()
+
+    output = pipeline.OUTPUT_DIR
+    manifest = json.loads((output / pipeline.OUTPUT_MANIFEST).read_text())
+    moments = json.loads((output / "story-moments.json").read_text())
+    assert any(moment.get('flowSet') for moment in moments)
+
+    for moment in moments:
+        flow_filter = moment.get('flowFilter')
+        if not flow_filter:
+            assert 'flowSet' not in moment
+            continue
+
+        # An hour/day filter (StoryFlowFilter) always comes with its flow set:
+        # the site never filters it client-side
+        assert {'hours', 'days', 'direction'} <= flow_filter.keys()
+        assert 'timePeriods' not in flow_filter
+        ref = moment['flowSet']
+
+        # Loaded the way loadStoryFlows in lib/citibike.ts does
+        content = (output / ref['file']).read_bytes()
+        assert hashlib.sha256(content).hexdigest() == ref['sha256']
+        assert manifest['files'][f"{pipeline.STORY_FLOW_DIR}/{moment['id']}.json"]['file'] == ref['file']
+        flow_set = json.loads(content)
+
+        ntas = len(flow_set['ntas'])
+        assert len(flow_set['centroids']) == ntas
+        assert len(flow_set['f']) == len(flow_set['t']) == len(flow_set['c'])
+        assert all(0 <= i < ntas for i in flow_set['f'] + flow_set['t'])
+        assert flow_set['c'] and flow_set['c'] == sorted(flow_set['c'], reverse=True)
+        assert flow_set['trips'] == ref['trips'] >= sum(flow_set['c'])
+        for ends, prefixes in (('f', flow_filter.get('fromPrefixes')), ('t', flow_filter.get('toPrefixes'))):
+            if prefixes:
+                assert all(flow_set['ntas'][i].startswith(tuple(prefixes)) for i in flow_set[ends])
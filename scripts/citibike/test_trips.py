@@ -0,0 +1,27 @@
+"""Loading trips from the raw zips."""
+
+import shutil
+import zipfile
+
+import pandas as pd
+
+def add_header_only_member(raw_dir, target):
+    """Copy the trip zips in raw_dir to target, adding a header-only CSV to the first."""
+    target.mkdir()
+    zips = sorted(raw_dir.glob("*.zip"))
+    for zip_path in zips:
+        shutil.copy(zip_path, target)
+    with zipfile.ZipFile(zips[0]) as archive:
+        with archive.open(archive.namelist()[0]) as member:
+            header = member.readline()
+    with zipfile.ZipFile(target / zips[0].name, 'a') as archive:
+        archive.writestr(f"{zips[0].stem}_empty.csv", header)
+    return target
+
+def test_header_only_members_are_skipped(pipeline, tmp_path, monkeypatch):
+    expected = pipeline.load_and_process_trips(pipeline.AGGREGATE_COLUMNS)
+    monkeypatch.setattr(pipeline, 'RAW_DIR', add_header_only_member(pipeline.RAW_DIR, tmp_path / "raw"))
+    trips = pipeline.load_and_process_trips(pipeline.AGGREGATE_COLUMNS)
+
+    assert isinstance(trips['start_station_id'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(trips, expected)
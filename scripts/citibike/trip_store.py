@@ -0,0 +1,104 @@
+"""
+Memory-mapped columnar store of parsed trips.
+
+process_data.py --engine store decodes the trip zips once into one flat file
+per column under cache/store/<key>/. Worker processes are only handed the
+directory and a row range; they open the same files with np.memmap, so the
+trips exist once in the page cache however many workers read them:
+
+    from trip_store import TripStore
+    store = TripStore.load('cache/store/<key>')
+    for rows in store.row_slices(4):
+        night = (store.hour[rows] < 5).sum()
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+class TripStore:
+    """One row per trip, as parallel fixed-width columns.
+
+    start and end are station codes (0 for a missing station ID), day is the
+    day of week (0=Monday) and hour the hour the trip started.
+    duration_bucket and speed_bucket are the trip's quantile sketch buckets,
+    or -1 for trips without a usable duration or speed.
+    """
+
+    COLUMNS = {'start': np.int32, 'end': np.int32, 'day': np.int8, 'hour': np.int8, 'member': np.bool_,
+               'duration_bucket': np.int16, 'speed_bucket': np.int16}
+
+    def __init__(self, start, end, day, hour, member, duration_bucket, speed_bucket):
+        self.start = start
+        self.end = end
+        self.day = day
+        self.hour = hour
+        self.member = member
+        self.duration_bucket = duration_bucket
+        self.speed_bucket = speed_bucket
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.COLUMNS)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map a store written by TripStoreWriter, read-only."""
+        directory = Path(directory)
+        rows = json.loads((directory / "rows.json").read_text())
+        columns = [np.memmap(directory / f"{column}.bin", dtype=dtype, mode='r', shape=(rows,))
+                   if rows else np.empty(0, dtype=dtype)
+                   for column, dtype in cls.COLUMNS.items()]
+        return cls(*columns)
+
+    def row_slices(self, parts):
+        """Split the rows into at most `parts` contiguous, non-empty slices."""
+        bounds = np.linspace(0, len(self), max(1, parts) + 1).astype(np.int64)
+        return [slice(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+class TripStoreWriter:
+    """Append column chunks to a new store.
+
+    Rows go to a temporary directory (`path`, where callers may add files of
+    their own) that replaces `directory` on a clean exit, so a half-written
+    store is never picked up.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.path = self.directory.with_suffix('.tmp')
+        self.rows = 0
+        self._files = {}
+
+    def __enter__(self):
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        self._files = {column: open(self.path / f"{column}.bin", 'wb') for column in TripStore.COLUMNS}
+        return self
+
+    def append(self, **columns):
+        """Write one chunk; every column must be given, all of the same length."""
+        lengths = {len(columns[column]) for column in TripStore.COLUMNS}
+        if len(lengths) != 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+        for column, dtype in TripStore.COLUMNS.items():
+            np.ascontiguousarray(columns[column], dtype=dtype).tofile(self._files[column])
+        self.rows += lengths.pop()
+
+    def __exit__(self, exc_type, exc, tb):
+        for f in self._files.values():
+            f.close()
+        if exc_type is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return False
+        (self.path / "rows.json").write_text(json.dumps(self.rows))
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+        self.path.replace(self.directory)
+        return False